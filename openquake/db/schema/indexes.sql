@@ -37,6 +37,9 @@ CREATE INDEX hzrdi_simple_fault_outline_idx ON hzrdi.simple_fault USING gist(out
 CREATE INDEX hzrdi_source_area_idx ON hzrdi.source USING gist(area);
 CREATE INDEX hzrdi_source_point_idx ON hzrdi.source USING gist(point);
 
+-- hzrdr.hazard_curve_data
+CREATE INDEX hzrdr_hazard_curve_data_location_idx ON hzrdr.hazard_curve_data USING gist(location);
+
 -- index for the 'owner_id' foreign key
 CREATE INDEX eqcat_catalog_owner_id_idx on eqcat.catalog(owner_id);
 CREATE INDEX hzrdi_complex_fault_owner_id_idx on hzrdi.complex_fault(owner_id);
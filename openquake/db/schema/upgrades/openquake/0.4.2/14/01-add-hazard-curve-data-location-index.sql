@@ -0,0 +1,13 @@
+/*
+
+    Copyright (c) 2010-2011, GEM Foundation.
+
+    OpenQuake database is made available under the Open Database License:
+    http://opendatacommons.org/licenses/odbl/1.0/. Any rights in individual
+    contents of the database are licensed under the Database Contents License:
+    http://opendatacommons.org/licenses/dbcl/1.0/
+
+*/
+
+
+CREATE INDEX hzrdr_hazard_curve_data_location_idx ON hzrdr.hazard_curve_data USING gist(location);
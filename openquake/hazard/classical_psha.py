@@ -21,10 +21,12 @@ Collection of functions that compute stuff using
 as input data produced with the classical psha method.
 """
 
+import heapq
 import math
 import numpy
 
-from scipy.interpolate import interp1d
+from itertools import izip
+
 from scipy.stats.mstats import mquantiles
 
 from openquake import kvs
@@ -34,6 +36,28 @@ from openquake.logs import LOG
 QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES_HAZARD_MAPS"
 
+# Maximum number of sites whose curves (for all realizations) are loaded
+# into memory at once by the statistics functions below.
+STATISTICS_BLOCK_SIZE = 100
+
+# Plotting positions used by `mquantiles` (the default, i.e. Cunnane's
+# approximation); the vectorized quantile code reproduces its results.
+_QUANTILE_ALPHAP = 0.4
+_QUANTILE_BETAP = 0.4
+
+# Incremental statistics: the quantile curves of a site are computed exactly
+# from its curves when it has at most QUANTILE_SAMPLES realizations, else
+# from a sketch of its PoEs (see _sketch_bins) whose estimates are within a
+# relative error of QUANTILE_SKETCH_ACCURACY (an absolute error of
+# QUANTILE_SKETCH_MIN_POE for the smaller PoEs).
+QUANTILE_SAMPLES = 100
+QUANTILE_SKETCH_ACCURACY = 0.01
+QUANTILE_SKETCH_MIN_POE = 1e-12
+
+_SKETCH_GAMMA = (1 + QUANTILE_SKETCH_ACCURACY) / (1 - QUANTILE_SKETCH_ACCURACY)
+_SKETCH_ZERO_BIN = int(math.ceil(
+    math.log(QUANTILE_SKETCH_MIN_POE, _SKETCH_GAMMA))) - 1
+
 
 def compute_mean_curve(curves):
     """Compute a mean hazard curve.
@@ -59,8 +83,130 @@ def compute_quantile_curve(curves, quantile):
     return result
 
 
+def compute_mean_curve_block(curves):
+    """Compute the mean hazard curves for a block of sites.
+
+    :param curves: the hazard curves (PoEs only) for a block of sites, as
+        returned by :py:func:`poes_block_at`
+    :type curves: 3-dimensional :py:class:`numpy.ndarray` of shape
+        (sites, realizations, IMLs)
+    :returns: the mean curve of each site
+    :rtype: 2-dimensional :py:class:`numpy.ndarray` of shape (sites, IMLs)
+    """
+    return curves.mean(axis=1)
+
+
+def compute_quantile_curve_block(curves, quantiles):
+    """Compute the quantile hazard curves for a block of sites.
+
+    All the quantiles are computed in a single sort along the realization
+    axis. The results match the ones of :py:func:`compute_quantile_curve`
+    (i.e. `mquantiles` with its default plotting positions).
+
+    :param curves: the hazard curves (PoEs only) for a block of sites, as
+        returned by :py:func:`poes_block_at`
+    :type curves: 3-dimensional :py:class:`numpy.ndarray` of shape
+        (sites, realizations, IMLs)
+    :param quantiles: the quantiles to compute
+    :type quantiles: list of :py:class:`float`
+    :returns: the quantile curves of each site, one 2-dimensional array of
+        shape (sites, IMLs) for each quantile
+    :rtype: 3-dimensional :py:class:`numpy.ndarray` of shape
+        (quantiles, sites, IMLs)
+    """
+    sorted_curves = numpy.sort(curves, axis=1)
+    realizations = curves.shape[1]
+
+    result = numpy.empty((len(quantiles), curves.shape[0], curves.shape[2]))
+
+    for idx, quantile in enumerate(quantiles):
+        k, gamma = _quantile_position(realizations, quantile)
+
+        result[idx] = ((1.0 - gamma) * sorted_curves[:, k - 1, :]
+                       + gamma * sorted_curves[:, k, :])
+
+    return result
+
+
+def _quantile_position(realizations, quantile):
+    """The quantile lies between the order statistics k - 1 and k (counting
+    from 0) of the realizations, at the fraction gamma of the way: return
+    (k, gamma)."""
+    aleph = realizations * quantile + _QUANTILE_ALPHAP + quantile * (
+        1.0 - _QUANTILE_ALPHAP - _QUANTILE_BETAP)
+    k = int(math.floor(min(max(aleph, 1), realizations - 1)))
+    gamma = min(max(aleph - k, 0.0), 1.0)
+
+    return k, gamma
+
+
+def _sketch_bins(curve):
+    """The bins of the quantile sketch the PoEs of a curve fall in.
+
+    Bin b holds the PoEs in (g ** (b - 1), g ** b], where g is
+    (1 + a) / (1 - a) for a QUANTILE_SKETCH_ACCURACY of a: all of them are
+    within a relative error a of the bin value 2 * g ** b / (g + 1). The
+    PoEs below QUANTILE_SKETCH_MIN_POE fall in a bin valued 0, so that there
+    are at most log(QUANTILE_SKETCH_MIN_POE) / log(g) + 2 bins.
+    """
+    curve = numpy.asarray(curve, dtype=float)
+
+    with numpy.errstate(divide="ignore"):
+        bins = numpy.ceil(numpy.log(curve) / math.log(_SKETCH_GAMMA))
+
+    bins[curve < QUANTILE_SKETCH_MIN_POE] = _SKETCH_ZERO_BIN
+
+    return bins.astype(int)
+
+
+def _sketch_value(bin_):
+    """The PoE estimating all the ones in the given bin of the sketch."""
+    if bin_ == _SKETCH_ZERO_BIN:
+        return 0.0
+
+    return 2 * _SKETCH_GAMMA ** bin_ / (_SKETCH_GAMMA + 1)
+
+
+def compute_quantile_curve_sketch(sketch, quantiles):
+    """Estimate the quantile curves of a site from the sketch of its PoEs
+    built by :py:func:`accumulate_hazard_curves`.
+
+    The order statistics enclosing each quantile are estimated from the
+    sketch, and interpolated like :py:func:`compute_quantile_curve_block`
+    does: each quantile PoE is hence within a relative error of
+    QUANTILE_SKETCH_ACCURACY of the exact one (within an absolute error of
+    QUANTILE_SKETCH_MIN_POE for the smaller PoEs).
+
+    :param sketch: the number of PoEs in each bin, for each IML
+    :type sketch: list of :py:class:`dict` (bins as strings)
+    :param quantiles: the quantiles to compute
+    :type quantiles: list of :py:class:`float`
+    :returns: the quantile curves, one for each quantile
+    :rtype: 2-dimensional :py:class:`numpy.ndarray` of shape
+        (quantiles, IMLs)
+    """
+    result = numpy.empty((len(quantiles), len(sketch)))
+
+    for iml_idx, counts in enumerate(sketch):
+        bins = sorted(int(bin_) for bin_ in counts)
+        last_ranks = numpy.cumsum([counts[str(bin_)] for bin_ in bins])
+
+        def order_statistic(rank):
+            """Estimate the order statistic `rank` (counting from 0)."""
+            return _sketch_value(
+                bins[numpy.searchsorted(last_ranks, rank, side="right")])
+
+        for idx, quantile in enumerate(quantiles):
+            k, gamma = _quantile_position(last_ranks[-1], quantile)
+
+            result[idx, iml_idx] = ((1.0 - gamma) * order_statistic(k - 1)
+                                    + gamma * order_statistic(k))
+
+    return result
+
+
 def poes_at(job_id, site, realizations):
-    """Return all the json deserialized hazard curves for
+    """Return all the hazard curves for
     a single site (different realizations).
 
     :param job_id: the id of the job.
@@ -70,28 +216,77 @@ def poes_at(job_id, site, realizations):
     :param realizations: number of realizations.
     :type realizations: integer
     :returns: the hazard curves.
-    :rtype: list of :py:class:`list` of :py:class:`float`
-        containing the probability of exceedence for each realization
+    :rtype: list of :py:class:`numpy.ndarray` containing the probability
+        of exceedence for each realization
     """
     keys = [kvs.tokens.hazard_curve_poes_key(job_id, realization, site)
                 for realization in xrange(realizations)]
     # get the probablity of exceedence for each curve in the site
-    return kvs.mget_decoded(keys)
+    return kvs.mget_arrays(keys)
+
+
+def poes_block_at(job_id, sites, realizations):
+    """Return the hazard curves of all the realizations for a block of sites.
+
+    The curves are read from the KVS with a single round trip.
+
+    :param job_id: the id of the job.
+    :type job_id: integer
+    :param sites: the sites where the curves are computed.
+    :type sites: list of :py:class:`shapes.Site` objects
+    :param realizations: number of realizations.
+    :type realizations: integer
+    :returns: the hazard curves.
+    :rtype: 3-dimensional :py:class:`numpy.ndarray` of shape
+        (sites, realizations, IMLs)
+    """
+    keys = [kvs.tokens.hazard_curve_poes_key(job_id, realization, site)
+                for site in sites for realization in xrange(realizations)]
+    poes = numpy.array(kvs.mget_arrays(keys), dtype=float)
+
+    return poes.reshape((len(sites), realizations, poes.shape[1]))
+
+
+def _site_blocks(sites, block_size=STATISTICS_BLOCK_SIZE):
+    """Split the given sites in blocks of (at most) `block_size` sites."""
+    for start in xrange(0, len(sites), block_size):
+        yield sites[start:start + block_size]
 
 
 def compute_mean_hazard_curves(job_id, sites, realizations):
     """Compute a mean hazard curve for each site in the list
-    using as input all the pre-computed curves for different realizations."""
+    using as input all the pre-computed curves for different realizations.
+
+    The sites are processed in blocks: the curves of a block are loaded
+    at once, averaged in a single vectorized pass and written back in bulk.
+    """
     keys = []
-    for site in sites:
-        poes = poes_at(job_id, site, realizations)
+    for block in _site_blocks(sites):
+        mean_poes = compute_mean_curve_block(
+            poes_block_at(job_id, block, realizations))
+
+        block_keys = [kvs.tokens.mean_hazard_curve_key(job_id, site)
+                      for site in block]
+        keys.extend(block_keys)
+
+        kvs.mset_arrays(dict(izip(block_keys, mean_poes)))
+
+    return keys
+
 
-        mean_poes = compute_mean_curve(poes)
+def _store_quantile_curve_block(job_id, sites, quantiles, quantile_poes):
+    """Store the quantile curves computed for a block of sites with
+    :py:func:`compute_quantile_curve_block` and return their keys."""
+    keys = []
+    values = {}
+    for site_idx, site in enumerate(sites):
+        for quantile_idx, quantile in enumerate(quantiles):
+            key = kvs.tokens.quantile_hazard_curve_key(job_id, site, quantile)
+            keys.append(key)
 
-        key = kvs.tokens.mean_hazard_curve_key(job_id, site)
-        keys.append(key)
+            values[key] = quantile_poes[quantile_idx, site_idx]
 
-        kvs.set_value_json_encoded(key, mean_poes)
+    kvs.mset_arrays(values)
 
     return keys
 
@@ -99,68 +294,265 @@ def compute_mean_hazard_curves(job_id, sites, realizations):
 def compute_quantile_hazard_curves(job_id, sites, realizations, quantiles):
     """Compute a quantile hazard curve for each site in the list
     using as input all the pre-computed curves for different realizations.
+
+    The sites are processed in blocks: all the quantiles of a block are
+    computed in a single vectorized pass and written back in bulk.
     """
 
     LOG.debug("[QUANTILE_HAZARD_CURVES] List of quantiles is %s" % quantiles)
 
     keys = []
-    for site in sites:
-        poes = poes_at(job_id, site, realizations)
+    if not quantiles:
+        return keys
+
+    for block in _site_blocks(sites):
+        quantile_poes = compute_quantile_curve_block(
+            poes_block_at(job_id, block, realizations), quantiles)
 
-        for quantile in quantiles:
-            quantile_poes = compute_quantile_curve(poes, quantile)
+        keys.extend(_store_quantile_curve_block(
+            job_id, block, quantiles, quantile_poes))
+
+    return keys
 
-            key = kvs.tokens.quantile_hazard_curve_key(
-                    job_id, site, quantile)
+
+def accumulate_hazard_curves(job_id, realization, sites, curves,
+                             keep_samples=False):
+    """Fold the hazard curves of a single realization into the running
+    per-site statistics accumulators.
+
+    For each site a running sum of the curves (plus the number of curves
+    summed) is kept, which is all that is needed to compute the mean curve.
+    When `keep_samples` is set, what the quantile curves need is kept too:
+    the PoEs are counted in a sketch of bounded size (see
+    :py:func:`_sketch_bins`), and the curves of the first QUANTILE_SAMPLES
+    realizations are stored in the per-site hash of samples (keyed by
+    realization), deleted when more realizations are folded. The quantiles
+    of a site are exact as long as its samples are all kept, and estimated
+    from the sketch afterwards, so the memory needed does not grow with the
+    number of realizations.
+
+    The folding is atomic and idempotent: the accumulators of the sites
+    are updated in a single transaction, and record the realizations they
+    contain so that a realization folded already (e.g. by a task which was
+    retried, or by a lost one still running) is skipped. The realizations
+    are recorded as the number of the first ones, all folded, plus the
+    few folded out of order, so the accumulators do not grow with the
+    number of realizations.
+
+    :param job_id: the id of the job.
+    :type job_id: integer
+    :param realization: the logic tree realization of the curves.
+    :type realization: integer
+    :param sites: the sites where the curves were computed.
+    :type sites: list of :py:class:`shapes.Site` objects
+    :param curves: the hazard curves (PoEs only), one for each site.
+    :type curves: list of :py:class:`list` of :py:class:`float`
+    :param keep_samples: whether the curves are needed for quantiles
+    :type keep_samples: bool
+    """
+    sum_keys = [kvs.tokens.hazard_curve_sum_key(job_id, site)
+                for site in sites]
+
+    # the number of curves of each site once the realization is folded
+    counts = {}
+
+    def fold(accumulators):
+        """Return the accumulators with the curves added."""
+        sums = {}
+        counts.clear()
+        for key, curve, accumulator in izip(sum_keys, curves, accumulators):
+            if accumulator is None:
+                accumulator = dict(count=0, sum=numpy.zeros(len(curve)),
+                                   folded_below=0, folded_above=[])
+
+                if keep_samples:
+                    accumulator["sketch"] = [{} for _ in curve]
+
+            folded_below = accumulator["folded_below"]
+            folded_above = set(accumulator["folded_above"])
+
+            if realization < folded_below or realization in folded_above:
+                continue
+
+            folded_above.add(realization)
+            while folded_below in folded_above:
+                folded_above.remove(folded_below)
+                folded_below += 1
+
+            sums[key] = dict(count=accumulator["count"] + 1,
+                             sum=numpy.array(accumulator["sum"]) + curve,
+                             folded_below=folded_below,
+                             folded_above=sorted(folded_above))
+            counts[key] = sums[key]["count"]
+
+            if keep_samples:
+                sketch = accumulator["sketch"]
+                for counts_, bin_ in izip(sketch, _sketch_bins(curve)):
+                    counts_[str(bin_)] = counts_.get(str(bin_), 0) + 1
+                sums[key]["sketch"] = sketch
+
+        return sums
+
+    kvs.update_encoded(sum_keys, fold)
+
+    if keep_samples:
+        # the quantiles of the sites with too many realizations will be
+        # estimated from their sketches
+        stale_keys = []
+
+        with kvs.WriteBuffer() as writer:
+            for site, key, curve in izip(sites, sum_keys, curves):
+                samples_key = kvs.tokens.hazard_curve_samples_key(job_id, site)
+
+                if counts.get(key, 0) > QUANTILE_SAMPLES:
+                    stale_keys.append(samples_key)
+                elif key in counts:
+                    writer.hmset(
+                        samples_key, {realization: kvs.encode_array(curve)})
+
+        if stale_keys:
+            kvs.get_client().delete(*stale_keys)
+
+
+def _check_accumulated_realizations(site, count, realizations):
+    """Make sure all the realizations were folded into the accumulators."""
+    if count != realizations:
+        raise ValueError(
+            "%s realizations accumulated at site %s, %s expected"
+            % (count, site, realizations))
+
+
+def finalize_mean_hazard_curves(job_id, sites, realizations):
+    """Compute the mean hazard curve for each site in the list
+    from the running sums accumulated by :py:func:`accumulate_hazard_curves`.
+    """
+    keys = []
+    for block in _site_blocks(sites):
+        sum_keys = [kvs.tokens.hazard_curve_sum_key(job_id, site)
+                    for site in block]
+
+        values = {}
+        for site, accumulator in izip(block, kvs.mget_decoded(sum_keys)):
+            _check_accumulated_realizations(
+                site, accumulator["count"], realizations)
+
+            key = kvs.tokens.mean_hazard_curve_key(job_id, site)
             keys.append(key)
 
-            kvs.set_value_json_encoded(key, quantile_poes)
+            values[key] = numpy.array(accumulator["sum"]) / realizations
+
+        kvs.mset_arrays(values)
 
     return keys
 
 
-def build_interpolator(poes, imls, site=None):
+def finalize_quantile_hazard_curves(job_id, sites, realizations, quantiles):
+    """Compute the quantile hazard curves for each site in the list
+    from the samples (or the sketches, with more than QUANTILE_SAMPLES
+    realizations) collected by :py:func:`accumulate_hazard_curves`.
     """
-    Return a function interpolating the specified points.
+    keys = []
+    if not quantiles:
+        return keys
 
-    :param site: the site to which the points belong (used only for debugging
-                 purposes)
-    :type site: :py:class:`shapes.Site` or None
-    :param poes: the PoEs (abscissae)
-    :type poes: list of :py:class:`float`
-    :param imls: the IMLs (ordinates)
+    client = kvs.get_client()
+
+    for block in _site_blocks(sites):
+        sum_keys = [kvs.tokens.hazard_curve_sum_key(job_id, site)
+                    for site in block]
+
+        site_quantiles = []
+        for site, accumulator in izip(block, kvs.mget_decoded(sum_keys)):
+            _check_accumulated_realizations(
+                site, accumulator["count"], realizations)
+
+            if realizations > QUANTILE_SAMPLES:
+                site_quantiles.append(compute_quantile_curve_sketch(
+                    accumulator["sketch"], quantiles))
+                continue
+
+            samples = [kvs.decode_array(sample) for sample in
+                client.hmget(kvs.tokens.hazard_curve_samples_key(
+                    job_id, site), range(realizations))
+                if sample is not None]
+            _check_accumulated_realizations(
+                site, len(samples), realizations)
+
+            site_quantiles.append(compute_quantile_curve_block(
+                numpy.array([samples], dtype=float), quantiles)[:, 0])
+
+        # (sites, quantiles, IMLs) -> (quantiles, sites, IMLs)
+        quantile_poes = numpy.array(site_quantiles).swapaxes(0, 1)
+
+        keys.extend(_store_quantile_curve_block(
+            job_id, block, quantiles, quantile_poes))
+
+        # the samples are not needed anymore
+        client.delete(*[kvs.tokens.hazard_curve_samples_key(job_id, site)
+                        for site in block])
+
+    return keys
+
+
+def compute_hazard_map_block(curves, imls, poes):
+    """Compute the hazard map values (IMLs) of a block of sites at all the
+    given PoEs at once.
+
+    For each curve the IML is interpolated linearly in the log(IML) space
+    between the two points enclosing the target PoE. PoEs above the highest
+    PoE of a curve yield its minimum IML, PoEs below its lowest PoE yield its
+    maximum IML. A PoE shared by several points of a curve (e.g. the zeros at
+    its tail) yields the lowest IML of those points.
+
+    :param curves: the hazard curves (PoEs only) of the sites
+    :type curves: 2-dimensional :py:class:`numpy.ndarray` of shape
+        (sites, IMLs)
+    :param imls: the IMLs (abscissae of the curves)
     :type imls: list of :py:class:`float`
-    :return: the interpolating function
-    :rtype: a function fn(poe, site=None), that given a PoE will return the IML
+    :param poes: the PoEs to compute the maps for
+    :type poes: list of :py:class:`float`
+    :returns: the interpolated IMLs
+    :rtype: 2-dimensional :py:class:`numpy.ndarray` of shape (sites, PoEs)
     """
     # In our interpolation, PoE becomes the x axis, IML the y axis, therefore
     # the arrays have to be reversed (x axis has to be monotonically
     # increasing).
-    poes = numpy.array(poes)[::-1]
-    imls = numpy.array(imls)[::-1]
-
-    interpolator = interp1d(poes, numpy.log(imls), kind='linear')
+    curves = numpy.asarray(curves, dtype=float)[:, ::-1]
+    imls = numpy.asarray(imls, dtype=float)[::-1]
+    log_imls = numpy.log(imls)
+    poes = numpy.asarray(poes, dtype=float)
+
+    # index of the first point (for each site and PoE) whose PoE is above
+    # the target PoE, i.e. the upper end of the interpolation segment
+    upper = (curves[:, numpy.newaxis, :]
+             <= poes[numpy.newaxis, :, numpy.newaxis]).sum(axis=2)
+    upper = upper.clip(1, len(imls) - 1)
+    lower = upper - 1
+
+    rows = numpy.arange(len(curves))[:, numpy.newaxis]
+    x_lower, x_upper = curves[rows, lower], curves[rows, upper]
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        slope = (log_imls[upper] - log_imls[lower]) / (x_upper - x_lower)
+        # a zero width segment is only left when the target PoE is the
+        # highest PoE of the curve, shared by its last points
+        result = numpy.exp(numpy.where(
+            x_upper == x_lower, log_imls[upper],
+            log_imls[lower] + slope * (poes - x_lower)))
+
+    # limit the values between the minimum and maximum IMLs of the curves
+    above = poes > curves[:, -1:]
+    below = poes < curves[:, :1]
+
+    if above.any() or below.any():
+        LOG.debug("[HAZARD_MAP] Interpolation out of bounds for %s PoE/site "
+                  "pairs, using the IML of the closest curve point"
+                  % (above.sum() + below.sum()))
+
+    result[above] = imls[-1]
+    result[below] = imls[0]
 
-    def safe_interpolator(poe):
-        """
-        Return the interpolated IML, limiting the value between the minimum and
-        maximum IMLs of the original points describing the curve.
-        """
-        if poe > poes[-1]:
-            LOG.debug("[HAZARD_MAP] Interpolation out of bounds for PoE %s, "\
-                "using maximum PoE value pair, PoE: %s, IML: %s, at site %s"
-                % (poe, poes[-1], imls[-1], site))
-            return imls[-1]
-
-        if poe < poes[0]:
-            LOG.debug("[HAZARD_MAP] Interpolation out of bounds for PoE %s, "\
-                "using minimum PoE value pair, PoE: %s, IML: %s, at site %s"
-                % (poe, poes[0], imls[0], site))
-            return imls[0]
-
-        return math.exp(interpolator(poe))
-
-    return safe_interpolator
+    return result
 
 
 def compute_quantile_hazard_maps(job_id, sites, quantiles, imls, poes):
@@ -172,19 +564,27 @@ def compute_quantile_hazard_maps(job_id, sites, quantiles, imls, poes):
     LOG.debug("[QUANTILE_HAZARD_MAPS] List of quantiles is %s" % quantiles)
 
     keys = []
+    if not poes:
+        return keys
+
     for quantile in quantiles:
-        for site in sites:
-            quantile_poes = kvs.get_value_json_decoded(
-                kvs.tokens.quantile_hazard_curve_key(job_id, site, quantile))
+        for block in _site_blocks(sites):
+            quantile_poes = kvs.mget_arrays(
+                [kvs.tokens.quantile_hazard_curve_key(job_id, site, quantile)
+                 for site in block])
 
-            interpolate = build_interpolator(quantile_poes, imls, site)
+            imls_at_poes = compute_hazard_map_block(quantile_poes, imls, poes)
 
-            for poe in poes:
-                key = kvs.tokens.quantile_hazard_map_key(
-                        job_id, site, poe, quantile)
-                keys.append(key)
+            values = {}
+            for site, site_imls in izip(block, imls_at_poes):
+                for poe, iml in izip(poes, site_imls):
+                    key = kvs.tokens.quantile_hazard_map_key(
+                            job_id, site, poe, quantile)
+                    keys.append(key)
 
-                kvs.set_value_json_encoded(key, interpolate(poe))
+                    values[key] = iml
+
+            kvs.mset_arrays(values)
 
     return keys
 
@@ -197,15 +597,54 @@ def compute_mean_hazard_maps(job_id, sites, imls, poes):
     LOG.debug("[MEAN_HAZARD_MAPS] List of POEs is %s" % poes)
 
     keys = []
-    for site in sites:
-        mean_poes = kvs.get_value_json_decoded(
-            kvs.tokens.mean_hazard_curve_key(job_id, site))
-        interpolate = build_interpolator(mean_poes, imls, site)
+    if not poes:
+        return keys
 
-        for poe in poes:
-            key = kvs.tokens.mean_hazard_map_key(job_id, site, poe)
-            keys.append(key)
+    for block in _site_blocks(sites):
+        mean_poes = kvs.mget_arrays(
+            [kvs.tokens.mean_hazard_curve_key(job_id, site) for site in block])
+
+        imls_at_poes = compute_hazard_map_block(mean_poes, imls, poes)
+
+        values = {}
+        for site, site_imls in izip(block, imls_at_poes):
+            for poe, iml in izip(poes, site_imls):
+                key = kvs.tokens.mean_hazard_map_key(job_id, site, poe)
+                keys.append(key)
+
+                values[key] = iml
 
-            kvs.set_value_json_encoded(key, interpolate(poe))
+        kvs.mset_arrays(values)
 
     return keys
+
+
+def balance_site_blocks(sites, costs, number_of_blocks):
+    """Partition the given sites in (at most) `number_of_blocks` blocks of
+    about the same total computation cost.
+
+    The most expensive sites are assigned first, each to the block with the
+    lowest total cost so far. Within each block the sites keep their
+    original (grid) order.
+
+    :param sites: the sites to partition
+    :type sites: list of :py:class:`shapes.Site` objects
+    :param costs: the estimated computation cost of each site
+    :type costs: list of numbers
+    :param number_of_blocks: the number of blocks to build
+    :type number_of_blocks: integer
+    :returns: the non-empty blocks of sites
+    :rtype: list of lists of :py:class:`shapes.Site` objects
+    """
+    number_of_blocks = max(min(number_of_blocks, len(sites)), 1)
+
+    # (total cost, block index) of each block
+    loads = [(0, index) for index in xrange(number_of_blocks)]
+    indices = [[] for _ in xrange(number_of_blocks)]
+
+    for site_index in sorted(xrange(len(sites)), key=lambda i: -costs[i]):
+        load, block = heapq.heappop(loads)
+        indices[block].append(site_index)
+        heapq.heappush(loads, (load + costs[site_index], block))
+
+    return [[sites[i] for i in sorted(block)] for block in indices if block]
@@ -48,23 +48,23 @@ class DeterministicEventBasedMixin(BasePSHAMixin):
             "Random")(int(self.params["GMF_RANDOM_SEED"]))
 
         encoder = json.JSONEncoder()
-        kvs_client = kvs.get_client()
 
         grid = self.region.grid
 
-        for _ in xrange(self._number_of_calculations()):
-            gmf = self.compute_ground_motion_field(random_generator)
+        with kvs.WriteBuffer() as writer:
+            for _ in xrange(self._number_of_calculations()):
+                gmf = self.compute_ground_motion_field(random_generator)
 
-            for gmv in gmf_to_dict(
-                gmf, self.params["INTENSITY_MEASURE_TYPE"]):
+                for gmv in gmf_to_dict(
+                    gmf, self.params["INTENSITY_MEASURE_TYPE"]):
 
-                site = shapes.Site(gmv["site_lon"], gmv["site_lat"])
-                point = grid.point_at(site)
+                    site = shapes.Site(gmv["site_lon"], gmv["site_lat"])
+                    point = grid.point_at(site)
 
-                key = kvs.tokens.ground_motion_values_key(
-                    self.job_id, point)
+                    key = kvs.tokens.ground_motion_values_key(
+                        self.job_id, point)
 
-                kvs_client.rpush(key, encoder.encode(gmv))
+                    writer.rpush(key, encoder.encode(gmv))
 
     def _number_of_calculations(self):
         """Return the number of calculations to trigger.
@@ -20,6 +20,7 @@
 Wrapper around the OpenSHA-lite java library.
 """
 
+import json
 import math
 import os
 import multiprocessing
@@ -37,6 +38,7 @@ from openquake import xml
 from openquake.hazard import classical_psha
 from openquake.hazard import job
 from openquake.hazard import tasks
+from openquake.job import checkpoint
 from openquake.job.mixins import Mixin
 from openquake.output import hazard as hazard_output
 from openquake.utils import config
@@ -57,18 +59,43 @@ IML_SCALING = {'PGA': numpy.log,
 HAZARD_CURVE_FILENAME_PREFIX = 'hazardcurve'
 HAZARD_MAP_FILENAME_PREFIX = 'hazardmap'
 
+# maximum number of sites at which the sources are counted to estimate the
+# cost of the hazard curve calculation (see estimate_site_costs())
+SITE_COST_SAMPLES = 200
+
+# number of logic tree realizations whose source model and GMPE map are
+# stored (and whose tasks may be running) at the same time, unless set with
+# the CONCURRENT_REALIZATIONS parameter
+DEFAULT_CONCURRENT_REALIZATIONS = 2
+
+# the Java ERFs and GMPE maps built by this (worker) process, see
+# BasePSHAMixin.generate_erf(): (job id, token, seed) -> object. At most
+# MAX_CACHED_REALIZATION_OBJECTS are kept, the oldest are dropped first.
+_REALIZATION_OBJECTS = {}
+_REALIZATION_OBJECT_KEYS = []
+MAX_CACHED_REALIZATION_OBJECTS = 4
+
 
 def preload(fn):
-    """A decorator for preload steps that must run on the Jobber node"""
+    """A decorator for preload steps that must run on the Jobber node
+
+    The steps are only run once per job object, a job reused across tasks
+    (see :py:meth:`openquake.job.Job.cached`) keeps what was loaded."""
     def preloader(self, *args, **kwargs):
         """Validate job"""
-        self.cache = java.jclass("KVS")(
-                config.get("kvs", "host"),
-                int(config.get("kvs", "port")))
-        self.calc = java.jclass("LogicTreeProcessor")(
-                self.cache, self.key)
-        java.jvm().java.lang.System.setProperty("openquake.nrml.schema",
-                                                xml.nrml_schema_file())
+        if getattr(self, "calc", None) is None:
+            if kvs.backend() != kvs.REDIS_BACKEND:
+                raise RuntimeError(
+                    "this hazard is computed in Java, which needs the redis "
+                    "KVS backend (%s was configured)" % kvs.backend())
+
+            self.cache = java.jclass("KVS")(
+                    config.get("kvs", "host"),
+                    int(config.get("kvs", "port")))
+            self.calc = java.jclass("LogicTreeProcessor")(
+                    self.cache, self.key)
+            java.jvm().java.lang.System.setProperty(
+                "openquake.nrml.schema", xml.nrml_schema_file())
         return fn(self, *args, **kwargs)
     return preloader
 
@@ -96,44 +123,147 @@ def unwrap_validation_error(jpype, runtime_exception, path=None):
 class BasePSHAMixin(Mixin):
     """Contains common functionality for PSHA Mixins."""
 
-    def store_source_model(self, seed):
+    @property
+    def concurrent_realizations(self):
+        """How many logic tree realizations are calculated at the same time?
+
+        Their source models and GMPE maps are stored under distinct keys
+        (see :py:meth:`store_source_model`), so that the tasks of the next
+        realizations can start before all the tasks of the current one are
+        finished.
+        """
+        value = self.params.get("CONCURRENT_REALIZATIONS")
+        value = value.strip() if value else None
+
+        if value:
+            return max(int(value), 1)
+
+        return DEFAULT_CONCURRENT_REALIZATIONS
+
+    def store_source_model(self, seed, realization=None):
         """Generates an Earthquake Rupture Forecast, using the source zones and
         logic trees specified in the job config file. Note that this has to be
         done currently using the file itself, since it has nested references to
-        other files."""
+        other files.
+
+        The source model is stored under the key of the given logic tree
+        `realization` (see :py:func:`openquake.kvs.tokens.source_model_key`).
+        """
 
         LOG.info("Storing source model from job config")
-        key = kvs.tokens.source_model_key(self.job_id)
+        key = kvs.tokens.source_model_key(self.job_id, realization)
         print "source model key is", key
         jpype = java.jvm()
         try:
             self.calc.sampleAndSaveERFTree(self.cache, key, seed)
+            self._store_seed(kvs.tokens.SOURCE_MODEL_TOKEN, seed, realization)
+            kvs.register_keys([key])
         except jpype.JavaException, ex:
             unwrap_validation_error(
                 jpype, ex,
                 self.params.get("SOURCE_MODEL_LOGIC_TREE_FILE_PATH"))
 
-    def store_gmpe_map(self, seed):
+    def store_gmpe_map(self, seed, realization=None):
         """Generates a hash of tectonic regions and GMPEs, using the logic tree
-        specified in the job config file."""
-        key = kvs.tokens.gmpe_key(self.job_id)
+        specified in the job config file, and stores it under the key of the
+        given logic tree `realization`."""
+        key = kvs.tokens.gmpe_key(self.job_id, realization)
         print "GMPE map key is", key
         jpype = java.jvm()
         try:
             self.calc.sampleAndSaveGMPETree(self.cache, key, seed)
+            self._store_seed(kvs.tokens.GMPE_TOKEN, seed, realization)
+            kvs.register_keys([key])
         except jpype.JavaException, ex:
             unwrap_validation_error(
                 jpype, ex, self.params.get("GMPE_LOGIC_TREE_FILE_PATH"))
 
-    def generate_erf(self):
-        """Generate the Earthquake Rupture Forecast from the currently stored
-        source model logic tree."""
-        key = kvs.tokens.source_model_key(self.job_id)
-        sources = java.jclass("JsonSerializer").getSourceListFromCache(
-                    self.cache, key)
-        erf = java.jclass("GEM1ERF")(sources)
-        self.calc.setGEM1ERFParams(erf)
-        return erf
+    def _store_seed(self, token, seed, realization):
+        """Record the seed the source model (`token` is
+        :py:data:`openquake.kvs.tokens.SOURCE_MODEL_TOKEN`) or the GMPE map
+        (:py:data:`openquake.kvs.tokens.GMPE_TOKEN`) of the given logic tree
+        `realization` was sampled with."""
+        key = kvs.tokens.logic_tree_seeds_key(self.job_id, realization)
+        kvs.get_client().hmset(key, {token: seed})
+        kvs.register_keys([key])
+
+    def _cached_realization_object(self, token, realization, build):
+        """Return the Java object (ERF or GMPE map) for the given logic tree
+        `realization`, calling `build` only if this process has not built
+        it yet.
+
+        The objects are cached by the seed their realization was sampled
+        with (see :py:meth:`_store_seed`), so that the tasks running on a
+        worker for the same realization build them once.
+        """
+        seed, = kvs.get_client().hmget(
+            kvs.tokens.logic_tree_seeds_key(self.job_id, realization),
+            [token])
+
+        if seed is None:
+            return build()
+
+        key = (self.job_id, token, seed)
+
+        if key not in _REALIZATION_OBJECTS:
+            if len(_REALIZATION_OBJECT_KEYS) >= MAX_CACHED_REALIZATION_OBJECTS:
+                del _REALIZATION_OBJECTS[_REALIZATION_OBJECT_KEYS.pop(0)]
+
+            _REALIZATION_OBJECTS[key] = build()
+            _REALIZATION_OBJECT_KEYS.append(key)
+
+        return _REALIZATION_OBJECTS[key]
+
+    def store_site_blocks(self, site_blocks):
+        """Store the coordinates of the given blocks of sites in the KVS,
+        once per job, so that the tasks receive a block ID (see
+        :py:meth:`site_block`) instead of the sites.
+
+        :param site_blocks: the blocks of sites
+        :type site_blocks: list of lists of :py:class:`openquake.shapes.Site`
+        :returns: the number of blocks, their IDs are 0, 1, ...
+        :rtype: int
+        """
+        kvs.mset_encoded(dict(
+            (kvs.tokens.site_block_key(self.job_id, block_id),
+             [(site.longitude, site.latitude) for site in block])
+            for block_id, block in enumerate(site_blocks)))
+
+        return len(site_blocks)
+
+    def site_block(self, block_id):
+        """The sites of a block stored with :py:meth:`store_site_blocks`.
+
+        :rtype: list of :py:class:`openquake.shapes.Site`
+        """
+        return [shapes.Site(lon, lat) for lon, lat in
+                kvs.get_value_json_decoded(
+                    kvs.tokens.site_block_key(self.job_id, block_id))]
+
+    def forget_realization(self, realization):
+        """Remove the source model and GMPE map of the given logic tree
+        `realization` from the KVS, once its tasks are finished."""
+        kvs.get_client().delete(
+            kvs.tokens.source_model_key(self.job_id, realization),
+            kvs.tokens.gmpe_key(self.job_id, realization),
+            kvs.tokens.logic_tree_seeds_key(self.job_id, realization))
+
+    def generate_erf(self, realization=None):
+        """Generate the Earthquake Rupture Forecast from the source model
+        stored for the given logic tree `realization` (or reuse the one
+        already generated by this process)."""
+
+        def build():
+            """Deserialize the source model and build the ERF."""
+            key = kvs.tokens.source_model_key(self.job_id, realization)
+            sources = java.jclass("JsonSerializer").getSourceListFromCache(
+                        self.cache, key)
+            erf = java.jclass("GEM1ERF")(sources)
+            self.calc.setGEM1ERFParams(erf)
+            return erf
+
+        return self._cached_realization_object(
+            kvs.tokens.SOURCE_MODEL_TOKEN, realization, build)
 
     def set_gmpe_params(self, gmpe_map):
         """Push parameters from configuration file into the GMPE objects"""
@@ -152,13 +282,21 @@ class BasePSHAMixin(Mixin):
                 jpype.JObject(gmpe, java.jclass("AttenuationRelationship")))
             gmpe_map.put(tect_region, gmpe)
 
-    def generate_gmpe_map(self):
-        """Generate the GMPE map from the stored GMPE logic tree."""
-        key = kvs.tokens.gmpe_key(self.job_id)
-        gmpe_map = java.jclass(
-            "JsonSerializer").getGmpeMapFromCache(self.cache, key)
-        self.set_gmpe_params(gmpe_map)
-        return gmpe_map
+    def generate_gmpe_map(self, realization=None):
+        """Generate the GMPE map stored for the given logic tree
+        `realization` (or reuse the one already generated by this
+        process)."""
+
+        def build():
+            """Deserialize the GMPE map and set its parameters."""
+            key = kvs.tokens.gmpe_key(self.job_id, realization)
+            gmpe_map = java.jclass(
+                "JsonSerializer").getGmpeMapFromCache(self.cache, key)
+            self.set_gmpe_params(gmpe_map)
+            return gmpe_map
+
+        return self._cached_realization_object(
+            kvs.tokens.GMPE_TOKEN, realization, build)
 
     def get_iml_list(self):
         """Build the appropriate Arbitrary Discretized Func from the IMLs,
@@ -207,10 +345,84 @@ class ClassicalMixin(BasePSHAMixin):
     params loaded from the Job configuration file."""
 
     def number_of_tasks(self):
-        """How many `celery` tasks should be used for the calculations?"""
+        """How many `celery` tasks should be used for the calculations?
+
+        Unless set with the `HAZARD_TASKS` parameter, this is twice the
+        number of processes of the running `celery` workers (or twice the
+        number of CPUs/cores when no worker replies).
+        """
         value = self.params.get("HAZARD_TASKS")
         value = value.strip() if value else None
-        return 2 * multiprocessing.cpu_count() if value is None else int(value)
+
+        if value is not None:
+            return int(value)
+
+        if getattr(self, "_worker_pool_size", None) is None:
+            # pylint: disable=W0201
+            self._worker_pool_size = (utils_tasks.worker_pool_size()
+                                      or multiprocessing.cpu_count())
+
+        return 2 * self._worker_pool_size
+
+    @property
+    def cost_based_partitioning(self):
+        """Are the sites to be partitioned in blocks of (about) the same
+        estimated cost (instead of the same number of sites) for the hazard
+        curve calculation?"""
+        return self.params.get(
+            "HAZARD_SITE_PARTITIONING", "grid").strip().lower() == "cost"
+
+    @java.jexception
+    def estimate_site_costs(self, sites):
+        """Estimate the relative cost of the hazard curve calculation at each
+        of the given sites.
+
+        The cost of a site is proportional to the number of IMLs and to the
+        number of sources within `MAXIMUM_DISTANCE` (plus one). The sources
+        are only counted at (at most) `SITE_COST_SAMPLES` sites, evenly
+        picked in the given list; the other sites take the count of the
+        closest of them. The source model of the first logic tree
+        realization is used, it must be stored already.
+
+        :param sites: the sites
+        :type sites: list of :py:class:`openquake.shapes.Site`
+        :returns: the estimated cost of each site
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        erf = self.generate_erf(0)
+        sources = [erf.getSource(i) for i in xrange(erf.getNumSources())]
+        max_distance = float(self.params['MAXIMUM_DISTANCE'])
+
+        samples = sites[::int(math.ceil(
+            len(sites) / float(SITE_COST_SAMPLES))) or 1]
+        counts = numpy.array([
+            sum(1 for source in sources
+                if source.getMinDistance(jsite) <= max_distance)
+            for jsite in (site.to_java() for site in samples)])
+
+        coords = numpy.array([(s.longitude, s.latitude) for s in sites])
+        sample_coords = numpy.array(
+            [(s.longitude, s.latitude) for s in samples])
+
+        nearest = numpy.array([
+            ((sample_coords - coord) ** 2).sum(axis=1).argmin()
+            for coord in coords])
+
+        return (1 + counts[nearest]) * len(self.imls)
+
+    @property
+    def incremental_statistics(self):
+        """Are the mean/quantile curves to be accumulated while the
+        realizations are computed (instead of after all of them)?
+
+        The memory needed then does not grow with the number of
+        realizations: the quantile curves are estimated from bounded
+        sketches when there are more than
+        :py:data:`classical_psha.QUANTILE_SAMPLES` realizations (see
+        :py:func:`classical_psha.accumulate_hazard_curves`).
+        """
+        return self.params.get(
+            "INCREMENTAL_STATISTICS", "false").strip().lower() == "true"
 
     def do_curves(self, sites, realizations,
                   serializer=None,
@@ -231,11 +443,27 @@ class ClassicalMixin(BasePSHAMixin):
         :param the_task: The `celery` task to use for the hazard curve
             calculation, it takes the following parameters:
                 * job ID
-                * the sites for which to calculate the hazard curves
+                * the ID of the block of sites for which to calculate the
+                  hazard curves (see :py:meth:`site_block`)
                 * the logic tree realization number
         :type the_task: a callable taking three parameters
         :returns: KVS keys of the calculated hazard curves.
         :rtype: list of string
+
+        The realizations are pipelined: the sites are split in blocks (see
+        :py:meth:`site_blocks`) and the (realization, block) tasks are
+        submitted as a single stream, at most :py:meth:`number_of_tasks` at
+        a time. A block is calculated for a realization as soon as it is
+        done for the previous one, and the source models and GMPE maps of
+        up to :py:attr:`concurrent_realizations` realizations are stored in
+        advance, so the workers move on to the next realization instead of
+        waiting for the slowest block of the current one. The realizations
+        are serialized in order, as soon as all their blocks are done.
+
+        The completed (realization, block) units and the serialized
+        realizations are recorded in a checkpoint: when the job is resumed
+        (see :py:func:`openquake.job.run_job`) they are skipped, and only
+        the missing units are calculated (with the same site blocks).
         """
         source_model_generator = random.Random()
         source_model_generator.seed(
@@ -244,19 +472,149 @@ class ClassicalMixin(BasePSHAMixin):
         gmpe_generator = random.Random()
         gmpe_generator.seed(self.params.get("GMPE_LT_RANDOM_SEED", None))
 
-        for realization in xrange(0, realizations):
+        if realizations < 1:
+            return
+
+        # The seeds are drawn for all the realizations up front, so that
+        # they do not depend on the realizations skipped when resuming.
+        seeds = [(source_model_generator.getrandbits(32),
+                  source_model_generator.getrandbits(32))
+                 for _ in xrange(realizations)]
+        stored_realizations = set()
+
+        def store_realization(realization):
+            """Store the source model and GMPE map of `realization`."""
+            if realization in stored_realizations:
+                return
+
             LOG.info("Calculating hazard curves for realization %s"
                      % realization)
-            self.store_source_model(source_model_generator.getrandbits(32))
-            self.store_gmpe_map(source_model_generator.getrandbits(32))
+            source_model_seed, gmpe_seed = seeds[realization]
+            self.store_source_model(source_model_seed, realization)
+            self.store_gmpe_map(gmpe_seed, realization)
+            stored_realizations.add(realization)
+
+        the_checkpoint = checkpoint.Checkpoint(self.job_id, "hazard_curves")
+        number_of_blocks = None
+
+        if self.resumed:
+            # the site blocks stored by the failed run are reused
+            number_of_blocks = the_checkpoint.load("site_blocks")
+
+        if number_of_blocks is None:
+            # Nothing was completed yet.
+            the_checkpoint.clear()
+            store_realization(0)
+            number_of_blocks = self.store_site_blocks(self.site_blocks(sites))
+            the_checkpoint.save("site_blocks", number_of_blocks)
+        else:
+            LOG.info("Resuming the hazard curve calculation")
+
+        max_running = max(self.number_of_tasks(), 1)
+
+        # the next realization to calculate for each block
+        next_realization = [0] * number_of_blocks
+        # the blocks still to calculate and the curve keys of each realization
+        blocks_left = {}
+        curve_keys = {}
+        # ((realization, block index), result) of the running tasks
+        running = []
+        prepared = finished = 0
+
+        while finished < realizations:
+            while prepared < min(realizations,
+                                 finished + self.concurrent_realizations):
+                if the_checkpoint.done(prepared):
+                    blocks_left[prepared] = set()
+                else:
+                    blocks_left[prepared] = set(
+                        block for block in xrange(number_of_blocks)
+                        if not the_checkpoint.done(prepared, block))
+
+                if blocks_left[prepared]:
+                    store_realization(prepared)
+
+                curve_keys[prepared] = []
+                prepared += 1
+
+            busy = set(block for (_, block), _ in running)
+
+            for block in xrange(number_of_blocks):
+                # skip the realizations completed for this block already
+                while (next_realization[block] < prepared and block not in
+                       blocks_left.get(next_realization[block], ())):
+                    next_realization[block] += 1
+
+            idle = sorted((next_realization[block], block)
+                          for block in xrange(number_of_blocks)
+                          if block not in busy)
+
+            for realization, block in idle:
+                if len(running) >= max_running or realization >= prepared:
+                    break
+
+                running.append(((realization, block), utils_tasks.submit(
+                    the_task, dict(job_id=self.job_id, block_id=block,
+                                   realization=realization))))
+
+            if running:
+                for (realization, block), keys in utils_tasks.wait_for_any(
+                        running):
+                    the_checkpoint.mark_done(realization, block)
+                    next_realization[block] += 1
+                    blocks_left[realization].discard(block)
+                    curve_keys[realization].extend(keys or [])
+
+            # The blocks of a realization can only finish after those of the
+            # previous one, so the realizations finish in order.
+            while finished < prepared and not blocks_left[finished]:
+                if not the_checkpoint.done(finished):
+                    if serializer:
+                        serializer(sites, finished)
+
+                    if self.incremental_statistics and curve_keys[finished]:
+                        # The curves of this realization were folded into
+                        # the statistics accumulators already and are not
+                        # needed anymore.
+                        kvs.delete_arrays(curve_keys[finished])
+
+                    the_checkpoint.mark_done(finished)
+
+                if finished in stored_realizations:
+                    self.forget_realization(finished)
+
+                del blocks_left[finished], curve_keys[finished]
+                finished += 1
+
+    def site_blocks(self, sites):
+        """Split the sites in the blocks calculated by the hazard curve
+        tasks.
+
+        With cost based partitioning (see
+        :py:attr:`cost_based_partitioning`) there are
+        :py:meth:`number_of_tasks` blocks of about the same estimated cost,
+        otherwise the blocks have the same number of sites. With adaptive
+        scheduling (see :py:func:`openquake.utils.tasks.scheduling`) the
+        blocks are `INITIAL_CHUNKS_PER_TASK` times smaller, so that the
+        faster workers take over more of them.
+
+        :param sites: the sites
+        :type sites: list of :py:class:`openquake.shapes.Site`
+        :returns: the blocks of sites (at least one, possibly empty)
+        :rtype: list of lists of :py:class:`openquake.shapes.Site`
+        """
+        if self.cost_based_partitioning and sites:
+            LOG.info("Partitioning %s sites by estimated cost" % len(sites))
+            return classical_psha.balance_site_blocks(
+                sites, self.estimate_site_costs(sites),
+                self.number_of_tasks())
 
-            utils_tasks.distribute(
-                self.number_of_tasks(), the_task, ("site_list", sites),
-                dict(job_id=self.job_id, realization=realization),
-                flatten_results=True)
+        cardinality = max(self.number_of_tasks(), 1)
 
-            if serializer:
-                serializer(sites, realization)
+        if utils_tasks.scheduling() == utils_tasks.ADAPTIVE_SCHEDULING:
+            cardinality *= utils_tasks.INITIAL_CHUNKS_PER_TASK
+
+        return utils_tasks.portions(sites, cardinality)
 
     def param_set(self, name):
         """Is the parameter with the given `name` set and non-empty?
@@ -298,8 +656,14 @@ class ClassicalMixin(BasePSHAMixin):
                 * job ID
                 * the sites for which to calculate the hazard curves
         :type curve_task: function(string, [:py:class:`openquake.shapes.Site`])
-        :param map_func: A function that computes mean hazard maps.
-        :type map_func: function(:py:class:`openquake.job.Job`)
+        :param map_func: The `celery` task to use for the mean hazard map
+            calculation, it takes the following parameters:
+                * job ID
+                * the sites for which to calculate the hazard maps
+                * the IMLs
+                * the PoEs
+        :type map_func: function(string, [:py:class:`openquake.shapes.Site`],
+            [float], [float])
         :returns: `None`
         """
         if not self.param_set("COMPUTE_MEAN_HAZARD_CURVE"):
@@ -323,7 +687,11 @@ class ClassicalMixin(BasePSHAMixin):
             assert map_serializer, "No serializer for the mean hazard maps set"
 
             LOG.info("Computing/serializing mean hazard maps")
-            map_func(self.job_id, sites, self.imls, self.poes_hazard_maps)
+            utils_tasks.distribute(
+                self.number_of_tasks(), map_func, ("sites", sites),
+                dict(job_id=self.job_id, imls=self.imls,
+                     poes=self.poes_hazard_maps),
+                flatten_results=True)
             map_serializer(sites, self.poes_hazard_maps)
 
     # pylint: disable=R0913
@@ -356,8 +724,15 @@ class ClassicalMixin(BasePSHAMixin):
                 * job ID
                 * the sites for which to calculate the hazard curves
         :type curve_task: function(string, [:py:class:`openquake.shapes.Site`])
-        :param map_func: A function that computes quantile hazard maps.
-        :type map_func: function(:py:class:`openquake.job.Job`)
+        :param map_func: The `celery` task to use for the quantile hazard map
+            calculation, it takes the following parameters:
+                * job ID
+                * the sites for which to calculate the hazard maps
+                * the quantiles
+                * the IMLs
+                * the PoEs
+        :type map_func: function(string, [:py:class:`openquake.shapes.Site`],
+            [float], [float], [float])
         :returns: `None`
         """
         if not quantiles:
@@ -384,8 +759,11 @@ class ClassicalMixin(BasePSHAMixin):
 
             # quantile maps
             LOG.info("Computing quantile hazard maps")
-            map_func(self.job_id, sites, quantiles, self.imls,
-                     self.poes_hazard_maps)
+            utils_tasks.distribute(
+                self.number_of_tasks(), map_func, ("sites", sites),
+                dict(job_id=self.job_id, quantiles=quantiles,
+                     imls=self.imls, poes=self.poes_hazard_maps),
+                flatten_results=True)
 
             LOG.info("Serializing quantile maps for %s values"
                      % len(quantiles))
@@ -408,16 +786,25 @@ class ClassicalMixin(BasePSHAMixin):
         self.do_curves(sites, realizations,
             serializer=self.serialize_hazard_curve_of_realization)
 
+        if self.incremental_statistics:
+            mean_task = tasks.finalize_mean_curves
+            quantile_task = tasks.finalize_quantile_curves
+        else:
+            mean_task = tasks.compute_mean_curves
+            quantile_task = tasks.compute_quantile_curves
+
         # mean curves
         self.do_means(sites, realizations,
             curve_serializer=self.serialize_mean_hazard_curves,
-            map_func=classical_psha.compute_mean_hazard_maps,
+            curve_task=mean_task,
+            map_func=tasks.compute_mean_maps,
             map_serializer=self.serialize_mean_hazard_map)
 
         # quantile curves
         self.do_quantiles(sites, realizations, self.quantile_levels,
             curve_serializer=self.serialize_quantile_hazard_curves,
-            map_func=classical_psha.compute_quantile_hazard_maps,
+            curve_task=quantile_task,
+            map_func=tasks.compute_quantile_maps,
             map_serializer=self.serialize_quantile_hazard_map)
 
     def serialize_hazard_curve_of_realization(self, sites, realization):
@@ -431,9 +818,9 @@ class ClassicalMixin(BasePSHAMixin):
         """
         hc_attrib_update = {'endBranchLabel': realization}
         nrml_file = self.hazard_curve_filename(realization)
-        key_template = kvs.tokens.hazard_curve_poes_key_template(self.job_id,
-                                                        realization)
-        self.serialize_hazard_curve(nrml_file, key_template,
+        key_func = lambda site: kvs.tokens.hazard_curve_poes_key(
+            self.job_id, realization, site)
+        self.serialize_hazard_curve(nrml_file, key_func,
                                     hc_attrib_update, sites)
 
     def serialize_mean_hazard_curves(self, sites):
@@ -445,8 +832,9 @@ class ClassicalMixin(BasePSHAMixin):
         """
         hc_attrib_update = {'statistics': 'mean'}
         nrml_file = self.mean_hazard_curve_filename()
-        key_template = kvs.tokens.mean_hazard_curve_key_template(self.job_id)
-        self.serialize_hazard_curve(nrml_file, key_template, hc_attrib_update,
+        key_func = lambda site: kvs.tokens.mean_hazard_curve_key(
+            self.job_id, site)
+        self.serialize_hazard_curve(nrml_file, key_func, hc_attrib_update,
                                     sites)
 
     def serialize_quantile_hazard_curves(self, sites, quantile):
@@ -463,14 +851,13 @@ class ClassicalMixin(BasePSHAMixin):
             'statistics': 'quantile',
             'quantileValue': quantile}
         nrml_file = self.quantile_hazard_curve_filename(quantile)
-        key_template =\
-            kvs.tokens.quantile_hazard_curve_key_template(self.job_id,
-                                                          str(quantile))
+        key_func = lambda site: kvs.tokens.quantile_hazard_curve_key(
+            self.job_id, site, quantile)
 
-        self.serialize_hazard_curve(nrml_file, key_template, hc_attrib_update,
+        self.serialize_hazard_curve(nrml_file, key_func, hc_attrib_update,
                                     sites)
 
-    def serialize_hazard_curve(self, nrml_file, key_template, hc_attrib_update,
+    def serialize_hazard_curve(self, nrml_file, key_func, hc_attrib_update,
                                sites):
         """
         Serialize the hazard curves of a set of sites.
@@ -480,9 +867,9 @@ class ClassicalMixin(BasePSHAMixin):
 
         :param nrml_file: the output filename
         :type nrml_file: :py:class:`string`
-        :param key_template: a template for constructing the key to get, for
-                             each site, its curve from the KVS
-        :type key_template: :py:class:`string`
+        :param key_func: a function returning, for each site, the key used
+                         to get its curve from the KVS
+        :type key_func: callable
         :param hc_attrib_update: a dictionary containing metadata for the set
                                  of curves that will be serialized
         :type hc_attrib_update: :py:class:`dict`
@@ -495,7 +882,10 @@ class ClassicalMixin(BasePSHAMixin):
             self.job_id, self.serialize_results_to, nrml_path)
         hc_data = []
 
-        for site in sites:
+        # all the curves are fetched with a single round trip
+        curves = kvs.mget_arrays([key_func(site) for site in sites])
+
+        for site, curve in zip(sites, curves):
             # Use hazard curve ordinate values (PoE) from KVS and abscissae
             # from the IML list in config.
             hc_attrib = {
@@ -503,8 +893,7 @@ class ClassicalMixin(BasePSHAMixin):
                 'IMLValues': self.imls,
                 'IMT': self['INTENSITY_MEASURE_TYPE'],
 
-                'PoEValues': kvs.get_value_json_decoded(key_template
-                                                        % hash(site))}
+                'PoEValues': curve.tolist()}
 
             hc_attrib.update(hc_attrib_update)
             hc_data.append((site, hc_attrib))
@@ -527,10 +916,10 @@ class ClassicalMixin(BasePSHAMixin):
             nrml_file = self.mean_hazard_map_filename(poe)
 
             hm_attrib_update = {'statistics': 'mean'}
-            key_template = kvs.tokens.mean_hazard_map_key_template(self.job_id,
-                                                          poe)
+            key_func = lambda site: kvs.tokens.mean_hazard_map_key(
+                self.job_id, site, poe)
 
-            self.serialize_hazard_map_at_poe(sites, poe, key_template,
+            self.serialize_hazard_map_at_poe(sites, poe, key_func,
                                              hm_attrib_update, nrml_file)
 
     def serialize_quantile_hazard_map(self, sites, poes, quantile):
@@ -548,16 +937,16 @@ class ClassicalMixin(BasePSHAMixin):
         for poe in poes:
             nrml_file = self.quantile_hazard_map_filename(quantile, poe)
 
-            key_template = kvs.tokens.quantile_hazard_map_key_template(
-                                             self.job_id, poe, quantile)
+            key_func = lambda site: kvs.tokens.quantile_hazard_map_key(
+                self.job_id, site, poe, quantile)
 
             hm_attrib_update = {'statistics': 'quantile',
                                 'quantileValue': quantile}
 
-            self.serialize_hazard_map_at_poe(sites, poe, key_template,
+            self.serialize_hazard_map_at_poe(sites, poe, key_func,
                                              hm_attrib_update, nrml_file)
 
-    def serialize_hazard_map_at_poe(self, sites, poe, key_template,
+    def serialize_hazard_map_at_poe(self, sites, poe, key_func,
                                     hm_attrib_update, nrml_file):
         """
         Serialize the hazard map for a set of sites at a given PoE.
@@ -569,9 +958,9 @@ class ClassicalMixin(BasePSHAMixin):
         :type sites: list of :py:class:`openquake.shapes.Site`
         :param poe: the PoE at which the map will be serialized
         :type poe: :py:class:`float`
-        :param key_template: a template for constructing the key used to get,
-                             for each site, its map from the KVS
-        :type key_template: :py:class:`string`
+        :param key_func: a function returning, for each site, the key used
+                         to get its map value from the KVS
+        :type key_func: callable
         :param hc_attrib_update: a dictionary containing metadata for the set
                                  of maps that will be serialized
         :type hc_attrib_update: :py:class:`dict`
@@ -588,13 +977,15 @@ class ClassicalMixin(BasePSHAMixin):
             self.job_id, self.serialize_results_to, nrml_path)
         hm_data = []
 
-        for site in sites:
+        imls = kvs.mget_arrays([key_func(site) for site in sites])
+
+        for site, iml in zip(sites, imls):
             # use hazard map IML values from KVS
             hm_attrib = {
                 'investigationTimeSpan': self.params['INVESTIGATION_TIME'],
                 'IMT': self.params['INTENSITY_MEASURE_TYPE'],
                 'vs30': self.params['REFERENCE_VS30_VALUE'],
-                'IML': kvs.get_value_json_decoded(key_template % hash(site)),
+                'IML': iml.item(),
                 'poE': poe}
 
             hm_attrib.update(hm_attrib_update)
@@ -606,15 +997,16 @@ class ClassicalMixin(BasePSHAMixin):
 
     @preload
     def compute_hazard_curve(self, sites, realization):
-        """ Compute hazard curves, write them to KVS as JSON,
-        and return a list of the KVS keys for each curve. """
+        """ Compute hazard curves, write them to KVS (see
+        :py:func:`openquake.kvs.encode_array`), and return a list of the KVS
+        keys for each curve. """
         jpype = java.jvm()
         try:
             calc = java.jclass("HazardCalculator")
             poes_list = calc.getHazardCurvesAsJson(
                 self.parameterize_sites(sites),
-                self.generate_erf(),
-                self.generate_gmpe_map(),
+                self.generate_erf(realization),
+                self.generate_gmpe_map(realization),
                 self.get_iml_list(),
                 float(self.params['MAXIMUM_DISTANCE']))
         except jpype.JavaException, ex:
@@ -622,14 +1014,22 @@ class ClassicalMixin(BasePSHAMixin):
 
         # write the poes to the KVS and return a list of the keys
 
+        curves = [json.loads(poes) for poes in poes_list]
+
         curve_keys = []
-        for site, poes in izip(sites, poes_list):
-            curve_key = kvs.tokens.hazard_curve_poes_key(
-                self.job_id, realization, site)
+        with kvs.WriteBuffer() as writer:
+            for site, poes in izip(sites, curves):
+                curve_key = kvs.tokens.hazard_curve_poes_key(
+                    self.job_id, realization, site)
+
+                writer.set_array(curve_key, poes)
 
-            kvs.set(curve_key, poes)
+                curve_keys.append(curve_key)
 
-            curve_keys.append(curve_key)
+        if self.incremental_statistics:
+            classical_psha.accumulate_hazard_curves(
+                self.job_id, realization, sites, curves,
+                keep_samples=bool(self.quantile_levels))
 
         return curve_keys
 
@@ -714,7 +1114,19 @@ class EventBasedMixin(BasePSHAMixin):
         """Main hazard processing block.
 
         Loops through various random realizations, spawning tasks to compute
-        GMFs."""
+        GMFs.
+
+        The (history, realization) tasks are submitted as a single stream:
+        the source models and GMPE maps of the next logic tree samples are
+        stored (under distinct keys) while the previous tasks are running,
+        and each stochastic event set is serialized as soon as its task is
+        finished. The number of running tasks is bounded by
+        :py:attr:`concurrent_realizations` or by the number of realizations
+        of a history, whichever is larger.
+
+        The serialized stochastic event sets are recorded in a checkpoint:
+        when the job is resumed (see :py:func:`openquake.job.run_job`) they
+        are not calculated again."""
         source_model_generator = random.Random()
         source_model_generator.seed(
                 self.params.get('SOURCE_MODEL_LT_RANDOM_SEED', None))
@@ -731,28 +1143,62 @@ class EventBasedMixin(BasePSHAMixin):
             "Going to run hazard for %s histories of %s realizations each."
             % (histories, realizations))
 
-        for i in range(0, histories):
-            pending_tasks = []
-            for j in range(0, realizations):
-                self.store_source_model(source_model_generator.getrandbits(32))
-                self.store_gmpe_map(gmpe_generator.getrandbits(32))
-                pending_tasks.append(
-                    tasks.compute_ground_motion_fields.delay(
-                        self.job_id, self.sites_for_region(),
-                        i, j, gmf_generator.getrandbits(32)))
-
-            for task in pending_tasks:
-                task.wait()
-                if task.status != 'SUCCESS':
-                    raise Exception(task.result)
+        max_running = max(self.concurrent_realizations, realizations)
+        # all the tasks calculate the whole region, stored once as block 0
+        self.store_site_blocks([self.sites_for_region()])
+        pending_tasks = []
 
+        the_checkpoint = checkpoint.Checkpoint(self.job_id, "gmfs")
+        if not self.resumed:
+            the_checkpoint.clear()
+
+        for i in range(0, histories):
             for j in range(0, realizations):
-                stochastic_set_key = kvs.tokens.stochastic_set_key(self.job_id,
-                                                                   i, j)
-                print "Writing output for ses %s" % stochastic_set_key
-                ses = kvs.get_value_json_decoded(stochastic_set_key)
-                if ses:
-                    self.serialize_gmf(ses)
+                # the seeds are drawn even for the stochastic sets which are
+                # skipped, so that the others get the same seeds
+                source_model_seed = source_model_generator.getrandbits(32)
+                gmpe_seed = gmpe_generator.getrandbits(32)
+                gmf_seed = gmf_generator.getrandbits(32)
+
+                if the_checkpoint.done(i, j):
+                    continue
+
+                sample = self.logic_tree_sample(i, j)
+                self.store_source_model(source_model_seed, sample)
+                self.store_gmpe_map(gmpe_seed, sample)
+                pending_tasks.append(((i, j), utils_tasks.submit(
+                    tasks.compute_ground_motion_fields,
+                    dict(job_id=self.job_id, block_id=0, history=i,
+                         realization=j, seed=gmf_seed))))
+
+                while len(pending_tasks) >= max_running:
+                    self._serialize_finished_gmfs(
+                        pending_tasks, the_checkpoint)
+
+        while pending_tasks:
+            self._serialize_finished_gmfs(pending_tasks, the_checkpoint)
+
+    def logic_tree_sample(self, history, realization):
+        """The number of the logic tree sample (i.e. the realization key of
+        the source model and GMPE map) of the given stochastic set."""
+        return history * int(
+            self.params['NUMBER_OF_LOGIC_TREE_SAMPLES']) + realization
+
+    def _serialize_finished_gmfs(self, pending_tasks, the_checkpoint):
+        """Wait for (at least) one of the pending GMF tasks to finish,
+        serialize the stochastic event sets of the finished ones and record
+        them in the checkpoint."""
+        for (i, j), _ in utils_tasks.wait_for_any(pending_tasks):
+            self.forget_realization(self.logic_tree_sample(i, j))
+
+            stochastic_set_key = kvs.tokens.stochastic_set_key(self.job_id,
+                                                               i, j)
+            print "Writing output for ses %s" % stochastic_set_key
+            ses = kvs.get_value_json_decoded(stochastic_set_key)
+            if ses:
+                self.serialize_gmf(ses)
+
+            the_checkpoint.mark_done(i, j)
 
     def serialize_gmf(self, ses):
         """
@@ -796,12 +1242,14 @@ class EventBasedMixin(BasePSHAMixin):
         gmc = self.params['GROUND_MOTION_CORRELATION']
         correlate = (gmc == "true" and True or False)
         stochastic_set_id = "%s!%s" % (history, realization)
+        sample = self.logic_tree_sample(history, realization)
         java.jclass("HazardCalculator").generateAndSaveGMFs(
                 self.cache, key, stochastic_set_id, jsite_list,
-                self.generate_erf(),
-                self.generate_gmpe_map(),
+                self.generate_erf(sample),
+                self.generate_gmpe_map(sample),
                 java.jclass("Random")(seed),
                 jpype.JBoolean(correlate))
+        kvs.register_keys([key])
 
 
 job.HazJobMixin.register("Event Based", EventBasedMixin, order=0)
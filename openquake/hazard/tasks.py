@@ -23,6 +23,8 @@ The following tasks are defined in the hazard engine:
     * generate_erf
     * compute_hazard_curve
     * compute_mgm_intensity
+    * compute_mean_curves/compute_quantile_curves
+    * compute_mean_maps/compute_quantile_maps
 """
 
 import json
@@ -54,30 +56,31 @@ def generate_erf(job_id):
     # TODO(JM): implement real ERF computation
 
     check_job_status(job_id)
-    kvs.get_client().set(kvs.tokens.erf_key(job_id),
-                         json.JSONEncoder().encode([job_id]))
+    kvs.set(kvs.tokens.erf_key(job_id), json.JSONEncoder().encode([job_id]))
 
     return job_id
 
 
 @task
-def compute_ground_motion_fields(job_id, site_list, history, realization,
+def compute_ground_motion_fields(job_id, block_id, history, realization,
                                  seed):
-    """ Generate ground motion fields """
-    # TODO(JMC): Use a block_id instead of a site_list
+    """ Generate ground motion fields for the sites of the given block (see
+    :py:meth:`openquake.hazard.opensha.BasePSHAMixin.store_site_blocks`) """
     check_job_status(job_id)
-    hazengine = job.Job.from_kvs(job_id)
+    hazengine = job.Job.cached(job_id)
     with mixins.Mixin(hazengine, hazjob.HazJobMixin):
-        hazengine.compute_ground_motion_fields(site_list, history, realization,
-                                               seed)
+        hazengine.compute_ground_motion_fields(
+            hazengine.site_block(block_id), history, realization, seed)
 
 
 @task
-def compute_hazard_curve(job_id, site_list, realization, callback=None):
-    """ Generate hazard curve for a given site list. """
+def compute_hazard_curve(job_id, block_id, realization, callback=None):
+    """ Generate hazard curves for the sites of the given block (see
+    :py:meth:`openquake.hazard.opensha.BasePSHAMixin.store_site_blocks`) """
     check_job_status(job_id)
-    hazengine = job.Job.from_kvs(job_id)
+    hazengine = job.Job.cached(job_id)
     with mixins.Mixin(hazengine, hazjob.HazJobMixin):
+        site_list = hazengine.site_block(block_id)
         keys = hazengine.compute_hazard_curve(site_list, realization)
 
         if callback:
@@ -132,3 +135,52 @@ def compute_quantile_curves(job_id, sites, realizations, quantiles):
 
     return classical_psha.compute_quantile_hazard_curves(job_id, sites,
         realizations, quantiles)
+
+
+@task
+def compute_mean_maps(job_id, sites, imls, poes):
+    """Compute the mean hazard map values for each site given."""
+
+    check_job_status(job_id)
+    HAZARD_LOG.info("Computing MEAN maps for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    return classical_psha.compute_mean_hazard_maps(job_id, sites, imls, poes)
+
+
+@task
+def compute_quantile_maps(job_id, sites, quantiles, imls, poes):
+    """Compute the quantile hazard map values for each site given."""
+
+    check_job_status(job_id)
+    HAZARD_LOG.info("Computing QUANTILE maps for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    return classical_psha.compute_quantile_hazard_maps(job_id, sites,
+        quantiles, imls, poes)
+
+
+@task
+def finalize_mean_curves(job_id, sites, realizations):
+    """Compute the mean hazard curve for each site given from the
+    statistics accumulated while the realizations were computed."""
+
+    check_job_status(job_id)
+    HAZARD_LOG.info("Finalizing MEAN curves for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    return classical_psha.finalize_mean_hazard_curves(job_id, sites,
+        realizations)
+
+
+@task
+def finalize_quantile_curves(job_id, sites, realizations, quantiles):
+    """Compute the quantile hazard curve for each site given from the
+    statistics accumulated while the realizations were computed."""
+
+    check_job_status(job_id)
+    HAZARD_LOG.info("Finalizing QUANTILE curves for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    return classical_psha.finalize_quantile_hazard_curves(job_id, sites,
+        realizations, quantiles)
@@ -21,18 +21,23 @@ Includes classpath arguments, and heap size."""
 from amqplib import client_0_8 as amqp
 import jpype
 import os
+import socket
 import sys
+import time
 import traceback
 
 from celery.decorators import task as celery_task
+from celery.signals import worker_process_init
 
 from functools import wraps
 
 from openquake import flags
+from openquake import kvs
 from openquake import logs
 from openquake.utils import config
 
 FLAGS = flags.FLAGS
+LOG = logs.LOG
 
 # Settings this flag to true pipes Java stderr and stdout to python stderr and
 # stdout and has a noticeable effect only when python stderr and stdout are
@@ -85,6 +90,19 @@ JAVA_CLASSES = {
     "MDC": "org.apache.log4j.MDC",
 }
 
+# the classes loaded by warm_up(): the calculators, the (de)serialization of
+# source models and GMPEs and the logic tree processing used by the tasks
+WARM_UP_CLASSES = (
+    "HazardCalculator", "GMFCalculator", "EventSetGen", "LogicTreeProcessor",
+    "KVS", "JsonSerializer", "GEM1ERF", "GmpeLogicTreeData",
+    "AttenuationRelationship", "GMPEDeserializer", "SourceModelReader",
+    "ArbitrarilyDiscretizedFunc", "Site", "Location", "MDC")
+
+# the time (in seconds) it took to start the JVM in this process, `None`
+# until it is started by jvm(); it is also recorded in the KVS, see
+# jvm_startup_times()
+JVM_STARTUP_TIME = None
+
 
 def jclass(class_key):
     """Wrapper around jpype.JClass for short class names"""
@@ -238,6 +256,8 @@ def jvm(max_mem=None):
                 '/usr/share/java')
 
     if not jpype.isJVMStarted():
+        global JVM_STARTUP_TIME  # pylint: disable=W0603
+        started = time.time()
         max_mem = get_jvm_max_mem(max_mem)
         jpype.startJVM(jpype.getDefaultJVMPath(),
             "-Djava.ext.dirs=%s:%s" % jarpaths,
@@ -250,9 +270,71 @@ def jvm(max_mem=None):
 
         init_logs(level=FLAGS.debug, log_type=config.get("logging", "backend"))
 
+        JVM_STARTUP_TIME = time.time() - started
+        LOG.info("JVM started in %.2f seconds" % JVM_STARTUP_TIME)
+
+        _record_jvm_startup_time()
+
     return jpype
 
 
+def _process_name():
+    """The name of this process in :py:func:`jvm_startup_times`."""
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def _record_jvm_startup_time():
+    """Record the JVM startup time of this process in the KVS."""
+    kvs.get_client().hmset(kvs.tokens.JVM_STARTUP_TIMES, {
+        _process_name(): JVM_STARTUP_TIME})
+
+
+def jvm_startup_times():
+    """Return the time (in seconds) it took to start the JVM in each process
+    which started one, keyed by "<host name>:<process id>"."""
+    return dict((process, float(seconds)) for process, seconds in
+                kvs.get_client().hgetall(kvs.tokens.JVM_STARTUP_TIMES).items())
+
+
+def warm_up(class_keys=WARM_UP_CLASSES):
+    """Start the JVM (and its logging) and load the given classes, so that
+    the tasks do not pay for it.
+
+    :param class_keys: the classes to load (keys of :py:data:`JAVA_CLASSES`)
+    :returns: the time (in seconds) spent loading the classes, the JVM
+        startup time is in :py:data:`JVM_STARTUP_TIME` (and in the KVS, see
+        :py:func:`jvm_startup_times`)
+    :rtype: float
+    """
+    jvm()
+
+    started = time.time()
+    for class_key in class_keys:
+        jclass(class_key)
+    elapsed = time.time() - started
+
+    LOG.info("JVM warmed up: started in %.2f seconds, %s classes loaded in "
+             "%.2f seconds" % (JVM_STARTUP_TIME, len(class_keys), elapsed))
+
+    # record it again, the KVS may have been flushed since the JVM started
+    _record_jvm_startup_time()
+
+    return elapsed
+
+
+def warm_up_worker(**kwargs):  # pylint: disable=W0613
+    """Warm up the JVM when a worker process starts, if enabled with the
+    `warm_up` setting of the `java` section in openquake.cfg (the workers
+    which do not run Java tasks would only waste the memory of a JVM)."""
+    if (config.get("java", "warm_up") or "false").lower() == "true":
+        warm_up()
+
+
+# the JVM cannot be shared by forked processes, it can be started by each
+# worker process of the pool, before it receives its first task
+worker_process_init.connect(warm_up_worker)
+
+
 # The default JVM max. memory size to be used in the absence of any other
 # setting or configuration.
 DEFAULT_JVM_MAX_MEM = 4000
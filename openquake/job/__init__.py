@@ -25,6 +25,7 @@ import sqlalchemy
 import subprocess
 import urlparse
 
+from collections import OrderedDict
 from ConfigParser import ConfigParser, RawConfigParser
 
 import geoalchemy as ga
@@ -69,11 +70,21 @@ ENUM_MAP = {
 
 REVERSE_ENUM_MAP = dict((v, k) for k, v in ENUM_MAP.iteritems())
 
+# the jobs loaded by the tasks running in this (worker) process, see
+# Job.cached(): job id -> job, the least recently used first
+_CACHED_JOBS = OrderedDict()
+MAX_CACHED_JOBS = 8
 
-def run_job(job_file, output_type):
-    """Given a job_file, run the job."""
 
-    a_job = Job.from_file(job_file, output_type)
+def run_job(job_file, output_type, resume_job_id=None):
+    """Given a job_file, run the job.
+
+    When `resume_job_id` is given, the (failed) job with that id is resumed:
+    the units of work it completed already are not repeated (see
+    :py:mod:`openquake.job.checkpoint`).
+    """
+
+    a_job = Job.from_file(job_file, output_type, resume_job_id)
     is_job_valid = a_job.is_valid()
 
     if is_job_valid[0]:
@@ -254,7 +265,38 @@ class Job(object):
         return job
 
     @staticmethod
-    def from_file(config_file, output_type):
+    def cached(job_id):
+        """Return the job in the underlying kvs system with the given id,
+        like :py:meth:`from_kvs`, but reuse the same job object (and what
+        was loaded into it, e.g. by the mixins' preload steps) across the
+        tasks this process runs for the job.
+
+        The cached jobs are looked up by id only, without reading the KVS:
+        a job is dropped when it completes (see
+        :py:func:`openquake.utils.tasks.check_job_status`) or is stored
+        again by this process (see :py:meth:`forget_cached`), and the least
+        recently used one when more than MAX_CACHED_JOBS are cached.
+        """
+        # (re)inserted last, as the most recently used
+        job = _CACHED_JOBS.pop(job_id, None)
+
+        if job is None:
+            job = Job.from_kvs(job_id)
+
+            if len(_CACHED_JOBS) >= MAX_CACHED_JOBS:
+                _CACHED_JOBS.popitem(last=False)
+
+        _CACHED_JOBS[job_id] = job
+        return job
+
+    @staticmethod
+    def forget_cached(job_id):
+        """Drop the job with the given id from the cache of
+        :py:meth:`cached`."""
+        _CACHED_JOBS.pop(job_id, None)
+
+    @staticmethod
+    def from_file(config_file, output_type, resume_job_id=None):
         """
         Create a job from external configuration files.
 
@@ -262,6 +304,8 @@ class Job(object):
         :param output_type: where to store results:
             * 'db' database
             * 'xml' XML files *plus* database
+        :param resume_job_id: the id of the job to resume, if any; no new
+            job record is created then
         :param params: optional dictionary of default parameters, overridden by
             the ones read from the config file
         :type params: :py:class:`dict`
@@ -291,12 +335,12 @@ class Job(object):
 
         if output_type == 'xml_without_db':
             # we are running a test
-            job_id = 0
+            job_id = resume_job_id or 0
             serialize_results_to = ['xml']
         else:
             # openquake-server creates the job record in advance and stores the
             # job id in the config file
-            job_id = params.get('OPENQUAKE_JOB_ID')
+            job_id = resume_job_id or params.get('OPENQUAKE_JOB_ID')
             if not job_id:
                 # create the database record for this job
                 job_id = prepare_job(params).id
@@ -308,6 +352,7 @@ class Job(object):
 
         job = Job(params, job_id, sections=sections, base_path=base_path)
         job.serialize_results_to = serialize_results_to
+        job.resumed = resume_job_id is not None
         job.config_file = config_file  # pylint: disable=W0201
         return job
 
@@ -350,6 +395,8 @@ class Job(object):
         self.sections = list(set(sections))
         self.serialize_results_to = []
         self.base_path = base_path
+        # is this a failed job that is being resumed?
+        self.resumed = False
         if base_path:
             self.to_kvs()
 
@@ -452,6 +499,11 @@ class Job(object):
         """
         LOG.debug("Running KVS garbage collection for job %s" % self.job_id)
 
+        if kvs.backend() == kvs.LOCAL_BACKEND:
+            # another process would not see the data of the local backend
+            kvs.cache_gc(self.job_id)
+            return
+
         gc_cmd = ['python', 'bin/cache_gc.py', '--job=%s' % self.job_id]
 
         # run KVS garbage collection aynchronously
@@ -492,7 +544,6 @@ class Job(object):
     def _slurp_files(self):
         """Read referenced files and write them into kvs, keyed on their
         sha1s."""
-        kvs_client = kvs.get_client()
         if self.base_path is None:
             LOG.debug("Can't slurp files without a base path, homie...")
             return
@@ -503,7 +554,7 @@ class Job(object):
                     LOG.debug("Slurping %s" % path)
                     blob = data_file.read()
                     file_key = kvs.tokens.generate_blob_key(self.job_id, blob)
-                    kvs_client.set(file_key, blob)
+                    kvs.set(file_key, blob)
                     self.params[key] = file_key
                     self.params[key + "_PATH"] = path
 
@@ -514,6 +565,7 @@ class Job(object):
             self._write_super_config()
         key = kvs.tokens.generate_job_key(self.job_id)
         kvs.set_value_json_encoded(key, self.params)
+        Job.forget_cached(self.job_id)
 
     def sites_for_region(self):
         """Return the list of sites for the region at hand."""
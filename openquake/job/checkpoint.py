@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+"""
+Checkpoints of the units of work completed by a job (e.g. the hazard curves
+of a site block for a logic tree realization), kept in the KVS so that a
+failed job can be resumed (see `bin/openquake --resume`) without repeating
+them.
+"""
+
+import json
+
+from openquake import kvs
+
+
+class Checkpoint(object):
+    """The named set of units of work completed by a job.
+
+    A unit is identified by a tuple of (string convertible) values, e.g.
+    (realization, block index).
+    """
+
+    def __init__(self, job_id, name):
+        self.job_id = job_id
+        self.name = name
+        self.key = kvs.tokens.checkpoint_key(job_id, name)
+
+    @staticmethod
+    def _unit(unit):
+        """The KVS set member of `unit`."""
+        return "!".join(str(part) for part in unit)
+
+    def done(self, *unit):
+        """Was the given unit of work completed?"""
+        return bool(kvs.get_client().sismember(self.key, self._unit(unit)))
+
+    def mark_done(self, *unit):
+        """Record that the given unit of work was completed."""
+        kvs.get_client().sadd(self.key, self._unit(unit))
+        kvs.register_keys([self.key])
+
+    def clear(self):
+        """Forget the completed units of work (e.g. when a job is started
+        from scratch)."""
+        kvs.get_client().delete(self.key)
+
+    def save(self, name, value):
+        """Save (JSON encoded) data the completed units depend on, e.g. how
+        the sites were split in blocks."""
+        kvs.set_value_json_encoded(
+            kvs.tokens.checkpoint_key(self.job_id, self.name, name), value)
+
+    def load(self, name):
+        """Return the data saved with :py:meth:`save` or `None`."""
+        value = kvs.get_client().get(
+            kvs.tokens.checkpoint_key(self.job_id, self.name, name))
+        return json.loads(value) if value is not None else None
@@ -21,8 +21,15 @@ This module tests contains logic related to the configuration and
 its validation.
 """
 
+from openquake import kvs
+
 EXPOSURE = "EXPOSURE"
 RISK_SECTION = "RISK"
+HAZARD_SECTION = "HAZARD"
+
+# the calculation modes whose hazard is computed by the Java side of the
+# engine reading and writing the KVS (see `LogicTreeProcessor`)
+JAVA_KVS_CALCULATION_MODES = ("Classical", "Event Based")
 INPUT_REGION = "REGION_VERTEX"
 CALCULATION_MODE = "CALCULATION_MODE"
 REGION_GRID_SPACING = "REGION_GRID_SPACING"
@@ -91,6 +98,39 @@ class ExposureValidator(object):
         return (True, [])
 
 
+class KVSBackendValidator(object):
+    """Validator that checks if the KVS backend can be used for the job:
+    the Java side of the engine, which computes the classical and event
+    based hazard, always reads and writes Redis, and cannot see the values
+    of the local backend."""
+
+    def __init__(self, sections, params):
+        self.sections = sections
+        self.params = params
+
+    def is_valid(self):
+        """Return true unless the job computes the hazard in Java with the
+        local KVS backend, false otherwise. When invalid returns also the
+        error messages.
+
+        :returns: the status of this validator and the related error messages.
+        :rtype: when valid, a (True, []) tuple is returned. When invalid, a
+            (False, [ERROR_MESSAGE#1, ERROR_MESSAGE#2, ..., ERROR_MESSAGE#N])
+            tuple is returned
+        """
+
+        if (HAZARD_SECTION in self.sections
+            and self.params.get(CALCULATION_MODE)
+                in JAVA_KVS_CALCULATION_MODES
+            and kvs.backend() == kvs.LOCAL_BACKEND):
+            return (False, [
+                "%s HAZARD processing uses Java, which needs the redis KVS "
+                "backend (the local one was configured)"
+                % self.params[CALCULATION_MODE]])
+
+        return (True, [])
+
+
 def default_validators(sections, params):
     """Create the set of default validators for a job.
 
@@ -109,5 +149,6 @@ def default_validators(sections, params):
 
     validators = ValidatorSet()
     validators.add(exposure)
+    validators.add(KVSBackendValidator(sections, params))
 
     return validators
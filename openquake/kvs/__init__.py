@@ -27,7 +27,9 @@ import numpy
 
 from openquake import logs
 from openquake.kvs import tokens
+from openquake.kvs.local import LocalKVS
 from openquake.kvs.redis import Redis
+from openquake.utils import config
 
 
 LOG = logs.LOG
@@ -37,6 +39,23 @@ INTERNAL_ID_SEPARATOR = ':'
 MAX_LENGTH_RANDOM_ID = 36
 SITES_KEY_TOKEN = "sites"
 
+REDIS_BACKEND = "redis"
+LOCAL_BACKEND = "local"
+BACKENDS = {REDIS_BACKEND: Redis, LOCAL_BACKEND: LocalKVS}
+
+# Numeric arrays (hazard curves, maps) stored in binary form start with this
+# header, followed by a one character type code and the raw little-endian
+# values. No JSON document can start with it.
+ARRAY_MAGIC = '\x93OQ'
+ARRAY_TYPE_CODES = {'float64': 'd', 'float32': 'f'}
+ARRAY_DTYPES = {'d': '<f8', 'f': '<f4'}
+DEFAULT_ARRAY_FORMAT = 'float64'
+
+DEFAULT_WRITE_BATCH_SIZE = 1000
+
+# number of keys deleted at a time by cache_gc()
+GC_BATCH_SIZE = 1000
+
 
 def flush():
     """Flush (delete) all the values stored in the underlying kvs system."""
@@ -44,7 +63,11 @@ def flush():
 
 
 def get_keys(regexp):
-    """Get all KVS keys that match a given regexp pattern."""
+    """Get all KVS keys that match a given regexp pattern.
+
+    This scans the whole KVS (and blocks it meanwhile): use
+    :py:func:`job_keys` to look up the keys of a job.
+    """
     return get_client().keys(regexp)
 
 
@@ -56,7 +79,7 @@ def mget(keys):
     :type keys: list
     :returns: one value for each key in the list
     """
-    return get_client().mget(keys)
+    return _mget_raw(keys)
 
 
 def mget_decoded(keys):
@@ -70,13 +93,16 @@ def mget_decoded(keys):
     """
     decoder = json.JSONDecoder()
 
-    return [decoder.decode(value) for value in get_client().mget(keys)]
+    return [decoder.decode(value) for value in _mget_raw(keys)]
 
 
 def get_pattern(regexp):
     """Get all the values whose keys satisfy the given regexp.
 
     Return an empty list if there are no keys satisfying the given regxep.
+    Like :py:func:`get_keys`, this scans the whole KVS. The per-site values
+    stored in the `block` layout (see :py:class:`tokens.SiteKey`) are hash
+    fields, and are not found.
     """
 
     values = []
@@ -104,20 +130,90 @@ def get_pattern_decoded(regexp):
 
 def get(key):
     """Get value from kvs for external decoding"""
-    return get_client().get(key)
+    return _mget_raw([key])[0]
+
+
+def backend():
+    """
+    Return the KVS backend, as configured in the `backend` setting of the
+    `kvs` section in openquake.cfg:
+        * 'redis': a Redis server (see :py:class:`Redis`)
+        * 'local': an in-process KVS (see :py:class:`LocalKVS`), only for
+          jobs whose tasks all run in the same process and do not use the
+          KVS from the Java side of the engine (i.e. no classical or event
+          based hazard), which always talks to Redis
+    """
+    return config.get("kvs", "backend") or REDIS_BACKEND
 
 
 def get_client(**kwargs):
     """possible kwargs:
         db: database identifier
+
+    The client is one of the configured :py:func:`backend`.
+    """
+    backend_ = backend()
+
+    if backend_ not in BACKENDS:
+        raise ValueError("unknown KVS backend: %s" % backend_)
+
+    return BACKENDS[backend_](**kwargs)
+
+
+def _queue_key_index(pipe, keys):
+    """Queue in the given pipeline the commands registering the given keys in
+    the index sets of their jobs (see :py:func:`job_keys`)."""
+    type_indexes = {}
+
+    for key in keys:
+        job_key, type_ = tokens.split_job_key(key)
+
+        if job_key is not None:
+            type_index = tokens.key_index_key(job_key, type_)
+            pipe.sadd(type_index, str(key))
+            type_indexes[type_index] = job_key
+
+    for type_index, job_key in type_indexes.iteritems():
+        pipe.sadd(tokens.key_index_key(job_key), type_index)
+
+
+def register_keys(keys):
+    """
+    Register in the index sets of their jobs keys which were not written
+    with the functions of this module (e.g. by the Java side), so that they
+    are found by :py:func:`job_keys` and :py:func:`cache_gc`.
+
+    :param keys: the KVS keys
+    :type keys: list
+    """
+    pipe = get_client().pipeline(transaction=False)
+    _queue_key_index(pipe, keys)
+    pipe.execute()
+
+
+def job_keys(job_id, type_):
+    """
+    Get the keys of a given type stored for a job, without scanning the
+    whole KVS.
+
+    Only the keys written with the functions of this module (or registered
+    with :py:func:`register_keys`) are returned.
+
+    :param job_id: the id of the job
+    :type job_id: int
+    :param type_: the key type (e.g. :py:data:`tokens.GMF_KEY_TOKEN`)
+    :type type_: string
+    :returns: the keys, in no particular order
+    :rtype: list
     """
-    return Redis(**kwargs)
+    return list(get_client().smembers(
+        tokens.key_index_key(tokens.generate_job_key(job_id), type_)))
 
 
 def get_value_json_decoded(key):
     """ Get value from kvs and json decode """
     try:
-        value = get_client().get(key)
+        value = get(key)
         decoder = json.JSONDecoder()
         return decoder.decode(value)
     except (TypeError, ValueError), e:
@@ -159,21 +255,391 @@ def set_value_json_encoded(key, value):
 
     try:
         encoded_value = encoder.encode(value)
-        get_client().set(key, encoded_value)
     except (TypeError, ValueError):
         raise ValueError("cannot encode value %s of type %s to JSON"
                          % (value, type(value)))
 
+    return set(key, encoded_value)
+
+
+def mset_encoded(values):
+    """
+    JSON encode multiple values and set them in the KVS with a single
+    round trip.
+
+    :param values: the values to store, keyed by their KVS key
+    :type values: dict
+    """
+    if not values:
+        return True
+
+    encoder = NumpyAwareJSONEncoder()
+
+    encoded_values = {}
+    for key, value in values.iteritems():
+        try:
+            encoded_values[key] = encoder.encode(value)
+        except (TypeError, ValueError):
+            raise ValueError("cannot encode value %s of type %s to JSON"
+                             % (value, type(value)))
+
+    pipe = get_client().pipeline(transaction=False)
+    _queue_values(pipe, encoded_values)
+    pipe.execute()
+    return True
+
+
+def update_encoded(keys, update):
+    """
+    Atomically replace the JSON encoded values of the given keys with new
+    ones computed from them.
+
+    The keys are watched while they are read and the new values are written
+    in a transaction (WATCH/MULTI/EXEC), which is retried when any of the
+    keys is written by somebody else meanwhile. `update` can hence be called
+    more than once and must not have side effects.
+
+    :param keys: the keys to update
+    :type keys: list of strings
+    :param update: called with the decoded values of the keys (`None` for
+        the missing ones), returns the new values keyed by their KVS key
+    :type update: callable
+    """
+    encoder = NumpyAwareJSONEncoder()
+
+    def transaction(pipe):
+        """Read the values, queue the writes of the new ones."""
+        values = update([None if value is None else json.loads(value)
+                         for value in pipe.mget(keys)])
+
+        pipe.multi()
+
+        if values:
+            pipe.mset(dict((key, encoder.encode(value))
+                           for key, value in values.iteritems()))
+            _queue_key_index(pipe, values.keys())
+
+    get_client().transaction(transaction, *keys)
+
+
+def array_format():
+    """
+    Return the format used to store numeric arrays in the KVS, as configured
+    in the `array_format` setting of the `kvs` section in openquake.cfg:
+        * 'float64' or 'float32': packed binary values
+        * 'json': JSON text (compatibility mode)
+    """
+    return config.get("kvs", "array_format") or DEFAULT_ARRAY_FORMAT
+
+
+def encode_array(values, format_=None):
+    """
+    Encode a numeric array (or a scalar) for storage in the KVS.
+
+    :param values: the values to encode
+    :type values: a sequence of numbers, a 1-dimensional
+        :py:class:`numpy.ndarray` or a number
+    :param format_: 'float64', 'float32' or 'json'; the configured
+        :py:func:`array_format` is used when not given
+    :returns: the encoded value
+    :rtype: string
+    """
+    format_ = format_ or array_format()
+
+    if format_ == 'json':
+        return NumpyAwareJSONEncoder().encode(values)
+
+    type_code = ARRAY_TYPE_CODES[format_]
+    return ARRAY_MAGIC + type_code + numpy.asarray(
+        values, dtype=ARRAY_DTYPES[type_code]).tostring()
+
+
+def decode_array(value):
+    """
+    Decode a numeric array stored with :py:func:`encode_array`, whatever
+    format it was stored in.
+
+    Binary values are not copied: the returned array is a read-only view
+    of the value read from the KVS.
+
+    :param value: the value read from the KVS
+    :type value: string
+    :returns: the decoded values (a 0-dimensional array for scalars stored
+        as JSON)
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    if value.startswith(ARRAY_MAGIC):
+        return numpy.frombuffer(
+            value, dtype=ARRAY_DTYPES[value[len(ARRAY_MAGIC)]],
+            offset=len(ARRAY_MAGIC) + 1)
+
+    return numpy.array(json.loads(value), dtype=float)
+
+
+def _hash_field(key):
+    """Return the (hash, field) pair a value is stored in when `key` is a
+    :py:class:`tokens.SiteKey` in the `block` layout, `None` otherwise."""
+    hash_key = getattr(key, "hash_key", None)
+    return None if hash_key is None else (hash_key, key.field)
+
+
+def set_array(key, values):
+    """Encode a numeric array with :py:func:`encode_array` and set it in the
+    KVS."""
+    return mset_arrays({key: values})
+
+
+def mset_arrays(values):
+    """
+    Encode multiple numeric arrays with :py:func:`encode_array` and set them
+    in the KVS with a single round trip.
+
+    Values keyed by a :py:class:`tokens.SiteKey` in the `block` layout are
+    stored as fields of the hash of their site block (one HMSET per block).
+
+    :param values: the arrays to store, keyed by their KVS key
+    :type values: dict
+    """
+    if values:
+        pipe = get_client().pipeline(transaction=False)
+        _queue_values(pipe, dict((key, encode_array(value))
+                                 for key, value in values.iteritems()))
+        pipe.execute()
+
+    return True
+
+
+def _queue_values(pipe, values):
+    """Queue in the given pipeline the commands storing the given (encoded)
+    values, as fields of the hashes of their site blocks for the
+    :py:class:`tokens.SiteKey` keys in the `block` layout."""
+    plain = {}
+    hashes = {}
+
+    for key, value in values.iteritems():
+        hash_field = _hash_field(key)
+
+        if hash_field is None:
+            plain[key] = value
+        else:
+            hashes.setdefault(hash_field[0], {})[hash_field[1]] = value
+
+    if plain:
+        pipe.mset(plain)
+
+    for hash_key, fields in hashes.iteritems():
+        pipe.hmset(hash_key, fields)
+
+    _queue_key_index(pipe, plain.keys() + hashes.keys())
+
+
+def get_array(key):
+    """
+    Get a numeric array from the KVS.
+
+    :returns: the decoded array or `None` if the key does not exist
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    value = _mget_raw([key])[0]
+    return None if value is None else decode_array(value)
+
+
+def _mget_raw(keys):
+    """Read the (encoded) values of the given keys, fetching all the fields
+    of the same site block hash with a single HMGET, in one round trip."""
+    plain = []
+    hashes = {}
+
+    for index, key in enumerate(keys):
+        hash_field = _hash_field(key)
+
+        if hash_field is None:
+            plain.append((index, key))
+        else:
+            hashes.setdefault(hash_field[0], []).append(
+                (index, hash_field[1]))
+
+    if not hashes:
+        return get_client().mget(keys)
+
+    pipe = get_client().pipeline(transaction=False)
+
+    if plain:
+        pipe.mget([key for _, key in plain])
+
+    for hash_key, fields in hashes.iteritems():
+        pipe.hmget(hash_key, [field for _, field in fields])
+
+    results = pipe.execute()
+
+    values = [None] * len(keys)
+    groups = ([plain] if plain else []) + hashes.values()
+
+    for group, group_values in zip(groups, results):
+        for (index, _), value in zip(group, group_values):
+            values[index] = value
+
+    return values
+
+
+def mget_arrays(keys):
+    """
+    Retrieve multiple numeric arrays from the KVS with a single round trip.
+
+    :param keys: keys to retrieve (the corresponding values must have been
+        stored with :py:func:`encode_array`)
+    :type keys: list
+    :returns: one :py:class:`numpy.ndarray` for each key in the list
+    """
+    return [decode_array(value) for value in _mget_raw(keys)]
+
+
+def delete_arrays(keys):
+    """
+    Delete multiple numeric arrays stored with :py:func:`mset_arrays` (or
+    any other values set with this module).
+
+    :param keys: keys to delete
+    :type keys: list
+    """
+    plain = []
+    hashes = {}
+
+    for key in keys:
+        hash_field = _hash_field(key)
+
+        if hash_field is None:
+            plain.append(key)
+        else:
+            hashes.setdefault(hash_field[0], []).append(hash_field[1])
+
+    pipe = get_client().pipeline(transaction=False)
+
+    if plain:
+        pipe.delete(*plain)
+
+        for key in plain:
+            job_key, type_ = tokens.split_job_key(key)
+
+            if job_key is not None:
+                pipe.srem(tokens.key_index_key(job_key, type_), str(key))
+
+    for hash_key, fields in hashes.iteritems():
+        for field in fields:
+            pipe.hdel(hash_key, field)
+
+    pipe.execute()
     return True
 
 
 def set(key, encoded_value):  # pylint: disable=W0622
     """ Set value in kvs, for objects that have their own encoding method. """
 
-    get_client().set(key, encoded_value)
+    pipe = get_client().pipeline(transaction=False)
+    _queue_values(pipe, {key: encoded_value})
+    pipe.execute()
     return True
 
 
+def write_batch_size():
+    """
+    Return the maximum number of commands a :py:class:`WriteBuffer` sends to
+    the KVS with a single round trip, as configured in the `write_batch_size`
+    setting of the `kvs` section in openquake.cfg.
+    """
+    return int(config.get("kvs", "write_batch_size")
+               or DEFAULT_WRITE_BATCH_SIZE)
+
+
+class WriteBuffer(object):
+    """
+    Collect KVS writes and send them in batches through a pipeline, instead
+    of paying a network round trip for every single command.
+
+    The buffered writes are sent when `batch_size` of them are pending, when
+    :py:meth:`flush` is called and when leaving the `with` block the buffer
+    is used in (unless an exception was raised)::
+
+        with kvs.WriteBuffer() as writer:
+            for key, value in values:
+                writer.set(key, value)
+
+    The writes are not visible to readers until they are flushed.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or write_batch_size()
+        self._commands = []
+        self._values = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self._commands) + len(self._values)
+
+    def _queue(self, command, *args):
+        """Queue a single command, flushing the buffer if it is full."""
+        self._commands.append((command, args))
+
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def set(self, key, encoded_value):  # pylint: disable=W0622
+        """Buffered :py:func:`openquake.kvs.set`."""
+        self._values[key] = encoded_value
+
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def set_value_json_encoded(self, key, value):
+        """Buffered :py:func:`openquake.kvs.set_value_json_encoded`."""
+        try:
+            encoded_value = NumpyAwareJSONEncoder().encode(value)
+        except (TypeError, ValueError):
+            raise ValueError("cannot encode value %s of type %s to JSON"
+                             % (value, type(value)))
+
+        self.set(key, encoded_value)
+
+    def set_array(self, key, values):
+        """Buffered :py:func:`openquake.kvs.set_array`."""
+        self.set(key, encode_array(values))
+
+    def rpush(self, key, value):
+        """Buffered RPUSH of `value` (already encoded) to the list `key`."""
+        self._queue("rpush", key, value)
+
+    def hmset(self, key, mapping):
+        """Buffered HMSET of the given fields (already encoded) of the hash
+        `key`."""
+        self._queue("hmset", key, mapping)
+
+    def flush(self):
+        """Send all the pending writes to the KVS, in a single round trip."""
+        if not len(self):
+            return
+
+        pipe = get_client().pipeline(transaction=False)
+
+        for command, args in self._commands:
+            getattr(pipe, command)(*args)
+
+        _queue_key_index(pipe, [args[0] for _, args in self._commands])
+
+        if self._values:
+            _queue_values(pipe, self._values)
+
+        pipe.execute()
+
+        self._commands = []
+        self._values = {}
+
+
 def _prefix_id_generator(prefix):
     """Generator for IDs with a specific prefix (prefix + sequence number)."""
 
@@ -218,8 +684,9 @@ def current_jobs():
 
 def cache_gc(job_id):
     """
-    Garbage collection for the KVS. This works by simply removing all keys
-    which contain the input job key.
+    Garbage collection for the KVS. This works by removing all the keys
+    registered in the index sets of the job (see :py:func:`job_keys`), in
+    batches of `GC_BATCH_SIZE` keys, and then the index sets themselves.
 
     The job key must be a member of the 'CURRENT_JOBS' set. If it isn't, this
     function will do nothing and simply return None.
@@ -235,16 +702,25 @@ def cache_gc(job_id):
     if client.sismember(tokens.CURRENT_JOBS, job_id):
         # matches a current job
         # do the garbage collection
-        keys = client.keys('*%s*' % tokens.generate_job_key(job_id))
+        job_index = tokens.key_index_key(tokens.generate_job_key(job_id))
+        keys = []
+
+        for type_index in client.smembers(job_index):
+            type_keys = list(client.smembers(type_index))
+
+            for i in xrange(0, len(type_keys), GC_BATCH_SIZE):
+                success = client.delete(*type_keys[i:i + GC_BATCH_SIZE])
+                # delete returns the number of deleted keys (some keys may
+                # have been deleted already), False when it fails
+                if success is False:
+                    msg = 'Redis failed to delete data for job %s' % job_id
+                    LOG.error(msg)
+                    raise RuntimeError(msg)
 
-        if len(keys) > 0:
+            client.delete(type_index)
+            keys.extend(type_keys)
 
-            success = client.delete(*keys)
-            # delete should return True
-            if not success:
-                msg = 'Redis failed to delete data for job %s' % job_id
-                LOG.error(msg)
-                raise RuntimeError(msg)
+        client.delete(job_index)
 
         # finally, remove the job key from CURRENT_JOBS
         client.srem(tokens.CURRENT_JOBS, job_id)
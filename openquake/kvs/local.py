@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+An in-process KVS backend, implementing the subset of the Redis commands
+used by :py:mod:`openquake.kvs`.
+
+It is meant for jobs (and tests) whose tasks all run in a single process
+(e.g. with `CELERY_ALWAYS_EAGER`): the values are kept in memory and are
+never serialized over the network. The Java side of the engine always
+uses Redis, so the jobs computing the classical or event based hazard are
+rejected with this backend (see
+:py:class:`openquake.job.config.KVSBackendValidator`).
+"""
+
+import fnmatch
+import threading
+import time
+
+
+# the databases, by number
+_DATABASES = {}
+_LOCK = threading.RLock()
+# notified when an item is pushed to a list, see LocalKVS.blpop
+_PUSHED = threading.Condition(_LOCK)
+
+
+def _encode(value):
+    """Convert a value to the string stored in the KVS, like Redis does."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def _synchronized(method):
+    """Run the decorated method holding the backend lock."""
+
+    def wrapper(*args, **kwargs):
+        """The synchronized method."""
+        with _LOCK:
+            return method(*args, **kwargs)
+
+    wrapper.__doc__ = method.__doc__
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class LocalKVS(object):
+    """An in-process KVS, with the same interface as the Redis client."""
+
+    def __init__(self, db=0, **kwargs):  # pylint: disable=W0613
+        with _LOCK:
+            self.data = _DATABASES.setdefault(db, {})
+
+    # keys
+
+    @_synchronized
+    def get(self, key):
+        """GET: the value of `key` or `None`."""
+        return self.data.get(_encode(key))
+
+    @_synchronized
+    def set(self, key, value):
+        """SET `key` to `value`."""
+        self.data[_encode(key)] = _encode(value)
+        return True
+
+    @_synchronized
+    def mget(self, keys, *args):
+        """MGET: the values of the given keys (`None` for missing keys)."""
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        return [self.data.get(_encode(key)) for key in keys + list(args)]
+
+    @_synchronized
+    def mset(self, mapping):
+        """MSET the given key/value pairs."""
+        for key, value in mapping.iteritems():
+            self.data[_encode(key)] = _encode(value)
+
+        return True
+
+    @_synchronized
+    def delete(self, *keys):
+        """DEL: remove the given keys, return how many existed."""
+        deleted = 0
+
+        for key in keys:
+            if self.data.pop(_encode(key), None) is not None:
+                deleted += 1
+
+        return deleted
+
+    def expire(self, key, seconds):  # pylint: disable=W0613
+        """EXPIRE: accepted for compatibility, the keys of this backend
+        live as long as the process."""
+        return self.exists(key)
+
+    @_synchronized
+    def exists(self, key):
+        """EXISTS: is `key` set?"""
+        return _encode(key) in self.data
+
+    @_synchronized
+    def keys(self, pattern='*'):
+        """KEYS: the keys matching the given glob pattern."""
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    @_synchronized
+    def flushdb(self):
+        """FLUSHDB: remove all the keys of this database."""
+        self.data.clear()
+        return True
+
+    @_synchronized
+    def flushall(self):
+        """FLUSHALL: remove all the keys of all the databases."""
+        for data in _DATABASES.itervalues():
+            data.clear()
+
+        return True
+
+    # lists
+
+    @_synchronized
+    def rpush(self, key, value):
+        """RPUSH `value` to the list `key`, return the list length."""
+        items = self.data.setdefault(_encode(key), [])
+        items.append(_encode(value))
+        _PUSHED.notify_all()
+        return len(items)
+
+    @_synchronized
+    def blpop(self, keys, timeout=0):
+        """BLPOP: pop the first item of the first non empty list among
+        `keys`, waiting at most `timeout` seconds (forever if 0) for another
+        thread to push one. Return a (key, item) pair, `None` on timeout."""
+        if isinstance(keys, basestring):
+            keys = [keys]
+
+        deadline = time.time() + timeout if timeout else None
+
+        while True:
+            for key in keys:
+                items = self.data.get(_encode(key))
+
+                if items:
+                    item = items.pop(0)
+
+                    if not items:
+                        del self.data[_encode(key)]
+
+                    return _encode(key), item
+
+            if deadline is None:
+                _PUSHED.wait()
+            elif deadline > time.time():
+                _PUSHED.wait(deadline - time.time())
+            else:
+                return None
+
+    @_synchronized
+    def lrange(self, key, start, end):
+        """LRANGE: the items of the list `key` between `start` and `end`
+        (both included, negative indices count from the end)."""
+        items = self.data.get(_encode(key), [])
+        end = len(items) if end == -1 else end + 1
+        return items[start:end]
+
+    # sets
+
+    @_synchronized
+    def sadd(self, key, value):
+        """SADD `value` to the set `key`, return whether it was added."""
+        members = self.data.setdefault(_encode(key), set())
+        value = _encode(value)
+        added = value not in members
+        members.add(value)
+        return added
+
+    @_synchronized
+    def srem(self, key, value):
+        """SREM `value` from the set `key`, return whether it was there."""
+        members = self.data.get(_encode(key), set())
+        value = _encode(value)
+        removed = value in members
+        members.discard(value)
+
+        if not members:
+            self.data.pop(_encode(key), None)
+
+        return removed
+
+    @_synchronized
+    def smembers(self, key):
+        """SMEMBERS: the members of the set `key`."""
+        return set(self.data.get(_encode(key), ()))
+
+    @_synchronized
+    def sismember(self, key, value):
+        """SISMEMBER: is `value` a member of the set `key`?"""
+        return _encode(value) in self.data.get(_encode(key), ())
+
+    # hashes
+
+    @_synchronized
+    def hmset(self, key, mapping):
+        """HMSET the given fields of the hash `key`."""
+        fields = self.data.setdefault(_encode(key), {})
+
+        for field, value in mapping.iteritems():
+            fields[_encode(field)] = _encode(value)
+
+        return True
+
+    @_synchronized
+    def hmget(self, key, fields):
+        """HMGET: the values of the given fields of the hash `key`."""
+        values = self.data.get(_encode(key), {})
+        return [values.get(_encode(field)) for field in fields]
+
+    @_synchronized
+    def hgetall(self, key):
+        """HGETALL: all the fields of the hash `key`, with their values."""
+        return dict(self.data.get(_encode(key), {}))
+
+    @_synchronized
+    def hdel(self, key, field):
+        """HDEL `field` from the hash `key`, return whether it was there."""
+        values = self.data.get(_encode(key), {})
+        removed = values.pop(_encode(field), None) is not None
+
+        if not values:
+            self.data.pop(_encode(key), None)
+
+        return removed
+
+    @_synchronized
+    def hlen(self, key):
+        """HLEN: the number of fields of the hash `key`."""
+        return len(self.data.get(_encode(key), {}))
+
+    def pipeline(self, transaction=True):  # pylint: disable=W0613
+        """Return a pipeline queueing commands for this KVS."""
+        return LocalPipeline(self)
+
+    def transaction(self, func, *watches):  # pylint: disable=W0613
+        """Call `func` with a pipeline watching the given keys, then run the
+        commands it queued after calling `multi`, like the Redis client does.
+
+        The backend lock is held meanwhile, so the keys cannot change
+        between the reads and the writes and no retry is ever needed.
+        """
+        with _LOCK:
+            pipe = self.pipeline()
+            pipe.watch(*watches)
+            func(pipe)
+            return pipe.execute()
+
+    def get_multi(self, keys):
+        """ Return value of multiple keys identically to the kvs way """
+        return dict(zip(keys, self.mget(keys)))
+
+
+class LocalPipeline(object):
+    """
+    Queue commands and run them on a :py:class:`LocalKVS` (atomically) when
+    :py:meth:`execute` is called, like a Redis pipeline.
+    """
+
+    def __init__(self, kvs):
+        self.kvs = kvs
+        self.commands = []
+        self.immediate = False
+
+    def __getattr__(self, name):
+        method = getattr(self.kvs, name)
+
+        def queue(*args, **kwargs):
+            """Queue the command (or run it, after :py:meth:`watch`)."""
+            if self.immediate:
+                return method(*args, **kwargs)
+
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def watch(self, *keys):  # pylint: disable=W0613
+        """WATCH: from now on run the commands immediately, until
+        :py:meth:`multi` is called."""
+        self.immediate = True
+        return True
+
+    def multi(self):
+        """MULTI: queue the commands again."""
+        self.immediate = False
+
+    def execute(self):
+        """Run the queued commands, return their results."""
+        with _LOCK:
+            results = [method(*args, **kwargs)
+                       for method, args, kwargs in self.commands]
+
+        self.commands = []
+        return results
@@ -34,42 +34,88 @@
 """ Redis class """
 
 from __future__ import absolute_import
+import os
 import redis
 
 from openquake.utils import config
 
 
+# clients (each with its own connection pool), by process id and
+# connection parameters
+_CLIENTS = {}
+
+# the seconds to wait for a free connection of a full pool
+DEFAULT_POOL_TIMEOUT = 20
+
+
+def _client(host, port, db, unix_socket, max_connections, pool_timeout):
+    """
+    Return the client of the current process for the given connection
+    parameters.
+
+    The clients (and their connection pools) are never shared among
+    processes: a forked process (e.g. a celery worker) creates its own
+    instead of using the sockets inherited from its parent.
+
+    When `max_connections` is set, a command issued while all the
+    connections are in use waits (at most `pool_timeout` seconds) for one
+    of them to be released, instead of failing.
+    """
+    client_key = (os.getpid(), host, port, db, unix_socket, max_connections,
+                  pool_timeout)
+    client = _CLIENTS.get(client_key)
+
+    if client is None:
+        # drop the clients inherited from the parent process, if any
+        for key in _CLIENTS.keys():
+            if key[0] != client_key[0]:
+                del _CLIENTS[key]
+
+        if unix_socket:
+            pool_kwargs = dict(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=unix_socket, db=db)
+        else:
+            pool_kwargs = dict(host=host, port=port, db=db)
+
+        if max_connections:
+            pool = redis.BlockingConnectionPool(
+                max_connections=max_connections, timeout=pool_timeout,
+                **pool_kwargs)
+        else:
+            pool = redis.ConnectionPool(**pool_kwargs)
+
+        client = redis.Redis(connection_pool=pool)
+        _CLIENTS[client_key] = client
+
+    return client
+
+
 class Redis(object):
-    """ A Borg-style wrapper for Redis client class. """
-    __shared_state = {}
-
-    def __new__(cls, host=config.get("kvs", "host"),
-                     port=int(config.get("kvs", "port")),
-                     **kwargs):  # pylint: disable=W0613
-        self = object.__new__(cls)
-        self.__dict__ = cls.__shared_state
-        return self
-
-    def __init__(self, host=config.get("kvs", "host"),
-                       port=int(config.get("kvs", "port")),
-                       **kwargs):
-        if not self.__dict__:
-            args = {"host": host,
-                    "port": port,
-                    "db": kwargs.get('db', 0)}
-
-            self.conn = redis.Redis(**args)
+    """
+    A wrapper for the Redis client class, sharing a per-process pool of (at
+    most `max_connections` of the `kvs` section in openquake.cfg, waiting
+    at most `pool_timeout` seconds for a free one) connections for every
+    set of connection parameters.
 
-    def __getattr__(self, name):
-        def call(*args, **kwargs):
-            """ Pass through the query to our redis connection """
-            cmd = getattr(self.conn, name)
-            return cmd(*args, **kwargs)
+    When the `unix_socket` setting of the `kvs` section is not empty, the
+    server is reached through that Unix domain socket instead of TCP.
+    """
+
+    def __init__(self, host=None, port=None, **kwargs):
+        host = host or config.get("kvs", "host")
+        port = int(port or config.get("kvs", "port"))
+        max_connections = int(config.get("kvs", "max_connections") or 0)
+        pool_timeout = int(config.get("kvs", "pool_timeout")
+                           or DEFAULT_POOL_TIMEOUT)
 
-        if name in self.__dict__:
-            return self.__dict__.get(name)
+        self.conn = _client(host, port, kwargs.get('db', 0),
+                            config.get("kvs", "unix_socket"),
+                            max_connections or None, pool_timeout)
 
-        return call
+    def __getattr__(self, name):
+        """ Pass through the query to our redis connection """
+        return getattr(self.conn, name)
 
     def get_multi(self, keys):
         """ Return value of multiple keys identically to the kvs way """
@@ -19,8 +19,10 @@
 """Tokens for KVS keys."""
 
 import hashlib
+import math
 
 from openquake import logs
+from openquake.utils import config
 
 
 LOG = logs.LOG
@@ -33,6 +35,8 @@ GMPE_TOKEN = 'gmpe'
 ERF_KEY_TOKEN = 'erf'
 MGM_KEY_TOKEN = 'mgm'
 HAZARD_CURVE_POES_KEY_TOKEN = 'hazard_curve_poes'
+HAZARD_CURVE_SUM_KEY_TOKEN = 'hazard_curve_sum'
+HAZARD_CURVE_SAMPLES_KEY_TOKEN = 'hazard_curve_samples'
 MEAN_HAZARD_CURVE_KEY_TOKEN = 'mean_hazard_curve'
 QUANTILE_HAZARD_CURVE_KEY_TOKEN = 'quantile_hazard_curve'
 STOCHASTIC_SET_TOKEN = 'ses'
@@ -49,8 +53,33 @@ LOSS_CURVE_KEY_TOKEN = 'LOSS_CURVE'
 VULNERABILITY_CURVE_KEY_TOKEN = 'VULNERABILITY_CURVE'
 
 
+# the coordinates of a block of sites, see hazard.opensha.store_site_blocks
+SITE_BLOCK_TOKEN = 'site_block'
+
+# the seeds a logic tree realization was sampled with
+LOGIC_TREE_SEEDS_TOKEN = 'logic_tree_seeds'
+
+# the units of work completed by a job, see openquake.job.checkpoint
+CHECKPOINT_TOKEN = 'checkpoint'
+
 CURRENT_JOBS = 'CURRENT_JOBS'
 
+# the JVM startup time of each process, see openquake.java.jvm_startup_times
+JVM_STARTUP_TIMES = 'JVM_STARTUP_TIMES'
+
+# a finished task pushes its id to its completion list, see
+# openquake.utils.tasks.wait_for_any
+TASK_DONE_TOKEN = 'TASK_DONE'
+
+# the keys of a job are registered in per-job, per-type index sets
+KEY_INDEX_TOKEN = 'KEYS'
+
+# layouts of the per-site results, see kvs_layout()
+SITE_LAYOUT = 'site'
+BLOCK_LAYOUT = 'block'
+# size (in degrees) of the site blocks used by the 'block' layout
+DEFAULT_SITE_BLOCK_SIZE = 1.0
+
 
 def _generate_key(job_id, type_, *parts):
     """
@@ -92,6 +121,51 @@ def generate_job_key(job_id):
     return JOB_KEY_FMT % job_id
 
 
+def split_job_key(kvs_key):
+    """
+    Split a KVS key into the key of the job it belongs to and its type.
+
+    :param kvs_key: the KVS key
+    :type kvs_key: str
+    :returns: a (job key, type) pair; the type of a job key is the empty
+        string, both are `None` if the key does not belong to any job
+    """
+    prefix, suffix = JOB_KEY_FMT.split('%s')
+
+    end = kvs_key.find(suffix, len(prefix))
+
+    if not kvs_key.startswith(prefix) or end == -1:
+        return None, None
+
+    job_key = kvs_key[:end + len(suffix)]
+    parts = kvs_key[len(job_key):].split(_KVS_KEY_SEPARATOR, 2)
+
+    return job_key, parts[1] if len(parts) > 1 else ''
+
+
+def key_index_key(job_key, type_=None):
+    """
+    Return the key of a set indexing the keys of a job.
+
+    :param job_key: the job key (see :py:func:`generate_job_key`)
+    :type job_key: str
+    :param type_: the type of the indexed keys; when not given, the key of
+        the set indexing the per-type index sets of the job is returned
+    :type type_: str
+    """
+    parts = [job_key, KEY_INDEX_TOKEN]
+
+    if type_ is not None:
+        parts.append(type_)
+
+    return _KVS_KEY_SEPARATOR.join(parts)
+
+
+def task_done_key(task_id):
+    """Return the key of the completion list of the given task."""
+    return _KVS_KEY_SEPARATOR.join((TASK_DONE_TOKEN, str(task_id)))
+
+
 def generate_blob_key(job_id, blob):
     """ Return the KVS key for a binary blob """
     return _generate_key(job_id, 'blob', hashlib.sha1(blob).hexdigest())
@@ -107,14 +181,43 @@ def asset_key(job_id, row, col):
     return _generate_key(job_id, EXPOSURE_KEY_TOKEN, row, col)
 
 
-def source_model_key(job_id):
-    """ Return the KVS key for the source model of the given job"""
-    return _generate_key(job_id, SOURCE_MODEL_TOKEN)
+def source_model_key(job_id, realization=None):
+    """ Return the KVS key for the source model of the given job (and logic
+    tree realization, if given)"""
+    if realization is None:
+        return _generate_key(job_id, SOURCE_MODEL_TOKEN)
+
+    return _generate_key(job_id, SOURCE_MODEL_TOKEN, realization)
+
+
+def gmpe_key(job_id, realization=None):
+    """ Return the KVS key for the GMPE of the given job (and logic tree
+    realization, if given)"""
+    if realization is None:
+        return _generate_key(job_id, GMPE_TOKEN)
 
+    return _generate_key(job_id, GMPE_TOKEN, realization)
 
-def gmpe_key(job_id):
-    """ Return the KVS key for the GMPE of the given job"""
-    return _generate_key(job_id, GMPE_TOKEN)
+
+def logic_tree_seeds_key(job_id, realization=None):
+    """ Return the KVS key for the seeds the source model and GMPE map of the
+    given job (and logic tree realization, if given) were sampled with"""
+    if realization is None:
+        return _generate_key(job_id, LOGIC_TREE_SEEDS_TOKEN)
+
+    return _generate_key(job_id, LOGIC_TREE_SEEDS_TOKEN, realization)
+
+
+def site_block_key(job_id, block_id):
+    """ Return the KVS key for the coordinates of the given block of sites
+    of the given job"""
+    return _generate_key(job_id, SITE_BLOCK_TOKEN, block_id)
+
+
+def checkpoint_key(job_id, name, *parts):
+    """ Return the KVS key for the named checkpoint of the given job (or for
+    the data saved with it, if `parts` are given)"""
+    return _generate_key(job_id, CHECKPOINT_TOKEN, name, *parts)
 
 
 def stochastic_set_key(job_id, history, realization):
@@ -164,83 +267,109 @@ def loss_key(job_id, row, col, asset_id, poe):
                          row, col)
 
 
-def _mean_hazard_curve_key(job_id, site_fragment):
-    "Common code for the key functions below"
-    return _generate_key(job_id, MEAN_HAZARD_CURVE_KEY_TOKEN, site_fragment)
+class SiteKey(str):
+    """The KVS key of a per-site result (e.g. a hazard curve).
 
+    It behaves as the plain per-site key. When the `block` layout is used
+    (see :py:func:`kvs_layout`) it also carries the hash the value is
+    actually stored in (`hash_key`, one per site block) and the field
+    within that hash (`field`).
 
-def mean_hazard_curve_key(job_id, site):
-    """Return the key used to store a mean hazard curve for a single site.
+    The values must hence be read and written with the functions of
+    :py:mod:`openquake.kvs` (which know about the layout), never with the
+    KVS client: in the `block` layout the client would silently find
+    nothing under the plain key.
+    """
 
-    :param job_id: the id of the job.
-    :type job_id: integer
-    :param site: site where the curve is computed.
+    def __new__(cls, key, hash_key=None, field=None):
+        site_key = str.__new__(cls, key)
+        site_key.hash_key = hash_key
+        site_key.field = field
+        return site_key
+
+    def __reduce__(self):
+        return (SiteKey, (str(self), self.hash_key, self.field))
+
+
+def kvs_layout():
+    """
+    Return how per-site results are laid out in the KVS, as configured in
+    the `layout` setting of the `kvs` section in openquake.cfg:
+        * 'site': one key per site
+        * 'block': one hash per site block, one hash field per site
+    """
+    return config.get("kvs", "layout") or SITE_LAYOUT
+
+
+def site_block_id(site):
+    """Return the id of the block (a square cell of `site_block_size`
+    degrees) the given site belongs to.
+
+    :param site: the site
     :type site: :py:class:`shapes.Site` object
-    :returns: the key.
     :rtype: string
     """
-    return _mean_hazard_curve_key(job_id, hash(site))
+    block_size = float(
+        config.get("kvs", "site_block_size") or DEFAULT_SITE_BLOCK_SIZE)
 
+    return "B%d_%d" % (math.floor(site.longitude / block_size),
+                       math.floor(site.latitude / block_size))
 
-def mean_hazard_curve_key_template(job_id):
-    """Return a template for a key used to store a mean hazard curve for a
-    single site.
 
-    The template must be specialized before use with something similar to:
-    `template_key % hash(site)`
+def _site_key(job_id, type_, site, prefix=(), suffix=()):
+    """
+    Create the key of a per-site result.
 
-    :param job_id: the id of the job.
-    :type job_id: integer
-    :returns: the key.
-    :rtype: string
+    :param job_id: the job id
+    :type job_id: int
+    :param type_: the key type
+    :param type_: string
+    :param site: the site
+    :type site: :py:class:`shapes.Site` object
+    :param prefix: the key parts preceding the site
+    :param suffix: the key parts following the site
+    :returns: the KVS key
+    :rtype: :py:class:`SiteKey`
     """
-    return _mean_hazard_curve_key(job_id, '%s')
+    key = _generate_key(
+        job_id, type_, *(list(prefix) + [hash(site)] + list(suffix)))
 
+    if kvs_layout() == BLOCK_LAYOUT:
+        hash_key = _generate_key(
+            job_id, type_,
+            *(list(prefix) + [site_block_id(site)] + list(suffix)))
+        return SiteKey(key, hash_key, str(hash(site)))
 
-def _quantile_hazard_curve_key(job_id, site_fragment, quantile):
-    "Common code for the key functions below"
-    return _generate_key(job_id, QUANTILE_HAZARD_CURVE_KEY_TOKEN,
-                         site_fragment, str(quantile))
+    return SiteKey(key)
 
 
-def quantile_hazard_curve_key(job_id, site, quantile):
-    """Return the key used to store a quantile hazard curve for a single site.
+def mean_hazard_curve_key(job_id, site):
+    """Return the key used to store a mean hazard curve for a single site.
 
     :param job_id: the id of the job.
     :type job_id: integer
     :param site: site where the curve is computed.
     :type site: :py:class:`shapes.Site` object
-    :param quantile: quantile used to compute the curve.
-    :type quantile: float
     :returns: the key.
-    :rtype: string
+    :rtype: :py:class:`SiteKey`
     """
+    return _site_key(job_id, MEAN_HAZARD_CURVE_KEY_TOKEN, site)
 
-    return _quantile_hazard_curve_key(job_id, hash(site), quantile)
-
-
-def quantile_hazard_curve_key_template(job_id, quantile):
-    """Return a template for a key used to store a quantile hazard curve for a
-    single site.
 
-    The template must be specialized before use with something similar to:
-    `template_key % hash(site)`
+def quantile_hazard_curve_key(job_id, site, quantile):
+    """Return the key used to store a quantile hazard curve for a single site.
 
     :param job_id: the id of the job.
     :type job_id: integer
+    :param site: site where the curve is computed.
+    :type site: :py:class:`shapes.Site` object
     :param quantile: quantile used to compute the curve.
     :type quantile: float
     :returns: the key.
-    :rtype: string
+    :rtype: :py:class:`SiteKey`
     """
-
-    return _quantile_hazard_curve_key(job_id, '%s', quantile)
-
-
-def _mean_hazard_map_key(job_id, site_fragment, poe):
-    "Common code for the key functions below"
-    return _generate_key(job_id, MEAN_HAZARD_MAP_KEY_TOKEN, site_fragment,
-                         str(poe))
+    return _site_key(job_id, QUANTILE_HAZARD_CURVE_KEY_TOKEN, site,
+                     suffix=[str(quantile)])
 
 
 def mean_hazard_map_key(job_id, site, poe):
@@ -254,34 +383,10 @@ def mean_hazard_map_key(job_id, site, poe):
     :param poe: probability of exceedance used to compute the value.
     :type poe: float
     :returns: the key.
-    :rtype: string
+    :rtype: :py:class:`SiteKey`
     """
-
-    return _mean_hazard_map_key(job_id, hash(site), poe)
-
-
-def mean_hazard_map_key_template(job_id, poe):
-    """Return a template key used to store the interpolated IML (Intensity
-    Measure Level) used in mean hazard maps for a single site.
-
-    The template must be specialized before use with something similar to:
-    `template_key % hash(site)`
-
-    :param job_id: the id of the job.
-    :type job_id: integer
-    :param poe: probability of exceedance used to compute the value.
-    :type poe: float
-    :returns: the key.
-    :rtype: string
-    """
-
-    return _mean_hazard_map_key(job_id, '%s', poe)
-
-
-def _quantile_hazard_map_key(job_id, site_fragment, poe, quantile):
-    "Common code for the key functions below"
-    return _generate_key(job_id, QUANTILE_HAZARD_MAP_KEY_TOKEN,
-                         site_fragment, str(poe), str(quantile))
+    return _site_key(job_id, MEAN_HAZARD_MAP_KEY_TOKEN, site,
+                     suffix=[str(poe)])
 
 
 def quantile_hazard_map_key(job_id, site, poe, quantile):
@@ -297,45 +402,55 @@ def quantile_hazard_map_key(job_id, site, poe, quantile):
     :param quantile: quantile used to compute the curve.
     :type quantile: float
     :returns: the key.
-    :rtype: string
+    :rtype: :py:class:`SiteKey`
     """
-    return _quantile_hazard_map_key(job_id, hash(site), poe, quantile)
+    return _site_key(job_id, QUANTILE_HAZARD_MAP_KEY_TOKEN, site,
+                     suffix=[str(poe), str(quantile)])
+
 
+def hazard_curve_poes_key(job_id, realization_num, site):
+    """ Result a hazard curve key (for a single site) """
 
-def quantile_hazard_map_key_template(job_id, poe, quantile):
-    """Return a template key used to store the interpolated IML (Intensity
-    Measure Level) used in quantile hazard maps for a single site.
+    return _site_key(job_id, HAZARD_CURVE_POES_KEY_TOKEN, site,
+                     prefix=[realization_num])
 
-    The template must be specialized before use with something similar to:
-    `template_key % hash(site)`
+
+def hazard_curve_sum_key(job_id, site):
+    """Return the key used to accumulate the running sum (and count) of the
+    hazard curves computed so far for a single site.
+
+    The sums are always stored under one key per site, whatever the
+    :py:func:`kvs_layout`.
 
     :param job_id: the id of the job.
     :type job_id: integer
-    :param poe: probability of exceedance used to compute the value.
-    :type poe: float
-    :param quantile: quantile used to compute the curve.
-    :type quantile: float
+    :param site: site where the curves are computed.
+    :type site: :py:class:`shapes.Site` object
     :returns: the key.
     :rtype: string
     """
-    return _quantile_hazard_map_key(job_id, '%s', poe, quantile)
+    return _generate_key(job_id, HAZARD_CURVE_SUM_KEY_TOKEN, hash(site))
 
 
-def _hazard_curve_poes_key(job_id, realization_num, site_fragment):
-    "Common code for the key functions below"
-    return _generate_key(job_id, HAZARD_CURVE_POES_KEY_TOKEN, realization_num,
-                         site_fragment)
-
-
-def hazard_curve_poes_key(job_id, realization_num, site):
-    """ Result a hazard curve key (for a single site) """
+def hazard_curve_samples_key(job_id, site):
+    """Return the key of the hash collecting the hazard curves computed so far
+    for a single site (one field per realization).
 
-    return _hazard_curve_poes_key(job_id, realization_num, hash(site))
+    Only the curves of the first
+    :py:data:`openquake.hazard.classical_psha.QUANTILE_SAMPLES` realizations
+    are kept: the hash is deleted when more are computed.
 
+    The samples are always stored under one key per site, whatever the
+    :py:func:`kvs_layout`.
 
-def hazard_curve_poes_key_template(job_id, realization_num):
-    """ Result a template for a hazard curve key (for a single site) """
-    return _hazard_curve_poes_key(job_id, realization_num, '%s')
+    :param job_id: the id of the job.
+    :type job_id: integer
+    :param site: site where the curves are computed.
+    :type site: :py:class:`shapes.Site` object
+    :returns: the key.
+    :rtype: string
+    """
+    return _generate_key(job_id, HAZARD_CURVE_SAMPLES_KEY_TOKEN, hash(site))
 
 
 def gmf_set_key(job_id, column, row):
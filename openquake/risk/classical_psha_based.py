@@ -22,17 +22,24 @@ This module defines functions to compute loss ratio curves
 using the classical psha based approach.
 """
 
+from collections import OrderedDict
+
 from scipy import sqrt, stats, log, exp
-from numpy import empty, linspace
-from numpy import array, concatenate
+from numpy import empty, linspace, newaxis
+from numpy import array, concatenate, dot
 from numpy import subtract, mean
 
 from openquake import shapes
 from openquake.risk.common import loop, collect
-from openquake.utils.general import MemoizeMutable
 
 STEPS_PER_INTERVAL = 5
 
+# the LREMs last used by this process (at most LREM_CACHE_SIZE, the least
+# recently used ones are evicted), keyed by the content hash of their
+# vulnerability function (see _compute_lrem())
+LREM_CACHE_SIZE = 100
+_LREM_CACHE = OrderedDict()
+
 
 def compute_loss_ratio_curve(vuln_function, hazard_curve):
     """Compute a loss ratio curve for a specific hazard curve (e.g., site),
@@ -41,7 +48,9 @@ def compute_loss_ratio_curve(vuln_function, hazard_curve):
     A loss ratio curve is a function that has loss ratios as X values
     and PoEs (Probabilities of Exceendance) as Y values.
 
-    This is the main (and only) public function of this module.
+    This is the main public function of this module, the assets sharing
+    the curve (same site and vulnerability function) are handled by
+    :py:func:`openquake.risk.common.compute_loss_curves`.
 
     :param vuln_function: the vulnerability function used
         to compute the curve.
@@ -51,9 +60,13 @@ def compute_loss_ratio_curve(vuln_function, hazard_curve):
     """
 
     lrem = _compute_lrem(vuln_function)
-    lrem_po = _compute_lrem_po(vuln_function, lrem, hazard_curve)
     loss_ratios = _generate_loss_ratios(vuln_function)
 
+    if hazard_curve:
+        pos = _convert_pes_to_pos(hazard_curve, _compute_imls(vuln_function))
+        return shapes.Curve(zip(loss_ratios, dot(lrem, pos)))
+
+    lrem_po = _compute_lrem_po(vuln_function, lrem, hazard_curve)
     return shapes.Curve(zip(loss_ratios, lrem_po.sum(axis=1)))
 
 
@@ -74,9 +87,7 @@ def _compute_lrem_po(vuln_function, lrem, hazard_curve):
     imls = _compute_imls(vuln_function)
 
     if hazard_curve:
-        pos = _convert_pes_to_pos(hazard_curve, imls)
-        for idx, po in enumerate(pos):
-            lrem_po[:, idx] = lrem[:, idx] * po
+        lrem_po[:] = lrem * _convert_pes_to_pos(hazard_curve, imls)
 
     return lrem_po
 
@@ -97,35 +108,45 @@ def _generate_loss_ratios(vuln_function):
     return _split_loss_ratios(loss_ratios)
 
 
-@MemoizeMutable
 def _compute_lrem(vuln_function, distribution=None):
     """Compute the LREM (Loss Ratio Exceedance Matrix).
 
+    The matrix is computed once per vulnerability function (and process),
+    the cached ones are looked up by
+    :py:attr:`openquake.shapes.VulnerabilityFunction.content_hash`. The
+    cached matrices are shared, hence read-only.
+
     :param vuln_function: the vulnerability function used
         to compute the LREM.
     :type vuln_function: :py:class:`openquake.shapes.VulnerabilityFunction`
     """
 
     if distribution is None:
-        # this is so we can memoize the thing
         distribution = stats.lognorm
 
-    loss_ratios = _generate_loss_ratios(vuln_function)
-    # LREM has number of rows equal to the number of loss ratios
-    # and number of columns equal to the number if imls
-    lrem = empty((loss_ratios.size, vuln_function.imls.size), float)
+    key = (vuln_function.content_hash, STEPS_PER_INTERVAL, distribution)
+
+    # (re)inserted last, as the most recently used
+    lrem = _LREM_CACHE.pop(key, None)
 
-    for idx, value in enumerate(vuln_function):
-        mean_val, cov = value[1:]
+    if lrem is None:
+        loss_ratios = _generate_loss_ratios(vuln_function)
+        mean_vals = vuln_function.loss_ratios
 
-        stddev = cov * mean_val
-        variance = stddev ** 2.0
-        mu = log(mean_val ** 2.0 / sqrt(variance + mean_val ** 2.0))
-        sigma = sqrt(log((variance / mean_val ** 2.0) + 1.0))
+        stddevs = vuln_function.covs * mean_vals
+        variances = stddevs ** 2.0
+        mus = log(mean_vals ** 2.0 / sqrt(variances + mean_vals ** 2.0))
+        sigmas = sqrt(log((variances / mean_vals ** 2.0) + 1.0))
 
-        for row, value in enumerate(lrem):
-            lrem[row][idx] = distribution.sf(loss_ratios[row],
-                    sigma, scale=exp(mu))
+        # LREM has number of rows equal to the number of loss ratios
+        # and number of columns equal to the number if imls
+        lrem = distribution.sf(loss_ratios[:, newaxis], sigmas, scale=exp(mus))
+        lrem.flags.writeable = False
+
+        if len(_LREM_CACHE) >= LREM_CACHE_SIZE:
+            _LREM_CACHE.popitem(last=False)
+
+    _LREM_CACHE[key] = lrem
 
     return lrem
 
@@ -206,5 +227,6 @@ def _convert_pes_to_pos(hazard_curve, imls):
     :type imls: :py:class:`list`
     """
 
-    return collect(loop(_compute_pes_from_imls(hazard_curve, imls),
-            lambda x, y: subtract(array(x), array(y))))
+    pes = array(_compute_pes_from_imls(hazard_curve, imls))
+
+    return subtract(pes[:-1], pes[1:])
@@ -25,7 +25,9 @@ This module defines functions that can be applied to loss ratio
 or loss curves.
 """
 
-from numpy import mean
+from itertools import izip
+
+from numpy import mean, outer
 
 from openquake import shapes
 
@@ -63,6 +65,60 @@ def compute_loss_curve(loss_ratio_curve, asset):
     return loss_ratio_curve.rescale_abscissae(asset)
 
 
+def compute_loss_curves(loss_ratio_curve, assets):
+    """Compute the loss curves for the given asset values at once, like
+    :py:func:`compute_loss_curve` does for a single value.
+
+    :param loss_ratio_curve: the loss ratio curve shared by the assets
+    :type loss_ratio_curve: :py:class:`openquake.shapes.Curve`
+    :param assets: the asset values
+    :type assets: list of floats
+    :returns: the loss curves, one per asset value
+    :rtype: list of :py:class:`openquake.shapes.Curve`
+    """
+
+    losses = outer([asset or 0.0 for asset in assets],
+                   loss_ratio_curve.x_values)
+    loss_curves = []
+
+    for asset, loss_values in izip(assets, losses):
+        if not asset:
+            loss_curves.append(shapes.EMPTY_CURVE)
+            continue
+
+        loss_curve = shapes.Curve(())
+        loss_curve.x_values = loss_values
+        loss_curve.y_values = loss_ratio_curve.y_values
+        loss_curves.append(loss_curve)
+
+    return loss_curves
+
+
+def group_by_vuln_function(assets):
+    """Group the given assets by vulnerability function reference.
+
+    :param assets: the assets
+    :type assets: list of :py:class:`dict` as provided by
+        :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+    :returns: pairs of (reference, list of assets), in the order of the
+        first asset with each reference
+    """
+
+    groups = {}
+    references = []
+
+    for asset in assets:
+        reference = asset["vulnerabilityFunctionReference"]
+
+        if reference not in groups:
+            groups[reference] = []
+            references.append(reference)
+
+        groups[reference].append(asset)
+
+    return [(reference, groups[reference]) for reference in references]
+
+
 def _compute_mid_mean_pe(loss_ratio_curve):
     """Compute a new loss ratio curve taking the mean values."""
 
@@ -20,8 +20,9 @@
 """ Mixin for Classical PSHA Risk Calculation """
 
 import geohash
+import numpy
 
-from celery.exceptions import TimeoutError
+from itertools import izip
 
 from openquake import kvs
 from openquake import logs
@@ -29,17 +30,24 @@ from openquake import logs
 from openquake.db.alchemy.db_utils import get_db_session
 from openquake.db.alchemy import models
 from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from openquake.parser import vulnerability
 from openquake.risk import classical_psha_based as cpsha_based
-from openquake.shapes import Curve
+from openquake.shapes import Curve, Site
 
-from openquake.risk.common import  compute_loss_curve
+from openquake.risk.common import  compute_loss_curve, compute_loss_curves
+from openquake.risk.common import group_by_vuln_function
 from openquake.risk.job import general
+from openquake.utils import tasks as utils_tasks
 
 
 LOGGER = logs.LOG
 
+# how much (in degrees) the bounding box of the sites whose hazard curves
+# are read is enlarged, to include the curves stored with rounded locations
+BOUNDING_BOX_MARGIN = 1e-6
+
 
 class ClassicalPSHABasedMixin:
     """Mixin for Classical PSHA Based Risk Job"""
@@ -52,39 +60,96 @@ class ClassicalPSHABasedMixin:
         for block_id in self.blocks_keys:
             LOGGER.debug("starting task block, block_id = %s of %s"
                         % (block_id, len(self.blocks_keys)))
-            celery_tasks.append(
-                general.compute_risk.delay(self.job_id, block_id))
+            celery_tasks.append((block_id, utils_tasks.submit(
+                general.compute_risk,
+                dict(job_id=self.job_id, block_id=block_id))))
 
         # task compute_risk has return value 'True' (writes its results to
-        # kvs).
-        for task in celery_tasks:
-            try:
-                # TODO(chris): Figure out where to put that timeout.
-                task.wait(timeout=None)
-            except TimeoutError:
-                # TODO(jmc): Cancel and respawn this task
-                return
+        # kvs). The tasks which fail or get lost are resubmitted.
+        for _ in utils_tasks.iter_results(celery_tasks):
+            pass
 
     def _get_db_curve(self, site):
         """Read hazard curve data from the DB"""
+        imls, poes = self._get_db_curves([site])
+
+        return Curve(zip(imls, poes[0]))
+
+    def _get_db_imls(self):
+        """Read the IMLs of the hazard curves from the DB, once per job"""
+        if getattr(self, "_hazard_imls", None) is None:
+            session = get_db_session("reslt", "reader")
+
+            iml_query = session.query(models.OqParams.imls) \
+                .join(models.OqJob) \
+                .filter(models.OqJob.id == self.job_id)
+
+            #pylint: disable=W0201
+            self._hazard_imls = numpy.array(iml_query.one().imls)
+
+        return self._hazard_imls
+
+    def _get_db_curves(self, sites):
+        """Read the mean hazard curves at the given sites from the DB, with
+        a single query
+
+        :param sites: the sites
+        :type sites: list of :py:class:`openquake.shapes.Site`
+        :returns: the IMLs and a matrix with the PoEs of the curve at
+            `sites[i]` in the row `i`
+        :rtype: a pair of :py:class:`numpy.ndarray`
+        """
+        imls = self._get_db_imls()
+        site_hashes = [geohash.encode(site.latitude, site.longitude,
+                                      precision=12) for site in sites]
+
+        if not site_hashes:
+            return imls, numpy.empty((0, len(imls)))
+
+        # the curves in the bounding box of the sites are selected (using
+        # the spatial index) and then matched to the sites here
+        bounding_box = sqlfunc.ST_MakeEnvelope(
+            min(site.longitude for site in sites) - BOUNDING_BOX_MARGIN,
+            min(site.latitude for site in sites) - BOUNDING_BOX_MARGIN,
+            max(site.longitude for site in sites) + BOUNDING_BOX_MARGIN,
+            max(site.latitude for site in sites) + BOUNDING_BOX_MARGIN,
+            4326)
+
         session = get_db_session("reslt", "reader")
+        location = models.HazardCurveData.location
 
-        iml_query = session.query(models.OqParams.imls) \
-            .join(models.OqJob) \
-            .filter(models.OqJob.id == self.job_id)
-        curve_query = session.query(models.HazardCurveData.poes) \
+        curve_query = session.query(sqlfunc.ST_X(location),
+                                    sqlfunc.ST_Y(location),
+                                    models.HazardCurveData.poes) \
             .join(models.HazardCurve) \
             .join(models.Output) \
             .filter(models.Output.oq_job_id == self.job_id) \
             .filter(models.HazardCurve.statistic_type == 'mean') \
-            .filter(sqlfunc.ST_GeoHash(models.HazardCurveData.location, 12)
-                        == geohash.encode(site.latitude, site.longitude,
-                                          precision=12))
+            .filter(sqlfunc.ST_Intersects(location, bounding_box))
+
+        wanted_hashes = set(site_hashes)
+        curves = {}
+
+        for longitude, latitude, poes in curve_query:
+            site_hash = geohash.encode(latitude, longitude, precision=12)
 
-        hc = curve_query.one()
-        pms = iml_query.one()
+            if site_hash not in wanted_hashes:
+                continue
 
-        return Curve(zip(pms.imls, hc.poes))
+            if site_hash in curves:
+                raise MultipleResultsFound(
+                    "More than one mean hazard curve for site %s"
+                    % Site(longitude, latitude))
+
+            curves[site_hash] = poes
+
+        for site, site_hash in izip(sites, site_hashes):
+            if site_hash not in curves:
+                raise NoResultFound(
+                    "No mean hazard curve for site %s" % site)
+
+        return imls, numpy.array(
+            [curves[site_hash] for site_hash in site_hashes])
 
     def compute_risk(self, block_id, **kwargs):  # pylint: disable=W0613
         """This task computes risk for a block of sites. It requires to have
@@ -97,23 +162,67 @@ class ClassicalPSHABasedMixin:
 
         block = general.Block.from_kvs(block_id)
 
-        #pylint: disable=W0201
-        self.vuln_curves = \
-                vulnerability.load_vuln_model_from_kvs(self.job_id)
+        # the model is loaded once per (cached) job
+        if getattr(self, "vuln_curves", None) is None:
+            #pylint: disable=W0201
+            self.vuln_curves = \
+                    vulnerability.load_vuln_model_from_kvs(self.job_id)
+
+        # the hazard curves of the whole block are read at once
+        points = list(block.grid(self.region))
+        imls, hazard_poes = self._get_db_curves(
+            [point.site for point in points])
+
+        # the loss results are not read back while the block is computed
+        with kvs.WriteBuffer() as writer:
+            for point, poes in izip(points, hazard_poes):
+                hazard_curve = Curve(zip(imls, poes))
+
+                asset_key = kvs.tokens.asset_key(self.job_id,
+                                point.row, point.column)
+                assets = kvs.get_list_json_decoded(asset_key)
+                for _, same_vuln_assets in group_by_vuln_function(assets):
+                    self.compute_loss_curves(
+                        point, same_vuln_assets, hazard_curve, writer=writer)
 
-        for point in block.grid(self.region):
-            hazard_curve = self._get_db_curve(point.site)
+        return True
+
+    def compute_loss_curves(self, point, assets, hazard_curve, writer=kvs):
+        """
+        Computes the loss ratio curve shared by the given assets once,
+        then their loss curves, and stores them with `writer` (the KVS or a
+        :py:class:`openquake.kvs.WriteBuffer`)
 
-            asset_key = kvs.tokens.asset_key(self.job_id,
-                            point.row, point.column)
-            for asset in kvs.get_list_json_decoded(asset_key):
-                LOGGER.debug("processing asset %s" % (asset))
-                loss_ratio_curve = self.compute_loss_ratio_curve(
-                    point, asset, hazard_curve)
+        :param point: the point of the grid we want to compute
+        :type point: :py:class:`openquake.shapes.GridPoint`
+        :param assets: the assets at the point with the same vulnerability
+            function
+        :type assets: list of :py:class:`dict` as provided by
+            :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
+        :param hazard_curve: the hazard curve at the point
+        :type hazard_curve: :py:class:`openquake.shapes.Curve`
+        """
 
-                self.compute_loss_curve(point, loss_ratio_curve, asset)
+        vuln_function = self._get_vuln_function(assets[0])
 
-        return True
+        if not vuln_function:
+            return
+
+        LOGGER.debug("processing assets %s" % (assets))
+        loss_ratio_curve = cpsha_based.compute_loss_ratio_curve(
+            vuln_function, hazard_curve)
+        loss_ratio_curve_json = loss_ratio_curve.to_json()
+
+        loss_curves = compute_loss_curves(
+            loss_ratio_curve, [asset['assetValue'] for asset in assets])
+
+        for asset, loss_curve in izip(assets, loss_curves):
+            writer.set(kvs.tokens.loss_ratio_key(
+                self.job_id, point.row, point.column, asset['assetID']),
+                loss_ratio_curve_json)
+            writer.set(kvs.tokens.loss_curve_key(
+                self.job_id, point.row, point.column, asset['assetID']),
+                loss_curve.to_json())
 
     def compute_loss_curve(self, point, loss_ratio_curve, asset):
         """
@@ -153,17 +262,9 @@ class ClassicalPSHABasedMixin:
         """
 
         # we get the vulnerability function related to the asset
-
-        vuln_function_reference = asset["vulnerabilityFunctionReference"]
-        vuln_function = self.vuln_curves.get(
-            vuln_function_reference, None)
+        vuln_function = self._get_vuln_function(asset)
 
         if not vuln_function:
-            LOGGER.error(
-                "Unknown vulnerability function %s for asset %s"
-                % (asset["vulnerabilityFunctionReference"],
-                asset["assetID"]))
-
             return None
 
         loss_ratio_curve = cpsha_based.compute_loss_ratio_curve(
@@ -176,4 +277,20 @@ class ClassicalPSHABasedMixin:
 
         return loss_ratio_curve
 
+    def _get_vuln_function(self, asset):
+        """The vulnerability function of the given asset, `None` (and an
+        error is logged) if it is unknown."""
+
+        vuln_function = self.vuln_curves.get(
+            asset["vulnerabilityFunctionReference"], None)
+
+        if not vuln_function:
+            LOGGER.error(
+                "Unknown vulnerability function %s for asset %s"
+                % (asset["vulnerabilityFunctionReference"],
+                asset["assetID"]))
+
+        return vuln_function
+
+
 general.RiskJobMixin.register("Classical", ClassicalPSHABasedMixin)
@@ -33,6 +33,7 @@ from openquake.output import risk as risk_output
 from openquake.parser import vulnerability
 from openquake.risk import deterministic_event_based as det
 from openquake.risk.job import general
+from openquake.utils import tasks as utils_tasks
 
 
 LOGGER = logs.LOG
@@ -67,17 +68,14 @@ class DeterministicEventBasedMixin:
         for block_id in self.blocks_keys:
             LOGGER.debug("Dispatching task for block %s of %s"
                 % (block_id, len(self.blocks_keys)))
-            a_task = general.compute_risk.delay(
-                self.job_id, block_id, vuln_model=vuln_model,
-                epsilon_provider=epsilon_provider)
-            tasks.append(a_task)
-
-        for task in tasks:
-            task.wait()
-            if not task.successful():
-                raise Exception(task.result)
-
-            block_loss, block_loss_map_data = task.result
+            a_task = utils_tasks.submit(general.compute_risk, dict(
+                job_id=self.job_id, block_id=block_id, vuln_model=vuln_model,
+                epsilon_provider=epsilon_provider))
+            tasks.append((block_id, a_task))
+
+        # the tasks which fail or get lost are resubmitted
+        for _, (block_loss, block_loss_map_data) in \
+                utils_tasks.iter_results(tasks):
 
             # do some basic validation on our results
             assert block_loss is not None, "Expected a result != None"
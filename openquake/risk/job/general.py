@@ -20,6 +20,7 @@
 
 from collections import defaultdict
 import json
+import numpy
 import os
 
 from scipy.stats import norm
@@ -117,7 +118,7 @@ def _plot(curve_path, result_path, **kwargs):
 def compute_risk(job_id, block_id, **kwargs):
     """ A task for computing risk, calls the mixed in compute_risk method """
     check_job_status(job_id)
-    engine = job.Job.from_kvs(job_id)
+    engine = job.Job.cached(job_id)
     with mixins.Mixin(engine, RiskJobMixin) as mixed:
         return mixed.compute_risk(block_id, **kwargs)
 
@@ -180,16 +181,19 @@ class RiskJobMixin(mixins.Mixin):
         exposure_parser = exposure.ExposurePortfolioFile("%s/%s" %
             (self.base_path, self.params[job_config.EXPOSURE]))
 
-        for site, asset in exposure_parser.filter(self.region):
+        encoder = json.JSONEncoder()
+
+        with kvs.WriteBuffer() as writer:
+            for site, asset in exposure_parser.filter(self.region):
 # TODO(ac): This is kludgey (?)
-            asset["lat"] = site.latitude
-            asset["lon"] = site.longitude
-            gridpoint = self.region.grid.point_at(site)
+                asset["lat"] = site.latitude
+                asset["lon"] = site.longitude
+                gridpoint = self.region.grid.point_at(site)
 
-            asset_key = kvs.tokens.asset_key(
-                self.job_id, gridpoint.row, gridpoint.column)
+                asset_key = kvs.tokens.asset_key(
+                    self.job_id, gridpoint.row, gridpoint.column)
 
-            kvs.get_client().rpush(asset_key, json.JSONEncoder().encode(asset))
+                writer.rpush(asset_key, encoder.encode(asset))
 
     def store_vulnerability_model(self):
         """ load vulnerability and write to kvs """
@@ -374,6 +378,25 @@ class EpsilonProvider(object):
                 samples[category] = norm.rvs(loc=0, scale=1)
             return samples[category]
 
+    def epsilons(self, asset, count):
+        """Sample `count` values from the standard normal distribution for
+        the given asset, with a single call.
+
+        The values are the ones `count` calls of :py:meth:`epsilon` would
+        return: the same random numbers are drawn for uncorrelated jobs,
+        the sample of the building typology is repeated for correlated ones.
+
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        if not count:
+            return numpy.array([])
+
+        correlation = getattr(self, "ASSET_CORRELATION", None)
+        if not correlation:
+            return norm.rvs(loc=0, scale=1, size=count)
+
+        return numpy.repeat(self.epsilon(asset), count)
+
 
 mixins.Mixin.register("Risk", RiskJobMixin, order=2)
 
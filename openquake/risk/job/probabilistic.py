@@ -25,8 +25,6 @@ compute_risk task
 
 from numpy import zeros
 
-from celery.exceptions import TimeoutError
-
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
@@ -37,6 +35,7 @@ from openquake.parser import vulnerability
 
 from openquake.risk.job import aggregate_loss_curve
 from openquake.risk.job import general
+from openquake.utils import tasks as utils_tasks
 
 from openquake.db.alchemy.db_utils import get_db_session
 from openquake.db.alchemy import models
@@ -63,17 +62,14 @@ class ProbabilisticEventMixin():
         for block_id in self.blocks_keys:
             LOGGER.debug("starting task block, block_id = %s of %s"
                         % (block_id, len(self.blocks_keys)))
-            tasks.append(general.compute_risk.delay(self.job_id, block_id))
+            tasks.append((block_id, utils_tasks.submit(
+                general.compute_risk,
+                dict(job_id=self.job_id, block_id=block_id))))
 
         # task compute_risk has return value 'True' (writes its results to
-        # kvs)
-        for task in tasks:
-            try:
-                # TODO(chris): Figure out where to put that timeout.
-                task.wait(timeout=None)
-            except TimeoutError:
-                # TODO(jmc): Cancel and respawn this task
-                return
+        # kvs). The tasks which fail or get lost are resubmitted.
+        for _ in utils_tasks.iter_results(tasks):
+            pass
 
         # the aggregation must be computed after the slicing
         # of the gmfs has been completed
@@ -166,15 +162,16 @@ class ProbabilisticEventMixin():
 
         gmfs = self._get_db_gmfs(block.sites, self.job_id)
 
-        for key, gmf_slice in gmfs.items():
-            (row, col) = key.split("!")
-            key_gmf = kvs.tokens.gmf_set_key(self.job_id, col, row)
-            LOGGER.debug("GMF_SLICE for %s X %s : \n\t%s" % (
-                    col, row, gmf_slice))
-            timespan = float(self['INVESTIGATION_TIME'])
-            gmf = {"IMLs": gmf_slice, "TSES": num_ses * timespan,
-                    "TimeSpan": timespan}
-            kvs.set_value_json_encoded(key_gmf, gmf)
+        with kvs.WriteBuffer() as writer:
+            for key, gmf_slice in gmfs.items():
+                (row, col) = key.split("!")
+                key_gmf = kvs.tokens.gmf_set_key(self.job_id, col, row)
+                LOGGER.debug("GMF_SLICE for %s X %s : \n\t%s" % (
+                        col, row, gmf_slice))
+                timespan = float(self['INVESTIGATION_TIME'])
+                gmf = {"IMLs": gmf_slice, "TSES": num_ses * timespan,
+                        "TimeSpan": timespan}
+                writer.set_value_json_encoded(key_gmf, gmf)
 
     def compute_risk(self, block_id, **kwargs):  # pylint: disable=W0613
         """This task computes risk for a block of sites. It requires to have
@@ -193,39 +190,48 @@ class ProbabilisticEventMixin():
                     'CONDITIONAL_LOSS_POE', "0.01").split()]
         self.slice_gmfs(block_id)
 
-        #pylint: disable=W0201
-        self.vuln_curves = \
-                vulnerability.load_vuln_model_from_kvs(self.job_id)
+        # the model is loaded once per (cached) job
+        if getattr(self, "vuln_curves", None) is None:
+            #pylint: disable=W0201
+            self.vuln_curves = \
+                    vulnerability.load_vuln_model_from_kvs(self.job_id)
 
         # TODO(jmc): DONT assumes that hazard and risk grid are the same
         block = general.Block.from_kvs(block_id)
 
-        for point in block.grid(self.region):
-            key = kvs.tokens.gmf_set_key(self.job_id, point.column, point.row)
-            gmf_slice = kvs.get_value_json_decoded(key)
-
-            asset_key = kvs.tokens.asset_key(
-                self.job_id, point.row, point.column)
-            for asset in kvs.get_list_json_decoded(asset_key):
-                LOGGER.debug("processing asset %s" % (asset))
-                loss_ratio_curve = self.compute_loss_ratio_curve(
-                        point.column, point.row, asset, gmf_slice)
-                if loss_ratio_curve is not None:
-
-                    # compute loss curve
-                    loss_curve = self.compute_loss_curve(
-                            point.column, point.row,
-                            loss_ratio_curve, asset)
-
-                    for loss_poe in conditional_loss_poes:
-                        self.compute_conditional_loss(point.column, point.row,
-                                loss_curve, asset, loss_poe)
+        # the loss results are not read back while the block is computed
+        with kvs.WriteBuffer() as writer:
+            for point in block.grid(self.region):
+                key = kvs.tokens.gmf_set_key(
+                    self.job_id, point.column, point.row)
+                gmf_slice = kvs.get_value_json_decoded(key)
+
+                asset_key = kvs.tokens.asset_key(
+                    self.job_id, point.row, point.column)
+                for asset in kvs.get_list_json_decoded(asset_key):
+                    LOGGER.debug("processing asset %s" % (asset))
+                    loss_ratio_curve = self.compute_loss_ratio_curve(
+                            point.column, point.row, asset, gmf_slice,
+                            writer=writer)
+                    if loss_ratio_curve is not None:
+
+                        # compute loss curve
+                        loss_curve = self.compute_loss_curve(
+                                point.column, point.row,
+                                loss_ratio_curve, asset, writer=writer)
+
+                        for loss_poe in conditional_loss_poes:
+                            self.compute_conditional_loss(
+                                point.column, point.row, loss_curve, asset,
+                                loss_poe, writer=writer)
 
         return True
 
-    def compute_conditional_loss(self, col, row, loss_curve, asset, loss_poe):
+    def compute_conditional_loss(self, col, row, loss_curve, asset, loss_poe,
+                                 writer=kvs):
         """ Compute the conditional loss for a loss curve and probability of
-        exceedance """
+        exceedance. The result is stored with `writer` (the KVS or a
+        :py:class:`openquake.kvs.WriteBuffer`). """
 
         loss_conditional = common.compute_conditional_loss(
                 loss_curve, loss_poe)
@@ -235,10 +241,12 @@ class ProbabilisticEventMixin():
 
         LOGGER.debug("RESULT: conditional loss is %s, write to key %s" % (
             loss_conditional, key))
-        kvs.set(key, loss_conditional)
+        writer.set(key, loss_conditional)
 
-    def compute_loss_ratio_curve(self, col, row, asset, gmf_slice):
-        """Compute the loss ratio curve for a single site."""
+    def compute_loss_ratio_curve(self, col, row, asset, gmf_slice,
+                                 writer=kvs):
+        """Compute the loss ratio curve for a single site and store it with
+        `writer` (the KVS or a :py:class:`openquake.kvs.WriteBuffer`)."""
 
         # fail if the asset has an unknown vulnerability code
         vuln_function = self.vuln_curves.get(
@@ -262,7 +270,7 @@ class ProbabilisticEventMixin():
 
         key = kvs.tokens.loss_ratio_key(
             self.job_id, row, col, asset["assetID"])
-        kvs.set(key, loss_ratio_curve.to_json())
+        writer.set(key, loss_ratio_curve.to_json())
 
         LOGGER.warn("RESULT: loss ratio curve is %s, write to key %s" % (
                 loss_ratio_curve, key))
@@ -289,8 +297,10 @@ class ProbabilisticEventMixin():
 
         return number_of_samples
 
-    def compute_loss_curve(self, column, row, loss_ratio_curve, asset):
-        """Compute the loss curve for a single site."""
+    def compute_loss_curve(self, column, row, loss_ratio_curve, asset,
+                           writer=kvs):
+        """Compute the loss curve for a single site and store it with
+        `writer` (the KVS or a :py:class:`openquake.kvs.WriteBuffer`)."""
         if asset is None:
             return None
 
@@ -300,7 +310,7 @@ class ProbabilisticEventMixin():
 
         LOGGER.warn("RESULT: loss curve is %s, write to key %s" % (
                 loss_curve, key))
-        kvs.set(key, loss_curve.to_json())
+        writer.set(key, loss_curve.to_json())
         return loss_curve
 
 
@@ -28,11 +28,12 @@ import math
 
 from numpy import zeros, array, linspace
 from numpy import histogram, where, mean
+from numpy import exp, log, sqrt
 
 from openquake import kvs, shapes
 from openquake.parser import vulnerability
 from openquake.logs import LOG
-from openquake.risk.common import collect, loop
+from openquake.risk.common import collect, loop, group_by_vuln_function
 
 DEFAULT_NUMBER_OF_SAMPLES = 25
 
@@ -91,32 +92,45 @@ def _sampled_based(vuln_function, ground_motion_field_set,
     :param epsilon_provider: service used to get the epsilon when
         using the sampled based algorithm.
     :type epsilon_provider: object that defines an :py:meth:`epsilon` method
+        (and possibly an :py:meth:`epsilons` method, see
+        :py:func:`_sample_epsilons`)
     :param asset: the asset used to compute the loss ratios.
     :type asset: :py:class:`dict` as provided by
         :py:class:`openquake.parser.exposure.ExposurePortfolioFile`
     """
 
-    loss_ratios = []
-
     means = vuln_function.loss_ratio_for(ground_motion_field_set["IMLs"])
     covs = vuln_function.cov_for(ground_motion_field_set["IMLs"])
 
-    for mean_ratio, cov in zip(means, covs):
-        if mean_ratio <= 0.0:
-            loss_ratios.append(0.0)
-        else:
-            variance = (mean_ratio * cov) ** 2.0
+    # the loss ratio is zero (and no epsilon is drawn) where the
+    # mean loss ratio is zero
+    loss_ratios = zeros(means.shape)
+    sampled = means > 0.0
+    means, covs = means[sampled], covs[sampled]
 
-            epsilon = epsilon_provider.epsilon(asset)
-            sigma = math.sqrt(
-                        math.log((variance / mean_ratio ** 2.0) + 1.0))
+    variances = (means * covs) ** 2.0
+    epsilons = _sample_epsilons(epsilon_provider, asset, means.size)
+    sigmas = sqrt(log((variances / means ** 2.0) + 1.0))
+    mus = log(means ** 2.0 / sqrt(variances + means ** 2.0))
 
-            mu = math.log(mean_ratio ** 2.0 / math.sqrt(
-                    variance + mean_ratio ** 2.0))
+    loss_ratios[sampled] = exp(mus + (epsilons * sigmas))
 
-            loss_ratios.append(math.exp(mu + (epsilon * sigma)))
+    return loss_ratios
 
-    return array(loss_ratios)
+
+def _sample_epsilons(epsilon_provider, asset, count):
+    """Draw `count` epsilons for the given asset.
+
+    They are drawn with a single call if the provider has an
+    `epsilons(asset, count)` method (e.g.
+    :py:class:`openquake.risk.job.general.EpsilonProvider`), else with
+    `count` calls of its `epsilon(asset)` method.
+    """
+
+    if hasattr(epsilon_provider, "epsilons"):
+        return epsilon_provider.epsilons(asset, count)
+
+    return array([epsilon_provider.epsilon(asset) for _ in xrange(count)])
 
 
 def _mean_based(vuln_function, ground_motion_field_set):
@@ -286,7 +300,11 @@ def _assets_keys_for_gmfs(job_id, gmfs_key):
 
 
 class AggregateLossCurve(object):
-    """Aggregate a set of losses and produce the resulting loss curve."""
+    """Aggregate a set of losses and produce the resulting loss curve.
+
+    Only the running sum of the losses of each event is kept, the memory
+    used does not depend on the number of assets.
+    """
 
     @staticmethod
     def from_kvs(job_id, epsilon_provider):
@@ -296,29 +314,31 @@ class AggregateLossCurve(object):
         vuln_model = vulnerability.load_vuln_model_from_kvs(job_id)
         aggregate_curve = AggregateLossCurve(vuln_model, epsilon_provider)
 
-        gmfs_keys = kvs.get_keys("%s*%s*" % (
-                kvs.tokens.generate_job_key(job_id), kvs.tokens.GMF_KEY_TOKEN))
+        gmfs_keys = kvs.job_keys(job_id, kvs.tokens.GMF_KEY_TOKEN)
 
         LOG.debug("Found %s stored GMFs..." % len(gmfs_keys))
         asset_counter = 0
 
-        for gmfs_key in gmfs_keys:
-            assets = _assets_keys_for_gmfs(job_id, gmfs_key)
+        decoder = json.JSONDecoder()
 
-            for asset in assets:
-                asset_counter += 1
-                gmfs = kvs.get_value_json_decoded(gmfs_key)
+        for gmfs_key in gmfs_keys:
+            assets = [decoder.decode(asset) for asset in
+                      _assets_keys_for_gmfs(job_id, gmfs_key)]
 
-                aggregate_curve.append(gmfs,
-                        json.JSONDecoder().decode(asset))
+            if assets:
+                asset_counter += len(assets)
+                aggregate_curve.append_assets(
+                    kvs.get_value_json_decoded(gmfs_key), assets)
 
         LOG.debug("Found %s stored assets..." % asset_counter)
         return aggregate_curve
 
     def __init__(self, vuln_model, epsilon_provider):
         self._tses = self._time_span = self._gmfs_length = None
+        self._losses = None
 
-        self.distribution = []
+        # the number of assets whose losses were added
+        self.number_of_assets = 0
         self.vuln_model = vuln_model
         self.epsilon_provider = epsilon_provider
 
@@ -326,6 +346,18 @@ class AggregateLossCurve(object):
         """Add the losses distribution identified by the given GMFs
         and asset to the set used to compute the aggregate curve."""
 
+        self.append_assets(gmfs, [asset])
+
+    def append_assets(self, gmfs, assets):
+        """Add the losses distributions of the given assets, that share the
+        given GMFs (i.e. they are at the same site), to the set used to
+        compute the aggregate curve.
+
+        The loss ratios of the assets with the same vulnerability function
+        are computed once if its CVs (Coefficent of Variation) are all zero,
+        and scaled by the sum of the asset values.
+        """
+
         if self.empty:
             self._initialize_parameters(gmfs)
 
@@ -333,17 +365,39 @@ class AggregateLossCurve(object):
         assert gmfs["TSES"] == self._tses
         assert len(gmfs["IMLs"]) == self._gmfs_length
 
-        if asset["vulnerabilityFunctionReference"] in self.vuln_model:
-            loss_ratios = compute_loss_ratios(self.vuln_model[
-                    asset["vulnerabilityFunctionReference"]], gmfs,
-                    self.epsilon_provider, asset)
-
-            self.distribution.append(loss_ratios * asset["assetValue"])
+        for reference, same_vuln_assets in group_by_vuln_function(assets):
+            if reference not in self.vuln_model:
+                for asset in same_vuln_assets:
+                    LOG.debug("Unknown vulnerability function %s, asset %s "
+                            "will not be included in the aggregate "
+                            "computation" % (reference, asset["assetID"]))
+                continue
+
+            vuln_function = self.vuln_model[reference]
+
+            if (vuln_function.covs <= 0.0).all():
+                # the loss ratios do not depend on the asset
+                loss_ratios = compute_loss_ratios(vuln_function, gmfs,
+                        self.epsilon_provider, same_vuln_assets[0])
+                self._add_losses(loss_ratios * sum(
+                        asset["assetValue"] for asset in same_vuln_assets),
+                        len(same_vuln_assets))
+            else:
+                for asset in same_vuln_assets:
+                    loss_ratios = compute_loss_ratios(vuln_function, gmfs,
+                            self.epsilon_provider, asset)
+                    self._add_losses(loss_ratios * asset["assetValue"], 1)
+
+    def _add_losses(self, losses, number_of_assets):
+        """Add the given losses (of the given number of assets) to the
+        per event sums."""
+
+        if self._losses is None:
+            self._losses = array(losses, dtype=float)
         else:
-            LOG.debug("Unknown vulnerability function %s, asset %s will " \
-                    "not be included in the aggregate computation"
-                    % (asset["vulnerabilityFunctionReference"],
-                    asset["assetID"]))
+            self._losses += losses
+
+        self.number_of_assets += number_of_assets
 
     def _initialize_parameters(self, gmfs):
         """Initialize the GMFs parameters."""
@@ -355,15 +409,15 @@ class AggregateLossCurve(object):
     def empty(self):
         """Return true is this aggregate curve has no losses
         associated, false otherwise."""
-        return len(self.distribution) == 0
+        return self.number_of_assets == 0
 
     @property
     def losses(self):
         """Return the losses used to compute the aggregate curve."""
         if self.empty:
             return array([])
-        else:  # if needed because numpy returns a scalar if the list is empty
-            return array(self.distribution).sum(axis=0)
+        else:
+            return self._losses
 
     def compute(self, number_of_samples=None):
         """Compute the aggregate loss curve."""
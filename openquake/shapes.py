@@ -20,6 +20,7 @@
 
 """Collection of base classes for processing spatially-related data."""
 
+import hashlib
 import json
 import math
 import numpy
@@ -647,6 +648,7 @@ class VulnerabilityFunction(object):
         self._imls = imls
         self._loss_ratios = loss_ratios
         self._covs = covs
+        self._content_hash = None
 
         # Check for proper IML ordering:
         assert self._imls == sorted(set(self._imls)), \
@@ -701,6 +703,21 @@ class VulnerabilityFunction(object):
         """
         return numpy.array(self._covs)
 
+    @property
+    def content_hash(self):
+        """
+        A hash of the IML, loss ratio and CoV values, computed once.
+
+        Functions with the same values have the same hash, it is used to
+        cache what is computed for a function.
+        """
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha1(numpy.array(
+                [self._imls, self._loss_ratios, self._covs],
+                dtype=float).tostring()).hexdigest()
+
+        return self._content_hash
+
     @property
     def is_empty(self):
         """
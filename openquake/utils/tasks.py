@@ -25,9 +25,38 @@ Utility functions related to splitting work into tasks.
 import itertools
 import time
 
-from celery.task.sets import TaskSet
+from celery.exceptions import TimeoutError
+from celery.signals import task_postrun
+from celery.task.control import inspect, revoke
 
+from openquake import kvs
 from openquake.job import Job
+from openquake.logs import LOG
+from openquake.utils import config
+
+
+STATIC_SCHEDULING = "static"
+ADAPTIVE_SCHEDULING = "adaptive"
+
+# adaptive scheduling: the data is initially split into this many chunks
+# per task, then the chunks are sized to take `target_chunk_duration`
+# seconds each
+INITIAL_CHUNKS_PER_TASK = 4
+DEFAULT_TARGET_CHUNK_DURATION = 10.0
+
+# failed or lost tasks are resubmitted at most this many times, waiting
+# `retry_delay` seconds before the first retry and twice as long before
+# each of the following ones
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+
+# wait_for_any() checks all the pending tasks when none of them signalled
+# its completion within this many seconds
+DEFAULT_CHECK_INTERVAL = 1
+
+# the completion lists of the tasks nobody waits for expire after this many
+# seconds
+TASK_DONE_TTL = 24 * 3600
 
 
 class WrongTaskParameters(Exception):
@@ -64,47 +93,208 @@ def distribute(cardinality, the_task, (name, data), other_args=None,
     :raises WrongTaskParameters: When a task receives a parameter it does not
         know.
     :raises TaskFailed: When at least one subtask fails (raises an exception).
+
+    When the `scheduling` setting of the `tasks` section in openquake.cfg is
+    'adaptive', the data is processed by :py:func:`distribute_adaptively`
+    instead (the returned list then has one element per chunk).
     """
-    # Too many local variables (18/15)
-    # pylint: disable=R0914
+    if scheduling() == ADAPTIVE_SCHEDULING:
+        return distribute_adaptively(cardinality, the_task, (name, data),
+                                     other_args, flatten_results)
 
-    def kwargs(data_portion):
-        """
-        Construct the full set of keyword parameters for the task to be
-        invoked.
-        """
-        params = {name: data_portion}
-        if other_args:
-            params.update(other_args)
-        return params
+    subtasks = _subtasks(cardinality, the_task, name, data, other_args)
 
-    subtasks = []
+    # At this point we have created all the subtasks and each one got a
+    # portion of the data that is to be processed. Now we will create and run
+    # the task set.
+    the_results = _handle_subtasks(subtasks, flatten_results)
+    return the_results
+
+
+def iter_distribute(cardinality, the_task, (name, data), other_args=None):
+    """Runs `the_task` in a task set with the given `cardinality`, like
+    :py:func:`distribute`, but yields the results as soon as the subtasks
+    finish instead of waiting for all of them.
+
+    The results are not accumulated, so the caller can process (e.g. store)
+    and drop each of them while the rest of the subtasks are still running.
+
+    :param int cardinality: The size of the task set.
+    :param the_task: A `celery` task callable.
+    :param str name: The parameter name under which the portioned `data` is to
+        be passed to `the_task`.
+    :param data: The `data` that is to be portioned and passed to the subtasks
+        for processing.
+    :param dict other_args: The remaining (keyword) parameters that are to be
+        passed to the subtasks.
+    :returns: An iterator of (subtask index, result) pairs, in the order the
+        subtasks finish.
+    :raises WrongTaskParameters: When a task receives a parameter it does not
+        know.
+    :raises TaskFailed: When at least one subtask fails (raises an exception).
+    """
+    return _iter_subtask_results(
+        _subtasks(cardinality, the_task, name, data, other_args))
+
+
+def scheduling():
+    """
+    Return how :py:func:`distribute` schedules the subtasks, as configured
+    in the `scheduling` setting of the `tasks` section in openquake.cfg:
+        * 'static': the data is split in `cardinality` equal portions
+        * 'adaptive': see :py:func:`distribute_adaptively`
+    """
+    return config.get("tasks", "scheduling") or STATIC_SCHEDULING
+
+
+def distribute_adaptively(cardinality, the_task, (name, data),
+                          other_args=None, flatten_results=False,
+                          target_chunk_duration=None):
+    """Runs `the_task` on many small chunks of `data`, keeping (at most)
+    `cardinality` subtasks running at any time.
+
+    A new chunk is submitted as soon as a subtask finishes, so that fast
+    workers take over the work slow ones would otherwise queue up. The
+    chunks are sized from the throughput measured so far in order to take
+    about `target_chunk_duration` seconds each, and never more than an
+    even share of the remaining data, so that the last chunks are small
+    and the job does not wait for a single slow subtask.
+
+    :param int cardinality: The maximum number of running subtasks.
+    :param the_task: A `celery` task callable.
+    :param str name: The parameter name under which the chunks of `data` are
+        to be passed to `the_task`.
+    :param data: The `data` that is to be chunked and passed to the subtasks
+        for processing.
+    :param dict other_args: The remaining (keyword) parameters that are to be
+        passed to the subtasks.
+    :param bool flatten_results: If set, the results will be returned as a
+        single list (as opposed to [[results1], [results2], ..]).
+    :param float target_chunk_duration: The time (in seconds) each chunk
+        should take, the `target_chunk_duration` setting of the `tasks`
+        section in openquake.cfg by default.
+    :returns: A list where each element is a result returned by a subtask.
+        The result order is the same as the data order.
+    :raises WrongTaskParameters: When a task receives a parameter it does not
+        know.
+    :raises TaskFailed: When at least one subtask fails (raises an exception).
+    """
+    if target_chunk_duration is None:
+        target_chunk_duration = float(
+            config.get("tasks", "target_chunk_duration")
+            or DEFAULT_TARGET_CHUNK_DURATION)
+
+    cardinality = max(cardinality, 1)
+    data_length = len(data)
+    chunk_size = max(
+        data_length // (cardinality * INITIAL_CHUNKS_PER_TASK), 1)
+
+    # processed items per second, measured on the finished chunks (each
+    # from its submission until it is seen finished)
+    items, seconds = 0, 0.0
+
+    results = {}
+    running = []
+    start = 0
+
+    while start < data_length or running or not results:
+        while len(running) < cardinality and (
+            start < data_length or not (results or running)):
+
+            if seconds > 0:
+                chunk_size = int(items / seconds * target_chunk_duration)
+
+            remaining = data_length - start
+            chunk_size = max(min(chunk_size, remaining // cardinality), 1)
+
+            kwargs = _task_kwargs(
+                name, data[start:start + chunk_size], other_args)
+
+            running.append(((start, min(chunk_size, remaining), time.time()),
+                            submit(the_task, kwargs)))
+            start += chunk_size
+
+        # a new chunk is submitted as soon as any running one finishes
+        for chunk, value in wait_for_any(running):
+            chunk_start, chunk_length, started = chunk
+            results[chunk_start] = value
+
+            items += chunk_length
+            seconds += time.time() - started
+
+    the_results = [results[key] for key in sorted(results)]
+
+    if flatten_results and the_results:
+        the_results = list(itertools.chain(*the_results))
+
+    return the_results
+
+
+def worker_pool_size():
+    """Return the total number of processes in the pools of the running
+    `celery` workers.
+
+    :returns: the number of worker processes or `None` if no worker replied
+    """
+    try:
+        stats = inspect().stats()
+    except IOError:
+        return None
+
+    if not stats:
+        return None
+
+    size = sum(worker.get("pool", {}).get("max-concurrency", 0)
+               for worker in stats.itervalues())
+    return size or None
+
+
+def _task_kwargs(name, data_portion, other_args):
+    """
+    Construct the full set of keyword parameters for the task to be
+    invoked.
+    """
+    params = {name: data_portion}
+    if other_args:
+        params.update(other_args)
+    return params
+
+
+def _subtasks(cardinality, the_task, name, data, other_args):
+    """Create `cardinality` subtasks of `the_task`, each receiving a portion
+    of `data` (see :py:func:`distribute`)."""
+    return [the_task.subtask(**_task_kwargs(name, data_portion, other_args))
+            for data_portion in portions(data, cardinality)]
+
+
+def portions(data, cardinality):
+    """Split `data` in (at most) `cardinality` portions of the same size,
+    the last portion takes the rest of the data.
+
+    :param data: The data to split.
+    :param int cardinality: The number of portions.
+    :returns: A list of portions, with at least one (possibly empty) portion
+        even when `data` is empty.
+    """
+    the_portions = []
 
     data_length = len(data)
     start = 0
     end = chunk_size = int(data_length / float(cardinality))
     if chunk_size == 0:
-        # We were given less data items than the number of subtasks specified.
-        # Spawn at least on subtask even if the data to be processed is empty.
+        # We were given less data items than the number of portions specified.
+        # Return at least one portion even if the data is empty.
         cardinality = data_length if data_length > 0 else 1
         end = chunk_size = 1
 
     for _ in xrange(cardinality - 1):
-        data_portion = data[start:end]
-        subtask = the_task.subtask(**kwargs(data_portion))
-        subtasks.append(subtask)
+        the_portions.append(data[start:end])
         start = end
         end += chunk_size
-    # The last subtask takes the rest of the data.
-    data_portion = data[start:]
-    subtask = the_task.subtask(**kwargs(data_portion))
-    subtasks.append(subtask)
+    # The last portion takes the rest of the data.
+    the_portions.append(data[start:])
 
-    # At this point we have created all the subtasks and each one got a
-    # portion of the data that is to be processed. Now we will create and run
-    # the task set.
-    the_results = _handle_subtasks(subtasks, flatten_results)
-    return the_results
+    return the_portions
 
 
 def parallelize(
@@ -143,7 +333,7 @@ def parallelize(
 
 
 def _handle_subtasks(subtasks, flatten_results):
-    """Start a `TaskSet` with the given `subtasks` and wait for it to finish.
+    """Start the given `subtasks` and wait for them to finish.
 
     :param subtasks: The subtasks to run
     :type subtasks: [celery_subtask]
@@ -155,18 +345,10 @@ def _handle_subtasks(subtasks, flatten_results):
         know.
     :raises TaskFailed: When at least one subtask fails (raises an exception).
     """
-    result = TaskSet(tasks=subtasks).apply_async()
+    the_results = [None] * len(subtasks)
 
-    # Wait for all subtasks to complete.
-    while not result.ready():
-        time.sleep(0.25)
-    try:
-        the_results = result.join()
-    except TypeError, exc:
-        raise WrongTaskParameters(exc.args[0])
-    except Exception, exc:
-        # At least one subtask failed.
-        raise TaskFailed(exc.args[0])
+    for index, result in _iter_subtask_results(subtasks):
+        the_results[index] = result
 
     if flatten_results:
         if the_results:
@@ -176,6 +358,295 @@ def _handle_subtasks(subtasks, flatten_results):
     return the_results
 
 
+def _iter_subtask_results(subtasks):
+    """Start the given `subtasks` and yield their results as they finish.
+
+    The subtasks which fail or get lost are resubmitted, see
+    :py:class:`RetriedTask`.
+
+    :param subtasks: The subtasks to run
+    :type subtasks: [celery_subtask]
+    :returns: An iterator of (subtask index, result) pairs, in the order the
+        subtasks finish.
+    :raises WrongTaskParameters: When a task receives a parameter it does not
+        know.
+    :raises TaskFailed: When at least one subtask fails (raises an exception).
+    """
+    return iter_results([(index, RetriedTask(subtask.apply_async))
+                         for index, subtask in enumerate(subtasks)])
+
+
+def submit(the_task, kwargs):
+    """Submit `the_task` with the given keyword parameters, it is
+    resubmitted when it fails or gets lost (see :py:class:`RetriedTask`).
+
+    :param the_task: A `celery` task callable.
+    :param dict kwargs: The (keyword) parameters of the task.
+    :returns: the submitted task
+    :rtype: :py:class:`RetriedTask`
+    """
+    return RetriedTask(lambda: the_task.apply_async(kwargs=kwargs))
+
+
+class RetriedTask(object):
+    """A submitted task, which is resubmitted (at most `max_retries` times)
+    when it fails or when it is lost, i.e. it does not finish within
+    `timeout` seconds.
+
+    The first retry waits `retry_delay` seconds, each of the following ones
+    twice as long as the previous one. Tasks failing because of wrong
+    parameters or because the job is completed are not retried.
+
+    The defaults are the `max_retries`, `retry_delay` and `task_timeout`
+    settings of the `tasks` section in openquake.cfg (a zero timeout means
+    that tasks are never considered lost).
+
+    It has the `task_id` attribute and the `ready()` and `get()` methods of
+    a `celery` result, and can be passed to :py:func:`wait_for_any`.
+    """
+
+    def __init__(self, submit_task, max_retries=None, retry_delay=None,
+                 timeout=None):
+        """
+        :param submit_task: submits the task, returns its `celery` result
+        :type submit_task: callable without parameters
+        """
+        self.submit_task = submit_task
+        self.max_retries = _config_value(
+            max_retries, "max_retries", DEFAULT_MAX_RETRIES, int)
+        self.retry_delay = _config_value(
+            retry_delay, "retry_delay", DEFAULT_RETRY_DELAY, float)
+        self.timeout = _config_value(timeout, "task_timeout", 0, float)
+
+        self.retries = 0
+        self.result = None
+        self.submitted = None
+        self.resubmit_at = None
+        self._submit()
+
+    @property
+    def task_id(self):
+        """The id of the last submission of the task."""
+        return self.result.task_id
+
+    def _submit(self):
+        """(Re)submit the task."""
+        self.result = self.submit_task()
+        self.submitted = time.time()
+        self.resubmit_at = None
+
+    def _retry(self, reason):
+        """Schedule the resubmission of the task, unless the retry budget is
+        exhausted.
+
+        :returns: whether the task will be resubmitted
+        """
+        if self.retries >= self.max_retries:
+            return False
+
+        delay = self.retry_delay * 2 ** self.retries
+        self.retries += 1
+
+        LOG.warn("Task %s %s, resubmitting it in %s seconds (retry %s of %s)"
+                 % (self.result.task_id, reason, delay, self.retries,
+                    self.max_retries))
+
+        self.resubmit_at = time.time() + delay
+        return True
+
+    def _remaining_time(self):
+        """The seconds left before the task is considered lost (`None` if it
+        never is)."""
+        if not self.timeout:
+            return None
+
+        return max(self.timeout - (time.time() - self.submitted), 0)
+
+    def _lost(self):
+        """Terminate the task which did not finish in time and schedule its
+        resubmission, return whether it will be resubmitted."""
+        revoke(self.result.task_id, terminate=True)
+        return self._retry("was lost")
+
+    @staticmethod
+    def _retriable(exc):
+        """Can the task which raised `exc` succeed when retried?"""
+        return not isinstance(exc, (TypeError, JobCompletedError))
+
+    def ready(self):
+        """Is the task finished (successfully or for good)?
+
+        This also resubmits the task when it failed, was lost or is due for
+        resubmission."""
+        if self.resubmit_at is not None:
+            if time.time() < self.resubmit_at:
+                return False
+
+            self._submit()
+
+        if not self.result.ready():
+            if self._remaining_time() == 0:
+                return not self._lost()
+
+            return False
+
+        if self.result.successful() or not self._retriable(
+                self.result.result):
+            return True
+
+        return not self._retry("failed (%s)" % self.result.result)
+
+    def get(self):
+        """Wait for the task to finish, resubmitting it if needed, and
+        return its result.
+
+        :raises: the exception of the last attempt, or
+            :py:class:`celery.exceptions.TimeoutError` when it was lost
+        """
+        while True:
+            if self.resubmit_at is not None:
+                time.sleep(max(self.resubmit_at - time.time(), 0))
+                self._submit()
+
+            try:
+                return self.result.get(timeout=self._remaining_time())
+            except TimeoutError:
+                if not self._lost():
+                    raise
+            except Exception, exc:
+                if not self._retriable(exc) or not self._retry(
+                        "failed (%s)" % exc):
+                    raise
+
+
+def _config_value(value, name, default, convert):
+    """`value` if not `None`, else the setting `name` of the `tasks` section
+    in openquake.cfg (or `default` if it is not set)."""
+    if value is not None:
+        return value
+
+    setting = config.get("tasks", name)
+    return convert(setting) if setting else default
+
+
+def iter_results(pending):
+    """Wait for all the `pending` tasks and yield their results as they
+    finish (see :py:func:`wait_for_any`).
+
+    :param pending: (tag, `celery` result) pairs of the submitted tasks, in
+        submission order. The list is emptied.
+    :type pending: list of (tag, :py:class:`celery.result.AsyncResult`)
+    :returns: An iterator of (tag, result value) pairs, in the order the
+        tasks finish.
+    :raises WrongTaskParameters: When a task received a parameter it does
+        not know.
+    :raises TaskFailed: When a task failed (raised an exception).
+    """
+    while pending:
+        for tag, value in wait_for_any(pending):
+            yield tag, value
+
+
+def wait_for_any(pending, check_interval=None):
+    """Wait until at least one of the `pending` tasks has finished.
+
+    A finished task pushes its id to its completion list (see
+    :py:func:`signal_task_done`), and this function blocks on the lists of
+    all the pending tasks at once, so that a slow task does not delay the
+    results of the tasks which finished after it was submitted.
+
+    When no task signalled its completion within `check_interval` seconds,
+    all the pending tasks are checked: this detects the lost tasks, the
+    tasks due for resubmission (see :py:class:`RetriedTask`) and the
+    results which are not computed by a worker.
+
+    :param pending: (tag, `celery` result) pairs of the submitted tasks, in
+        submission order. The pairs of the finished tasks are removed from
+        the list.
+    :type pending: list of (tag, :py:class:`celery.result.AsyncResult`)
+    :param int check_interval: The time (in seconds) to wait for a task
+        to signal its completion before checking them all, the
+        `check_interval` setting of the `tasks` section in openquake.cfg by
+        default.
+    :returns: The (tag, result value) pairs of the finished tasks, in
+        submission order.
+    :raises WrongTaskParameters: When a task received a parameter it does
+        not know.
+    :raises TaskFailed: When a task failed (raised an exception).
+    """
+    # BLPOP only takes whole seconds, and 0 would mean forever
+    check_interval = max(int(_config_value(
+        check_interval, "check_interval", DEFAULT_CHECK_INTERVAL, float)), 1)
+
+    client = kvs.get_client()
+
+    while pending:
+        keys = [kvs.tokens.task_done_key(result.task_id)
+                for _, result in pending]
+
+        popped = client.blpop(keys, check_interval)
+
+        if popped is None:
+            candidates = pending
+        else:
+            candidates = [pending[keys.index(popped[0])]]
+
+        ready = [(tag, result) for tag, result in candidates
+                 if result.ready()]
+
+        if ready:
+            break
+    else:
+        return []
+
+    # the completion lists of the tasks found by checking them all
+    client.delete(*[kvs.tokens.task_done_key(result.task_id)
+                    for _, result in ready])
+
+    finished = []
+
+    for tag, result in ready:
+        value = _get_result(result)
+        pending.remove((tag, result))
+        finished.append((tag, value))
+
+    return finished
+
+
+def signal_task_done(task_id=None, **kwargs):  # pylint: disable=W0613
+    """Push the id of a finished task to its completion list, which
+    :py:func:`wait_for_any` blocks on.
+
+    Connected to the `celery` `task_postrun` signal, sent once the task
+    result is stored.
+    """
+    key = kvs.tokens.task_done_key(task_id)
+
+    pipe = kvs.get_client().pipeline()
+    pipe.rpush(key, task_id)
+    pipe.expire(key, TASK_DONE_TTL)
+    pipe.execute()
+
+
+task_postrun.connect(signal_task_done)
+
+
+def _get_result(result):
+    """Wait for a subtask to finish and return its result.
+
+    :raises WrongTaskParameters: When the task received a parameter it does
+        not know.
+    :raises TaskFailed: When the subtask failed (raised an exception).
+    """
+    try:
+        return result.get()
+    except TypeError, exc:
+        raise WrongTaskParameters(exc.args[0])
+    except Exception, exc:
+        # At least one subtask failed (or was lost).
+        raise TaskFailed(exc.args[0] if exc.args else repr(exc))
+
+
 class JobCompletedError(Exception):
     """
     Exception to be thrown by :func:`check_job_status`
@@ -192,4 +663,5 @@ def check_job_status(job_id):
         for ``job_id``.
     """
     if Job.is_job_completed(job_id):
+        Job.forget_cached(job_id)
         raise JobCompletedError(job_id)
@@ -32,7 +32,9 @@ from hazard_nrml_unittest import *
 from hazard_unittest import *
 from input_risk_unittest import *
 from java_unittest import *
+from job_checkpoint_unittest import *
 from job_unittest import *
+from kvs_local_unittest import *
 from kvs_unittest import *
 from logs_unittest import *
 from loss_map_output_unittest import *
@@ -23,6 +23,7 @@ This module tests the risk side of the deterministic event based calculation.
 
 import json
 import mock
+import os
 import unittest
 
 from openquake import flags
@@ -30,6 +31,7 @@ from openquake import job
 from openquake import kvs
 from openquake import shapes
 from openquake.risk.job import deterministic as risk_job_det
+from openquake.risk.job import general
 
 from tests.utils import helpers
 from tests.utils.helpers import patch
@@ -152,3 +154,28 @@ class DeterministicRiskTestCase(unittest.TestCase):
         with patch('subprocess.Popen'):
 
             risk_job.launch()
+
+    def test_deterministic_job_runs_on_the_local_backend(self):
+        """
+        The deterministic job (whose hazard only uses Java to compute, not
+        to access the KVS) runs end-to-end with the local KVS backend, its
+        tasks running in this process.
+        """
+        with patch('openquake.kvs.backend') as backend_mock:
+            backend_mock.return_value = kvs.LOCAL_BACKEND
+            kvs.flush()
+
+            risk_job = helpers.job_from_file(TEST_JOB_FILE)
+            self.assertTrue(risk_job.is_valid()[0])
+
+            with mock.patch.object(general.compute_risk, "apply_async",
+                                   general.compute_risk.apply):
+                risk_job.launch()
+
+            self.assertTrue(os.path.exists(os.path.join(
+                risk_job['BASE_PATH'], risk_job['OUTPUT_DIR'],
+                'loss-map-%s.xml' % risk_job.job_id)))
+
+            # the KVS garbage collection ran in this process
+            self.assertEqual([], kvs.job_keys(
+                risk_job.job_id, kvs.tokens.EXPOSURE_KEY_TOKEN))
@@ -24,12 +24,15 @@ Unit tests for classic PSHA hazard computations with the hazard engine.
 import multiprocessing
 import unittest
 
+from openquake import kvs
 from openquake import logs
 from openquake import shapes
 
 from openquake.hazard import opensha
+from openquake.job import checkpoint
 
 from tests.utils import helpers
+from tests.utils.helpers import patch
 from tests.utils.tasks import test_compute_hazard_curve, test_data_reflector
 
 LOG = logs.LOG
@@ -104,6 +107,93 @@ class DoCurvesTestCase(helpers.TestMixin, unittest.TestCase):
                              the_task=test_compute_hazard_curve)
         self.assertEqual(2, fake_serializer.number_of_calls)
 
+    def test_realizations_are_serialized_in_order(self):
+        """The realizations are serialized in order, even if their tasks
+        overlap."""
+        serialized = []
+
+        self.mixin.params["HAZARD_TASKS"] = "3"
+        self.mixin.params["CONCURRENT_REALIZATIONS"] = "2"
+        self.mixin.do_curves(
+            self.sites, 2,
+            serializer=lambda sites, realization: serialized.append(
+                realization),
+            the_task=test_compute_hazard_curve)
+        self.assertEqual([0, 1], serialized)
+
+    def test_a_resumed_job_skips_the_completed_units(self):
+        """When resuming a job, only the (realization, block) units missing
+        in the checkpoint are calculated."""
+        the_checkpoint = checkpoint.Checkpoint(
+            self.mixin.job_id, "hazard_curves")
+        the_checkpoint.save("site_blocks", self.mixin.store_site_blocks(
+            [self.sites[:2], self.sites[2:]]))
+        the_checkpoint.mark_done(0, 0)
+        the_checkpoint.mark_done(0, 1)
+        the_checkpoint.mark_done(0)
+        the_checkpoint.mark_done(1, 1)
+
+        calculated = []
+        serialized = []
+
+        def fake_task(job_id, block_id, realization):
+            """Record the calculated units."""
+            calculated.append((realization, block_id))
+            return test_compute_hazard_curve.apply_async(
+                kwargs=dict(job_id=job_id, block_id=block_id,
+                            realization=realization))
+
+        fake_task.apply_async = lambda kwargs: fake_task(**kwargs)
+
+        self.mixin.resumed = True
+        self.mixin.do_curves(
+            self.sites, 2,
+            serializer=lambda sites, realization: serialized.append(
+                realization),
+            the_task=fake_task)
+
+        self.assertEqual([(1, 0)], calculated)
+        self.assertEqual([1], serialized)
+        self.assertTrue(the_checkpoint.done(1, 0))
+        self.assertTrue(the_checkpoint.done(1))
+
+    def test_site_blocks_are_stored_once(self):
+        """The tasks receive block IDs, the sites are stored in the KVS."""
+        self.assertEqual(2, self.mixin.store_site_blocks(
+            [self.sites[:1], self.sites[1:]]))
+        self.assertEqual(self.sites[:1], self.mixin.site_block(0))
+        self.assertEqual(self.sites[1:], self.mixin.site_block(1))
+
+    def test_site_blocks(self):
+        """Without cost based partitioning, the sites are split in
+        `number_of_tasks` blocks of the same size."""
+        self.mixin.params["HAZARD_TASKS"] = "2"
+        self.assertEqual([self.sites[:2], self.sites[2:]],
+                         self.mixin.site_blocks(self.sites))
+
+    def test_realization_objects_are_built_once_per_seed(self):
+        """The ERF of a realization is built once per process and seed."""
+        built = []
+
+        def build():
+            """Count the objects built."""
+            built.append(object())
+            return built[-1]
+
+        token = kvs.tokens.SOURCE_MODEL_TOKEN
+        self.mixin.store_source_model(42, 0)
+        erf = self.mixin._cached_realization_object(token, 0, build)
+        self.assertTrue(
+            erf is self.mixin._cached_realization_object(token, 0, build))
+        self.assertEqual(1, len(built))
+
+        # the realization is sampled again with another seed
+        self.mixin.store_source_model(43, 0)
+        self.assertFalse(
+            erf is self.mixin._cached_realization_object(token, 0, build))
+        self.assertEqual(2, len(built))
+        self.mixin.forget_realization(0)
+
 
 class DoMeansTestCase(helpers.TestMixin, unittest.TestCase):
     """Tests the behaviour of ClassicalMixin.do_means()."""
@@ -188,9 +278,6 @@ class DoMeansTestCase(helpers.TestMixin, unittest.TestCase):
             # realization.
             fake_serializer.number_of_calls += 1
 
-        def fake_map_func(*args):
-            return list(xrange(3))
-
         fake_serializer.number_of_calls = 0
 
         key = helpers.TestStore.put(self.mixin.job_id, self.mock_results)
@@ -199,7 +286,7 @@ class DoMeansTestCase(helpers.TestMixin, unittest.TestCase):
         self.mixin.do_means(self.sites, 1,
             curve_serializer=lambda _: True,
             curve_task=test_data_reflector,
-            map_func=fake_map_func,
+            map_func=test_data_reflector,
             map_serializer=fake_serializer)
         self.assertEqual(1, fake_serializer.number_of_calls)
 
@@ -293,12 +380,6 @@ class DoQuantilesTestCase(helpers.TestMixin, unittest.TestCase):
 
         fake_serializer.number_of_calls = 0
 
-        def fake_map_func(*args):
-            return ["quantile_hazard_map!10!-122.9!38.0!0.2",
-                    "quantile_hazard_map!10!-121.9!38.0!0.2",
-                    "quantile_hazard_map!10!-122.8!38.0!0.4",
-                    "quantile_hazard_map!10!-121.8!38.0!0.4"]
-
         key = helpers.TestStore.put(self.mixin.job_id, self.mock_results)
         self.keys.append(key)
         self.mixin.params["POES_HAZARD_MAPS"] = "0.6 0.8"
@@ -306,7 +387,7 @@ class DoQuantilesTestCase(helpers.TestMixin, unittest.TestCase):
             self.sites, 1, [0.2, 0.4],
             curve_serializer=lambda _, __: True,
             curve_task=test_data_reflector,
-            map_func=fake_map_func,
+            map_func=test_data_reflector,
             map_serializer=fake_serializer)
         # The serializer is called once for each quantile.
         self.assertEqual(2, fake_serializer.number_of_calls)
@@ -385,11 +466,23 @@ class NumberOfTasksTestCase(helpers.TestMixin, unittest.TestCase):
     def test_number_of_tasks_with_param_not_set(self):
         """
         When the `HAZARD_TASKS` parameter is not set the expected value is
-        twice the number of CPUs/cores.
+        twice the number of processes of the celery workers.
+        """
+        self.mixin.params = dict()
+        with patch('openquake.utils.tasks.worker_pool_size') as size_mock:
+            size_mock.return_value = 12
+            self.assertEqual(24, self.mixin.number_of_tasks())
+
+    def test_number_of_tasks_with_param_not_set_and_no_workers(self):
+        """
+        When the `HAZARD_TASKS` parameter is not set and no celery worker
+        replies the expected value is twice the number of CPUs/cores.
         """
         self.mixin.params = dict()
-        self.assertEqual(
-            2 * multiprocessing.cpu_count(), self.mixin.number_of_tasks())
+        with patch('openquake.utils.tasks.worker_pool_size') as size_mock:
+            size_mock.return_value = None
+            self.assertEqual(
+                2 * multiprocessing.cpu_count(), self.mixin.number_of_tasks())
 
     def test_number_of_tasks_with_param_set_and_valid(self):
         """
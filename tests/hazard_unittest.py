@@ -26,6 +26,7 @@ Includes:
 """
 
 import json
+import mock
 import numpy
 import os
 import unittest
@@ -147,7 +148,7 @@ class HazardEngineTestCase(unittest.TestCase):
                     key = tokens.hazard_curve_poes_key(
                         hazengine.job_id, realization, site)
 
-                    value = self.kvs_client.get(key)
+                    value = kvs.get(key)
                     # LOG.debug("kvs value is %s" % value)
                     self.assertTrue(value is not None,
                         "no non-empty value found at KVS key")
@@ -161,7 +162,7 @@ class HazardEngineTestCase(unittest.TestCase):
                 LOG.debug("verifying KVS entries for mean hazard curves")
                 for site in hazengine.sites_for_region():
                     key = tokens.mean_hazard_curve_key(hazengine.job_id, site)
-                    value = self.kvs_client.get(key)
+                    value = kvs.get(key)
                     self.assertTrue(
                         value is not None, "no value found at KVS key")
 
@@ -179,7 +180,7 @@ class HazardEngineTestCase(unittest.TestCase):
                     for site in hazengine.sites_for_region():
                         key = tokens.mean_hazard_map_key(
                             hazengine.job_id, site, poe)
-                        value = self.kvs_client.get(key)
+                        value = kvs.get(key)
                         self.assertTrue(
                             value is not None, "no value found at KVS key")
 
@@ -196,7 +197,7 @@ class HazardEngineTestCase(unittest.TestCase):
                 for site in hazengine.sites_for_region():
                     key = tokens.quantile_hazard_curve_key(
                         hazengine.job_id, site, quantile)
-                    value = self.kvs_client.get(key)
+                    value = kvs.get(key)
                     self.assertTrue(
                         value is not None, "no value found at KVS key")
 
@@ -220,7 +221,7 @@ class HazardEngineTestCase(unittest.TestCase):
                         for site in hazengine.sites_for_region():
                             key = tokens.quantile_hazard_map_key(
                                 hazengine.job_id, site, poe, quantile)
-                            value = self.kvs_client.get(key)
+                            value = kvs.get(key)
                             self.assertTrue(
                                 value is not None,
                                 "no value found at KVS key %s" % key)
@@ -409,6 +410,23 @@ class HazardEngineTestCase(unittest.TestCase):
             self.assertEqual(mgm_intensity, result.get())
 
 
+class BlockLayoutTestMixin(object):
+    """Runs the tests of the test case it is mixed in with the per-site
+    results stored in the `block` KVS layout (see
+    :py:func:`openquake.kvs.tokens.kvs_layout`)."""
+
+    def setUp(self):
+        self.layout_patch = helpers.patch('openquake.kvs.tokens.kvs_layout')
+        self.layout_patch.start().return_value = tokens.BLOCK_LAYOUT
+
+        super(BlockLayoutTestMixin, self).setUp()
+
+    def tearDown(self):
+        super(BlockLayoutTestMixin, self).tearDown()
+
+        self.layout_patch.stop()
+
+
 class MeanHazardCurveComputationTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -494,13 +512,23 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
         self.assertTrue(numpy.allclose(
                 self.expected_mean_curve, mean_hazard_curve))
 
+    def test_computes_the_mean_curves_of_a_block_of_sites(self):
+        curves = numpy.array([
+            [[0.9, 0.5, 0.1], [0.7, 0.3, 0.1]],
+            [[0.8, 0.4, 0.2], [0.6, 0.2, 0.0]]])
+
+        mean_curves = classical_psha.compute_mean_curve_block(curves)
+
+        self.assertTrue(numpy.allclose(
+                [[0.8, 0.4, 0.1], [0.7, 0.3, 0.1]], mean_curves))
+
     def test_an_empty_hazard_curve_produces_an_empty_mean_curve(self):
         hazard_curve = []
         self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve)
 
         self._run([shapes.Site(2.0, 5.0)], 1)
 
-        result = kvs.get_value_json_decoded(
+        result = kvs.get_array(
                 kvs.tokens.mean_hazard_curve_key(
                 self.job_id, shapes.Site(2.0, 5.0)))
 
@@ -539,7 +567,7 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
 
         self._run([site], 5)
 
-        result = kvs.get_value_json_decoded(
+        result = kvs.get_array(
                 kvs.tokens.mean_hazard_curve_key(self.job_id, site))
 
         # values are correct
@@ -559,6 +587,11 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
                 self.job_id, site)) != None)
 
 
+class MeanHazardCurveComputationBlockLayoutTestCase(
+    BlockLayoutTestMixin, MeanHazardCurveComputationTestCase):
+    """Tests the computation of the mean curves in the `block` layout."""
+
+
 class QuantileHazardCurveComputationTestCase(helpers.TestMixin,
                                              unittest.TestCase):
 
@@ -687,13 +720,33 @@ class QuantileHazardCurveComputationTestCase(helpers.TestMixin,
         self.assertTrue(numpy.allclose(
                 self.expected_curve, quantile_hazard_curve, atol=0.005))
 
+    def test_block_quantiles_match_the_single_site_quantiles(self):
+        curves = numpy.array([
+            [[0.98, 0.51, 0.12], [0.97, 0.46, 0.10], [0.99, 0.47, 0.13],
+             [0.95, 0.44, 0.11]],
+            [[0.91, 0.32, 0.02], [0.96, 0.38, 0.05], [0.93, 0.30, 0.01],
+             [0.92, 0.35, 0.03]]])
+        quantiles = [0.0, 0.25, 0.5, 0.75, 1.0]
+
+        quantile_curves = classical_psha.compute_quantile_curve_block(
+                curves, quantiles)
+
+        self.assertEqual((5, 2, 3), quantile_curves.shape)
+
+        for quantile_idx, quantile in enumerate(quantiles):
+            for site_idx in xrange(2):
+                self.assertTrue(numpy.allclose(
+                        classical_psha.compute_quantile_curve(
+                            curves[site_idx], quantile),
+                        quantile_curves[quantile_idx, site_idx]))
+
     def test_an_empty_hazard_curve_produces_an_empty_quantile_curve(self):
         hazard_curve = []
         self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve)
 
         self._run([shapes.Site(2.0, 5.0)], 1, [0.75])
 
-        result = kvs.get_value_json_decoded(
+        result = kvs.get_array(
                 kvs.tokens.quantile_hazard_curve_key(
                 self.job_id, shapes.Site(2.0, 5.0), 0.75))
 
@@ -730,7 +783,7 @@ class QuantileHazardCurveComputationTestCase(helpers.TestMixin,
 
         self._run([shapes.Site(2.0, 5.0)], 5, [0.75])
 
-        result = kvs.get_value_json_decoded(
+        result = kvs.get_array(
                 kvs.tokens.quantile_hazard_curve_key(
                 self.job_id, shapes.Site(2.0, 5.0), 0.75))
 
@@ -751,10 +804,163 @@ class QuantileHazardCurveComputationTestCase(helpers.TestMixin,
         self.assertEqual([], kvs.get_pattern(pattern))
 
     def _has_computed_quantile_for_site(self, site, value):
-        self.assertTrue(kvs.get_pattern(kvs.tokens.quantile_hazard_curve_key(
+        self.assertTrue(kvs.get(kvs.tokens.quantile_hazard_curve_key(
             self.job_id, site, value)))
 
 
+class QuantileHazardCurveComputationBlockLayoutTestCase(
+    BlockLayoutTestMixin, QuantileHazardCurveComputationTestCase):
+    """Tests the computation of the quantile curves in the `block` layout."""
+
+
+class BalanceSiteBlocksTestCase(unittest.TestCase):
+    """Tests the partitioning of the sites by estimated cost."""
+
+    def setUp(self):
+        self.sites = [shapes.Site(10.0 + i, 45.0) for i in xrange(6)]
+
+    def test_blocks_have_about_the_same_cost(self):
+        blocks = classical_psha.balance_site_blocks(
+            self.sites, [8, 1, 1, 4, 1, 3], 2)
+
+        # total costs: 9 and 9
+        self.assertEqual([[self.sites[0], self.sites[2]],
+                          [self.sites[1]] + self.sites[3:6]], blocks)
+
+    def test_all_sites_are_assigned_in_grid_order(self):
+        blocks = classical_psha.balance_site_blocks(
+            self.sites, [3, 1, 4, 1, 5, 9], 3)
+
+        self.assertEqual(3, len(blocks))
+        self.assertEqual(self.sites, sorted(sum(blocks, []),
+                                            key=self.sites.index))
+
+        for block in blocks:
+            self.assertEqual(block, sorted(block, key=self.sites.index))
+
+    def test_no_empty_blocks(self):
+        self.assertEqual([self.sites[:1], self.sites[1:2]],
+                         classical_psha.balance_site_blocks(
+                             self.sites[:2], [1, 1], 4))
+
+
+class IncrementalHazardCurveStatisticsTestCase(unittest.TestCase):
+    """Tests the accumulation of mean/quantile curves while the realizations
+    are computed."""
+
+    def setUp(self):
+        self.job = helpers.create_job({})
+        self.job_id = self.job.job_id
+
+        self.sites = [shapes.Site(1.5, 1.0), shapes.Site(2.0, 1.0)]
+        self.curves = [
+            [[0.98, 0.51, 0.12], [0.91, 0.32, 0.02]],
+            [[0.97, 0.46, 0.10], [0.96, 0.38, 0.05]],
+            [[0.99, 0.47, 0.13], [0.93, 0.30, 0.01]]]
+
+        # deleting server side cached data
+        kvs.flush()
+
+        for realization, curves in enumerate(self.curves):
+            for site, curve in zip(self.sites, curves):
+                kvs.set_value_json_encoded(
+                    kvs.tokens.hazard_curve_poes_key(
+                        self.job_id, realization, site), curve)
+
+            classical_psha.accumulate_hazard_curves(
+                self.job_id, realization, self.sites, curves,
+                keep_samples=True)
+
+    def test_accumulated_mean_curves_match_the_computed_ones(self):
+        finalized = kvs.mget_arrays(
+            classical_psha.finalize_mean_hazard_curves(
+                self.job_id, self.sites, 3))
+        computed = kvs.mget_arrays(
+            classical_psha.compute_mean_hazard_curves(
+                self.job_id, self.sites, 3))
+
+        self.assertTrue(numpy.allclose(computed, finalized))
+
+    def test_accumulated_quantile_curves_match_the_computed_ones(self):
+        finalized = kvs.mget_arrays(
+            classical_psha.finalize_quantile_hazard_curves(
+                self.job_id, self.sites, 3, [0.25, 0.75]))
+        computed = kvs.mget_arrays(
+            classical_psha.compute_quantile_hazard_curves(
+                self.job_id, self.sites, 3, [0.25, 0.75]))
+
+        self.assertTrue(numpy.allclose(computed, finalized))
+
+    def test_quantiles_are_estimated_from_sketches_with_many_realizations(
+            self):
+        """Beyond QUANTILE_SAMPLES realizations the samples are dropped, and
+        the quantiles are estimated within the accuracy of the sketches."""
+        curves = [[0.95, 0.40, 0.0], [0.90, 0.35, 1e-14]]
+
+        for site, curve in zip(self.sites, curves):
+            kvs.set_value_json_encoded(
+                kvs.tokens.hazard_curve_poes_key(self.job_id, 3, site), curve)
+
+        with mock.patch.object(classical_psha, "QUANTILE_SAMPLES", 3):
+            classical_psha.accumulate_hazard_curves(
+                self.job_id, 3, self.sites, curves, keep_samples=True)
+
+            self.assertFalse(kvs.get_client().exists(
+                kvs.tokens.hazard_curve_samples_key(
+                    self.job_id, self.sites[0])))
+
+            finalized = numpy.array(kvs.mget_arrays(
+                classical_psha.finalize_quantile_hazard_curves(
+                    self.job_id, self.sites, 4, [0.25, 0.5, 0.75])))
+
+        computed = numpy.array(kvs.mget_arrays(
+            classical_psha.compute_quantile_hazard_curves(
+                self.job_id, self.sites, 4, [0.25, 0.5, 0.75])))
+
+        self.assertTrue(numpy.all(abs(finalized - computed) <= (
+            classical_psha.QUANTILE_SKETCH_ACCURACY * computed
+            + classical_psha.QUANTILE_SKETCH_MIN_POE)))
+
+    def test_accumulating_a_realization_again_has_no_effect(self):
+        """A retried task cannot fold its realization twice."""
+        classical_psha.accumulate_hazard_curves(
+            self.job_id, 1, self.sites, self.curves[1], keep_samples=True)
+
+        finalized = kvs.mget_arrays(
+            classical_psha.finalize_mean_hazard_curves(
+                self.job_id, self.sites, 3))
+        computed = kvs.mget_arrays(
+            classical_psha.compute_mean_hazard_curves(
+                self.job_id, self.sites, 3))
+
+        self.assertTrue(numpy.allclose(computed, finalized))
+        self.assertEqual(2, len(classical_psha.finalize_quantile_hazard_curves(
+            self.job_id, self.sites, 3, [0.5])))
+
+    def test_the_folded_realizations_are_recorded_compactly(self):
+        for _ in range(2):
+            classical_psha.accumulate_hazard_curves(
+                self.job_id, 4, self.sites, self.curves[0])
+
+        accumulator = kvs.get_value_json_decoded(
+            kvs.tokens.hazard_curve_sum_key(self.job_id, self.sites[0]))
+
+        self.assertEqual(4, accumulator["count"])
+        self.assertEqual(3, accumulator["folded_below"])
+        self.assertEqual([4], accumulator["folded_above"])
+
+    def test_missing_realizations_are_detected(self):
+        self.assertRaises(
+            ValueError, classical_psha.finalize_mean_hazard_curves,
+            self.job_id, self.sites, 4)
+
+
+class IncrementalHazardCurveStatisticsBlockLayoutTestCase(
+    BlockLayoutTestMixin, IncrementalHazardCurveStatisticsTestCase):
+    """Tests the accumulation of the curve statistics in the `block`
+    layout."""
+
+
 class MeanQuantileHazardMapsComputationTestCase(helpers.TestMixin,
                                                 unittest.TestCase):
 
@@ -846,6 +1052,35 @@ class MeanQuantileHazardMapsComputationTestCase(helpers.TestMixin,
         self.assertTrue(numpy.allclose([2.1300e+00],
                 numpy.array(im_level)))
 
+    def test_computes_the_imls_of_a_block_of_sites(self):
+        mean_curve = [9.8784e-01, 9.8405e-01, 9.5719e-01, 9.1955e-01,
+                8.5019e-01, 7.4038e-01, 5.9153e-01, 4.2626e-01, 2.9755e-01,
+                2.7731e-01, 1.6218e-01, 8.8035e-02, 4.3499e-02, 1.9065e-02,
+                7.0442e-03, 2.1300e-03, 4.9498e-04, 8.1768e-05, 7.3425e-06]
+
+        imls = classical_psha.compute_hazard_map_block(
+                [mean_curve, mean_curve], self.imls, [0.99, 0.10, 0.00])
+
+        self.assertEqual((2, 3), imls.shape)
+
+        for site_imls in imls:
+            self.assertTrue(numpy.allclose(
+                    [5.0000e-03, 1.9078e-01, 2.1300e+00], site_imls,
+                    atol=0.005))
+
+    def test_poes_shared_by_several_points_take_their_lowest_iml(self):
+        # flat stretches of the curves, like the zeros at the tail
+        curves = [[0.9, 0.5, 0.1] + [0.0] * 16,
+                  [0.9, 0.9, 0.5, 0.5, 0.5] + [0.1] * 14]
+
+        imls = classical_psha.compute_hazard_map_block(
+                curves, self.imls, [0.0, 0.1, 0.5, 0.9])
+
+        self.assertFalse(numpy.isnan(imls).any())
+        self.assertTrue(numpy.allclose(
+                [[1.9200e-02, 1.3700e-02, 7.0000e-03, 5.0000e-03],
+                 [2.1300e+00, 3.7600e-02, 1.3700e-02, 5.0000e-03]], imls))
+
     def test_quantile_hazard_maps_computation(self):
         self.params[classical_psha.POES_PARAM_NAME] = "0.10"
         self.params[classical_psha.QUANTILE_PARAM_NAME] = "0.25 0.50 0.75"
@@ -914,7 +1149,7 @@ class MeanQuantileHazardMapsComputationTestCase(helpers.TestMixin,
                 self.job_id, sites[1], 0.10, 0.75)))
 
     def _get_iml_at(self, site, poe):
-        return kvs.get_value_json_decoded(
+        return kvs.get_array(
                 kvs.tokens.mean_hazard_map_key(self.job_id, site, poe))
 
     def _run(self, poes, sites=None):
@@ -935,3 +1170,8 @@ class MeanQuantileHazardMapsComputationTestCase(helpers.TestMixin,
     def _has_computed_IML_for_site(self, site, poe):
         self.assertTrue(kvs.get(kvs.tokens.mean_hazard_map_key(
             self.job_id, site, poe)))
+
+
+class MeanQuantileHazardMapsComputationBlockLayoutTestCase(
+    BlockLayoutTestMixin, MeanQuantileHazardMapsComputationTestCase):
+    """Tests the computation of the hazard maps in the `block` layout."""
@@ -20,6 +20,8 @@
 
 import unittest
 
+from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+
 from openquake.db.alchemy.db_utils import get_db_session
 from openquake.job import Job
 from openquake.job.mixins import Mixin
@@ -105,6 +107,35 @@ class HazardCurveDBReadTestCase(unittest.TestCase, helpers.DbTestMixin):
             self.assertEquals(list(curve2.ordinates),
                               [0.454, 0.214, 0.123, 0.102])
 
+    def test_read_curves(self):
+        """Verify _get_db_curves reads the curves of many sites at once."""
+        with Mixin(helpers.create_job({}, job_id=self.job.id),
+                   ClassicalPSHABasedMixin) as mixin:
+            imls, poes = mixin._get_db_curves(
+                [Site(-122.1, 37.5), Site(-122.2, 37.5), Site(-122.1, 37.5)])
+            self.assertEquals(list(imls), [0.005, 0.007, 0.0098, 0.0137])
+            self.assertEquals(poes.tolist(),
+                              [[0.454, 0.214, 0.123, 0.102],
+                               [0.354, 0.114, 0.023, 0.002],
+                               [0.454, 0.214, 0.123, 0.102]])
+
+            self.assertRaises(NoResultFound, mixin._get_db_curves,
+                              [Site(-122.2, 37.5), Site(10.0, 10.0)])
+
+    def test_duplicate_curves_are_detected(self):
+        """_get_db_curves refuses to pick one of many mean curves."""
+        session = get_db_session("reslt", "writer")
+        output_path = self.generate_output_path(self.job)
+        hcw = HazardCurveDBWriter(session, output_path, self.job.id)
+        hcw.serialize(HAZARD_CURVE_DATA()[:1])
+
+        with Mixin(helpers.create_job({}, job_id=self.job.id),
+                   ClassicalPSHABasedMixin) as mixin:
+            self.assertRaises(MultipleResultsFound, mixin._get_db_curves,
+                              [Site(-122.2, 37.5)])
+            self.assertEqual(1, len(mixin._get_db_curves(
+                [Site(-122.1, 37.5)])[1]))
+
 
 class GMFDBReadTestCase(unittest.TestCase, helpers.DbTestMixin):
     """
@@ -29,6 +29,7 @@ import unittest
 
 from openquake import java
 
+from tests.utils.helpers import patch
 from tests.utils.tasks import jtask_task, failing_jtask_task
 
 
@@ -88,6 +89,38 @@ class JvmMaxMemTestCase(unittest.TestCase):
         self.assertRaises(ValueError, java.get_jvm_max_mem, None)
 
 
+class JvmWarmUpTestCase(unittest.TestCase):
+    """Tests the warm up of the JVM in the worker processes"""
+
+    def test_warm_up_loads_the_classes(self):
+        """The JVM is started and its startup time recorded."""
+        self.assertTrue(java.warm_up(["HazardCalculator"]) >= 0)
+        self.assertTrue(java.jvm().isJVMStarted())
+        self.assertTrue(java.JVM_STARTUP_TIME is not None)
+
+    def test_the_jvm_startup_time_is_recorded_in_the_kvs(self):
+        """The startup time of the JVM of this process can be read by a
+        monitor."""
+        java.warm_up([])
+        self.assertTrue(java._process_name() in java.jvm_startup_times())
+
+    def test_worker_warm_up_is_opt_in(self):
+        """The warm up is skipped unless enabled in openquake.cfg."""
+        with patch("openquake.utils.config.get") as config_get:
+            with patch("openquake.java.warm_up") as warm_up:
+                config_get.return_value = None
+                java.warm_up_worker()
+                self.assertEqual(0, warm_up.call_count)
+
+                config_get.return_value = "false"
+                java.warm_up_worker()
+                self.assertEqual(0, warm_up.call_count)
+
+                config_get.return_value = "true"
+                java.warm_up_worker()
+                self.assertEqual(1, warm_up.call_count)
+
+
 class CeleryJavaExceptionTestCase(unittest.TestCase):
     """Tests the behaviour of Java exceptions in Celery jobs."""
 
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+import unittest
+
+from openquake import kvs
+from openquake.job.checkpoint import Checkpoint
+
+
+class CheckpointTestCase(unittest.TestCase):
+    """Tests for the checkpoints of the completed units of work."""
+
+    def setUp(self):
+        self.job_id = 7234
+        kvs.mark_job_as_current(self.job_id)
+        self.checkpoint = Checkpoint(self.job_id, "test")
+
+    def tearDown(self):
+        kvs.cache_gc(self.job_id)
+
+    def test_units_are_recorded(self):
+        self.assertFalse(self.checkpoint.done(1, 2))
+
+        self.checkpoint.mark_done(1, 2)
+
+        self.assertTrue(self.checkpoint.done(1, 2))
+        self.assertTrue(Checkpoint(self.job_id, "test").done(1, 2))
+        self.assertFalse(self.checkpoint.done(2, 1))
+        self.assertFalse(Checkpoint(self.job_id, "other").done(1, 2))
+
+    def test_clear(self):
+        self.checkpoint.mark_done(1)
+        self.checkpoint.clear()
+
+        self.assertFalse(self.checkpoint.done(1))
+
+    def test_saved_data(self):
+        self.assertEqual(None, self.checkpoint.load("blocks"))
+
+        self.checkpoint.save("blocks", [[1.0, 2.0]])
+
+        self.assertEqual([[1.0, 2.0]], self.checkpoint.load("blocks"))
+
+    def test_checkpoints_are_garbage_collected(self):
+        self.checkpoint.mark_done(1)
+        kvs.cache_gc(self.job_id)
+
+        self.assertFalse(self.checkpoint.done(1))
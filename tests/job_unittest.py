@@ -26,7 +26,7 @@ from openquake import kvs
 from openquake import flags
 from openquake.db.alchemy.db_utils import get_db_session
 from openquake.db.alchemy.models import OqJob
-from openquake.job import Job, LOG, prepare_job, run_job
+from openquake.job import Job, LOG, MAX_CACHED_JOBS, prepare_job, run_job
 from openquake.job.mixins import Mixin
 from openquake.risk.job import general
 from openquake.risk.job.probabilistic import ProbabilisticEventMixin
@@ -180,6 +180,64 @@ class JobTestCase(unittest.TestCase):
         self.assertEqual(self.job, Job.from_kvs(self.job.job_id))
         helpers.cleanup_loggers()
 
+    def test_cached_jobs_are_reused(self):
+        job_id = self.job.job_id
+        Job.forget_cached(job_id)
+
+        cached = Job.cached(job_id)
+        self.assertEqual(self.job, cached)
+        self.assertTrue(cached is Job.cached(job_id))
+
+        Job.forget_cached(job_id)
+        self.assertFalse(cached is Job.cached(job_id))
+
+    def test_cached_jobs_are_reloaded_when_stored_again(self):
+        job_id = self.job.job_id
+        Job.forget_cached(job_id)
+        cached = Job.cached(job_id)
+
+        self.job.params['REFERENCE_VS30_VALUE'] = '123.0'
+        self.job.to_kvs(write_cfg=False)
+
+        reloaded = Job.cached(job_id)
+        self.assertFalse(cached is reloaded)
+        self.assertEqual('123.0', reloaded['REFERENCE_VS30_VALUE'])
+        Job.forget_cached(job_id)
+
+    def test_cached_jobs_are_not_read_from_the_kvs(self):
+        job_id = self.job.job_id
+        cached = Job.cached(job_id)
+
+        with patch('openquake.kvs.get_client') as client_mock:
+            self.assertTrue(cached is Job.cached(job_id))
+            self.assertEqual(0, client_mock.call_count)
+
+        Job.forget_cached(job_id)
+
+    def test_the_least_recently_used_cached_job_is_evicted(self):
+        job_id = self.job.job_id
+        cached = Job.cached(job_id)
+        other_job_ids = range(-1, -MAX_CACHED_JOBS - 1, -1)
+
+        with mock.patch.object(Job, "from_kvs") as from_kvs_mock:
+            from_kvs_mock.return_value = self.job
+
+            for other_job_id in other_job_ids:
+                Job.cached(other_job_id)
+                # the job stays the most recently used
+                self.assertTrue(cached is Job.cached(job_id))
+
+            self.assertEqual(MAX_CACHED_JOBS, from_kvs_mock.call_count)
+
+            # the first of the other jobs was evicted
+            Job.cached(-1)
+            self.assertEqual(MAX_CACHED_JOBS + 1, from_kvs_mock.call_count)
+
+        self.assertTrue(cached is Job.cached(job_id))
+
+        for cached_job_id in other_job_ids + [job_id]:
+            Job.forget_cached(cached_job_id)
+
     def test_job_calls_cleanup(self):
         """
         This test ensures that jobs call
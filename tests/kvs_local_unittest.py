@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+import threading
+import unittest
+
+from openquake import kvs
+from openquake.kvs.local import LocalKVS
+from tests.utils.helpers import patch
+
+
+class LocalKVSTestCase(unittest.TestCase):
+    """Tests for the in-process KVS backend."""
+
+    def setUp(self):
+        self.client = LocalKVS(db=1)
+        self.client.flushdb()
+
+    def tearDown(self):
+        self.client.flushdb()
+
+    def test_values_are_stored_as_strings(self):
+        self.client.set("KEY", 0.5)
+        self.client.mset({"KEY2": 1, u"KEY3": u"VALUE"})
+
+        self.assertEqual(["0.5", "1", "VALUE", None],
+                         self.client.mget(["KEY", "KEY2", "KEY3", "KEY4"]))
+
+    def test_databases_are_shared_by_the_clients(self):
+        self.client.set("KEY", "VALUE")
+
+        self.assertEqual("VALUE", LocalKVS(db=1).get("KEY"))
+        self.assertEqual(None, LocalKVS(db=2).get("KEY"))
+
+    def test_lists(self):
+        for item in ("ITEM1", "ITEM2", "ITEM3"):
+            self.client.rpush("LIST", item)
+
+        self.assertEqual(["ITEM1", "ITEM2", "ITEM3"],
+                         self.client.lrange("LIST", 0, -1))
+        self.assertEqual(["ITEM2"], self.client.lrange("LIST", 1, 1))
+
+    def test_blpop_takes_the_first_item_of_the_first_non_empty_list(self):
+        self.client.rpush("LIST2", "ITEM1")
+        self.client.rpush("LIST2", "ITEM2")
+
+        self.assertEqual(("LIST2", "ITEM1"),
+                         self.client.blpop(["LIST1", "LIST2"], 1))
+        self.assertEqual(("LIST2", "ITEM2"),
+                         self.client.blpop(["LIST1", "LIST2"], 1))
+        self.assertEqual([], self.client.keys("*"))
+        self.assertEqual(None, self.client.blpop(["LIST1", "LIST2"], 0.01))
+
+    def test_blpop_waits_for_an_item_to_be_pushed(self):
+        pusher = threading.Timer(0.01, self.client.rpush, ("LIST", "ITEM"))
+        pusher.start()
+
+        self.assertEqual(("LIST", "ITEM"), self.client.blpop("LIST", 10))
+        pusher.join()
+
+    def test_sets_and_hashes(self):
+        self.client.sadd("SET", "A")
+        self.client.sadd("SET", "B")
+        self.client.srem("SET", "A")
+        self.client.hmset("HASH", {"F1": "V1", "F2": "V2"})
+        self.client.hdel("HASH", "F1")
+
+        self.assertEqual(set(["B"]), self.client.smembers("SET"))
+        self.assertTrue(self.client.sismember("SET", "B"))
+        self.assertEqual([None, "V2"], self.client.hmget("HASH", ["F1", "F2"]))
+        self.assertEqual({"F2": "V2"}, self.client.hgetall("HASH"))
+        self.assertEqual(1, self.client.hlen("HASH"))
+
+    def test_pipelines(self):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set("KEY", "VALUE")
+        pipe.rpush("LIST", "ITEM")
+
+        self.assertEqual(None, self.client.get("KEY"))
+        self.assertEqual([True, 1], pipe.execute())
+        self.assertEqual("VALUE", self.client.get("KEY"))
+
+    def test_transactions(self):
+        self.client.set("KEY", "1")
+
+        def increment(pipe):
+            value = int(pipe.get("KEY"))
+            pipe.multi()
+            pipe.set("KEY", value + 1)
+
+        self.assertEqual([True], self.client.transaction(increment, "KEY"))
+        self.assertEqual("2", self.client.get("KEY"))
+
+    def test_keys(self):
+        self.client.set("::JOB::1::!GMF!0!0", "VALUE")
+        self.client.set("::JOB::2::!GMF!0!0", "VALUE")
+
+        self.assertEqual(["::JOB::1::!GMF!0!0"], self.client.keys("*::1::*"))
+        self.assertEqual(1, self.client.delete("::JOB::1::!GMF!0!0", "X"))
+
+    def test_the_kvs_functions_work_with_the_local_backend(self):
+        with patch('openquake.kvs.get_client') as client_mock:
+            client_mock.return_value = self.client
+
+            kvs.mark_job_as_current(1)
+            kvs.set_array(kvs.tokens.mean_hazard_curve_key(1, "SITE"),
+                          [1.0, 2.0])
+
+            with kvs.WriteBuffer() as writer:
+                writer.rpush(kvs.tokens.asset_key(1, 0, 0), "ASSET")
+
+            self.assertEqual([1.0, 2.0], kvs.get_array(
+                kvs.tokens.mean_hazard_curve_key(1, "SITE")).tolist())
+            self.assertEqual(2, kvs.cache_gc(1))
+            self.assertEqual([], self.client.keys("*"))
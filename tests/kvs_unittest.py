@@ -21,12 +21,15 @@
 import json
 import numpy
 import os
+import pickle
 
 import unittest
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
+from openquake import shapes
+from openquake.kvs import redis as redis_kvs
 from openquake.utils import config
 from tests.utils import helpers
 from tests.utils.helpers import patch
@@ -64,6 +67,82 @@ class JSONEncoderTestCase(unittest.TestCase):
                          encoder.encode(numpy.array([1.0, 2.0, 3.0])))
 
 
+class ArrayCodecTestCase(unittest.TestCase):
+    """Tests for the encoding of numeric arrays stored in the KVS."""
+
+    def setUp(self):
+        self.values = [9.8728e-01, 9.8266e-01, 9.4957e-01, 7.3425e-06]
+
+    def test_binary_round_trip(self):
+        encoded = kvs.encode_array(self.values, "float64")
+
+        self.assertTrue(encoded.startswith(kvs.ARRAY_MAGIC))
+        self.assertEqual(len(kvs.ARRAY_MAGIC) + 1 + 8 * 4, len(encoded))
+        self.assertEqual(self.values, kvs.decode_array(encoded).tolist())
+
+    def test_float32_round_trip(self):
+        encoded = kvs.encode_array(self.values, "float32")
+
+        self.assertEqual(len(kvs.ARRAY_MAGIC) + 1 + 4 * 4, len(encoded))
+        self.assertTrue(numpy.allclose(
+            self.values, kvs.decode_array(encoded)))
+
+    def test_json_round_trip(self):
+        encoded = kvs.encode_array(numpy.array(self.values), "json")
+
+        self.assertEqual(self.values, json.loads(encoded))
+        self.assertEqual(self.values, kvs.decode_array(encoded).tolist())
+
+    def test_scalars(self):
+        for format_ in ("float64", "json"):
+            self.assertEqual(
+                0.25, kvs.decode_array(kvs.encode_array(0.25, format_)).item())
+
+    def test_empty_arrays(self):
+        for format_ in ("float64", "float32", "json"):
+            self.assertEqual(
+                [], kvs.decode_array(kvs.encode_array([], format_)).tolist())
+
+
+class RedisClientTestCase(unittest.TestCase):
+    """Tests for the pooled Redis clients."""
+
+    def setUp(self):
+        self.clients = dict(redis_kvs._CLIENTS)
+
+    def tearDown(self):
+        # getting a client in a "forked" process discards the cached ones
+        redis_kvs._CLIENTS.clear()
+        redis_kvs._CLIENTS.update(self.clients)
+
+    def test_clients_are_shared_in_a_process(self):
+        self.assertTrue(kvs.get_client().conn is kvs.get_client().conn)
+        self.assertFalse(kvs.get_client().conn is kvs.get_client(db=1).conn)
+
+    def test_clients_are_not_shared_with_forked_processes(self):
+        client = kvs.get_client().conn
+
+        with patch('os.getpid') as getpid_mock:
+            getpid_mock.return_value = -1
+            self.assertFalse(client is kvs.get_client().conn)
+
+    def test_the_connection_parameters_are_used(self):
+        client = kvs.get_client(host="127.0.0.1", port=6380)
+
+        kwargs = client.connection_pool.connection_kwargs
+        self.assertEqual(("127.0.0.1", 6380), (kwargs["host"], kwargs["port"]))
+
+    def test_full_pools_wait_for_a_free_connection(self):
+        client = redis_kvs._client(
+            config.get("kvs", "host"), int(config.get("kvs", "port")), 0,
+            None, 2, 5)
+
+        self.assertTrue(isinstance(client.connection_pool,
+                                   redis_kvs.redis.BlockingConnectionPool))
+        self.assertEqual(2, client.connection_pool.max_connections)
+        self.assertEqual(5, client.connection_pool.timeout)
+
+
 class KVSTestCase(unittest.TestCase):
     """
     Tests for various KVS storage operations.
@@ -114,6 +193,122 @@ class KVSTestCase(unittest.TestCase):
 
         self.assertEqual(data, kvs.get_list_json_decoded(TEST_KEY))
 
+    def test_mset_arrays(self):
+        values = {"KEY1": [1.0, 2.0], "KEY2": numpy.array([3.0, 4.0])}
+
+        kvs.mset_arrays(values)
+
+        self.assertEqual(
+            [[1.0, 2.0], [3.0, 4.0]],
+            [a.tolist() for a in kvs.mget_arrays(["KEY1", "KEY2"])])
+        self.assertEqual([3.0, 4.0], kvs.get_array("KEY2").tolist())
+
+    def test_mset_encoded(self):
+        values = {"KEY1": [1.0, 2.0], "KEY2": numpy.array([3.0, 4.0])}
+
+        kvs.mset_encoded(values)
+
+        self.assertEqual([[1.0, 2.0], [3.0, 4.0]],
+                         kvs.mget_decoded(["KEY1", "KEY2"]))
+
+    def test_update_encoded(self):
+        kvs.mset_encoded({"KEY1": 1})
+
+        kvs.update_encoded(
+            ["KEY1", "KEY2"],
+            lambda values: dict(KEY1=values[0] + 1, KEY2=values[1]))
+
+        self.assertEqual([2, None], kvs.mget_decoded(["KEY1", "KEY2"]))
+
+    def test_job_keys(self):
+        kvs.set(kvs.tokens.gmf_set_key(1, 0, 0), "VALUE")
+        kvs.set_value_json_encoded(kvs.tokens.gmf_set_key(1, 0, 1), [1])
+        kvs.mset_encoded({kvs.tokens.gmf_set_key(2, 0, 0): [1]})
+        kvs.set_value_json_encoded(kvs.tokens.vuln_key(1), {})
+
+        with kvs.WriteBuffer() as writer:
+            writer.rpush(kvs.tokens.asset_key(1, 0, 0), "ASSET")
+
+        self.assertEqual(
+            sorted([kvs.tokens.gmf_set_key(1, 0, 0),
+                    kvs.tokens.gmf_set_key(1, 0, 1)]),
+            sorted(kvs.job_keys(1, kvs.tokens.GMF_KEY_TOKEN)))
+        self.assertEqual([kvs.tokens.asset_key(1, 0, 0)],
+                         kvs.job_keys(1, kvs.tokens.EXPOSURE_KEY_TOKEN))
+        self.assertEqual([], kvs.job_keys(3, kvs.tokens.GMF_KEY_TOKEN))
+
+    def test_write_buffer(self):
+        with kvs.WriteBuffer(batch_size=3) as writer:
+            writer.set("KEY1", "VALUE")
+            writer.rpush("LIST", "ITEM1")
+            writer.rpush("LIST", "ITEM2")
+
+            # the batch is full, the writes were sent
+            self.assertEqual(0, len(writer))
+            self.assertEqual("VALUE", kvs.get("KEY1"))
+
+            writer.set_value_json_encoded("KEY2", {"a": 1})
+            writer.set_array("KEY3", [1.0, 2.0])
+
+            self.assertEqual(2, len(writer))
+            self.assertEqual(None, kvs.get("KEY2"))
+
+        self.assertEqual(["ITEM1", "ITEM2"],
+                         self.python_client.lrange("LIST", 0, -1))
+        self.assertEqual({"a": 1}, kvs.get_value_json_decoded("KEY2"))
+        self.assertEqual([1.0, 2.0], kvs.get_array("KEY3").tolist())
+
+    def test_write_buffer_drops_writes_on_errors(self):
+        try:
+            with kvs.WriteBuffer() as writer:
+                writer.set("KEY1", "VALUE")
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        self.assertEqual(None, kvs.get("KEY1"))
+
+    def test_arrays_in_block_layout(self):
+        site1, site2, site3 = (shapes.Site(10.1, 45.1),
+                               shapes.Site(10.2, 45.2),
+                               shapes.Site(11.1, 45.1))
+
+        with patch('openquake.kvs.tokens.kvs_layout') as layout_mock:
+            layout_mock.return_value = kvs.tokens.BLOCK_LAYOUT
+            keys = [kvs.tokens.mean_hazard_curve_key(1, site)
+                    for site in (site1, site2, site3)]
+
+        kvs.mset_arrays({keys[0]: [1.0], keys[1]: [2.0], keys[2]: [3.0]})
+
+        # one hash per site block, one field per site
+        self.assertEqual(2, len(self.python_client.keys(
+            "*!%s!*" % kvs.tokens.MEAN_HAZARD_CURVE_KEY_TOKEN)))
+        self.assertEqual(2, self.python_client.hlen(keys[0].hash_key))
+        self.assertEqual([[3.0], [2.0], [1.0]],
+                         [a.tolist() for a in kvs.mget_arrays(keys[::-1])])
+
+        kvs.delete_arrays(keys[:2])
+
+        self.assertEqual([3.0], kvs.get_array(keys[2]).tolist())
+        self.assertEqual(None, kvs.get_array(keys[0]))
+
+    def test_values_in_block_layout(self):
+        with patch('openquake.kvs.tokens.kvs_layout') as layout_mock:
+            layout_mock.return_value = kvs.tokens.BLOCK_LAYOUT
+            key = kvs.tokens.mean_hazard_curve_key(1, shapes.Site(10.1, 45.1))
+
+        kvs.set_value_json_encoded(key, [1.0, 2.0])
+
+        # the value is a field of the hash, not found under the plain key
+        self.assertEqual(None, self.python_client.get(key))
+        self.assertEqual([1.0, 2.0], kvs.get_value_json_decoded(key))
+        self.assertEqual([[1.0, 2.0]], kvs.mget_decoded([key]))
+
+        with kvs.WriteBuffer() as writer:
+            writer.set(key, "VALUE")
+
+        self.assertEqual("VALUE", kvs.get(key))
+
 
 class TokensTestCase(unittest.TestCase):
     """
@@ -152,6 +347,54 @@ class TokensTestCase(unittest.TestCase):
 
         self.assertEqual(expected_key, kvs.tokens.generate_job_key(job_id))
 
+    def test_logic_tree_keys_by_realization(self):
+        job_key = kvs.tokens.generate_job_key(self.job_id)
+        self.assertEqual("%s!%s" % (job_key, kvs.tokens.SOURCE_MODEL_TOKEN),
+                         kvs.tokens.source_model_key(self.job_id))
+        self.assertEqual(
+            "%s!%s!3" % (job_key, kvs.tokens.SOURCE_MODEL_TOKEN),
+            kvs.tokens.source_model_key(self.job_id, 3))
+        self.assertEqual("%s!%s!0" % (job_key, kvs.tokens.GMPE_TOKEN),
+                         kvs.tokens.gmpe_key(self.job_id, 0))
+
+    def test_split_job_key(self):
+        self.assertEqual(("::JOB::7::", "GMF"),
+                         kvs.tokens.split_job_key("::JOB::7::!GMF!1!2"))
+        self.assertEqual(("::JOB::7::", ""),
+                         kvs.tokens.split_job_key("::JOB::7::"))
+        self.assertEqual((None, None), kvs.tokens.split_job_key("BLOCK:1"))
+
+    def test_site_key_in_site_layout(self):
+        site = shapes.Site(10.1, 45.1)
+
+        with patch('openquake.kvs.tokens.kvs_layout') as layout_mock:
+            layout_mock.return_value = kvs.tokens.SITE_LAYOUT
+            key = kvs.tokens.hazard_curve_poes_key(self.job_id, 3, site)
+
+        self.assertEqual(kvs.tokens._generate_key(
+            self.job_id, kvs.tokens.HAZARD_CURVE_POES_KEY_TOKEN, 3,
+            hash(site)), key)
+        self.assertEqual(None, key.hash_key)
+
+    def test_site_key_in_block_layout(self):
+        site = shapes.Site(-10.1, 45.1)
+
+        with patch('openquake.kvs.tokens.kvs_layout') as layout_mock:
+            layout_mock.return_value = kvs.tokens.BLOCK_LAYOUT
+            key = kvs.tokens.hazard_curve_poes_key(self.job_id, 3, site)
+
+        self.assertEqual(kvs.tokens._generate_key(
+            self.job_id, kvs.tokens.HAZARD_CURVE_POES_KEY_TOKEN, 3,
+            hash(site)), key)
+        self.assertEqual(kvs.tokens._generate_key(
+            self.job_id, kvs.tokens.HAZARD_CURVE_POES_KEY_TOKEN, 3,
+            "B-11_45"), key.hash_key)
+        self.assertEqual(str(hash(site)), key.field)
+
+        # the keys survive the round trip through the task queue
+        self.assertEqual(key.hash_key,
+                         pickle.loads(pickle.dumps(key)).hash_key)
+
 
 class JobTokensTestCase(unittest.TestCase):
     """
@@ -222,9 +465,9 @@ class GarbageCollectionTestCase(unittest.TestCase):
         self.vuln_key = kvs.tokens.vuln_key(self.test_job)
 
         # now create the fake data for test_job
-        self.client.set(self.gmf1_key, 'fake gmf data 1')
-        self.client.set(self.gmf2_key, 'fake gmf data 2')
-        self.client.set(self.vuln_key, 'fake vuln curve data')
+        kvs.set(self.gmf1_key, 'fake gmf data 1')
+        kvs.set(self.gmf2_key, 'fake gmf data 2')
+        kvs.set(self.vuln_key, 'fake vuln curve data')
 
         # this job will have no data
         self.dataless_job = 2
@@ -251,6 +494,25 @@ class GarbageCollectionTestCase(unittest.TestCase):
         self.assertFalse(
             self.client.sismember(kvs.tokens.CURRENT_JOBS, self.test_job))
 
+        # the index sets are deleted too
+        self.assertEqual([], self.client.keys("*%s*"
+            % kvs.tokens.generate_job_key(self.test_job)))
+
+    def test_gc_keys_written_elsewhere(self):
+        """
+        Keys written outside :py:mod:`openquake.kvs` are deleted once
+        registered.
+        """
+        key = kvs.tokens.stochastic_set_key(self.test_job, 0, 0)
+        self.client.set(key, 'fake stochastic set')
+        list_key = kvs.tokens.gmf_set_key(self.test_job, 1, 1)
+        self.client.rpush(list_key, 'fake gmf data')
+        kvs.register_keys([key, list_key])
+
+        self.assertEqual(5, kvs.cache_gc(self.test_job))
+        self.assertFalse(self.client.exists(key))
+        self.assertFalse(self.client.exists(list_key))
+
     def test_gc_dataless_job(self):
         """
         Test that :py:function:`openquake.kvs.cache_gc` returns 0 (to indicate
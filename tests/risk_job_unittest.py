@@ -18,6 +18,7 @@
 # <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
 
 import mock
+import numpy
 import os
 import unittest
 
@@ -108,6 +109,28 @@ class EpsilonTestCase(unittest.TestCase):
             break
 
 
+    def test_epsilons_are_the_same_as_single_samples(self):
+        """Sampling many epsilons at once draws the same values as sampling
+        them one at a time."""
+        _, asset = iter(self.exposure_parser).next()
+
+        numpy.random.seed(42)
+        single = [self.epsilon_provider.epsilon(asset) for _ in xrange(5)]
+        numpy.random.seed(42)
+        self.assertTrue(numpy.allclose(
+            single, self.epsilon_provider.epsilons(asset, 5)))
+
+    def test_correlated_epsilons(self):
+        """For correlated jobs the sample of the building typology is
+        repeated."""
+        self.epsilon_provider.__dict__["ASSET_CORRELATION"] = "perfect"
+        _, asset = iter(self.exposure_parser).next()
+
+        self.assertEqual(
+            [self.epsilon_provider.epsilon(asset)] * 3,
+            list(self.epsilon_provider.epsilons(asset, 3)))
+
+
 class BlockTestCase(unittest.TestCase):
 
     def setUp(self):
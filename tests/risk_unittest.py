@@ -574,6 +574,19 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
 
         self.assertEqual(expected_curve, aggregate_curve.compute(6))
 
+    def test_assets_sharing_the_gmfs_are_aggregated_at_once(self):
+        vuln_functions = {"ID": self.vuln_function_2}
+
+        one_by_one = prob.AggregateLossCurve(vuln_functions, None)
+        one_by_one.append(self.gmfs_1, self.asset_1)
+        one_by_one.append(self.gmfs_1, self.asset_2)
+
+        at_once = prob.AggregateLossCurve(vuln_functions, None)
+        at_once.append_assets(self.gmfs_1, [self.asset_1, self.asset_2])
+
+        self.assertEqual(2, at_once.number_of_assets)
+        self.assertTrue(numpy.allclose(one_by_one.losses, at_once.losses))
+
     def test_no_distribution_without_gmfs(self):
         aggregate_curve = prob.AggregateLossCurve({}, None)
         self.assertEqual(0, aggregate_curve.losses.size)
@@ -635,7 +648,7 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
     def test_creating_the_aggregate_curve_from_kvs_gets_all_the_gmfs(self):
         # we have 6 gmfs stored in kvs
         aggregate_curve = prob.AggregateLossCurve.from_kvs(self.job_id, None)
-        self.assertEqual(6, len(aggregate_curve.distribution))
+        self.assertEqual(6, aggregate_curve.number_of_assets)
 
     def test_creating_the_aggregate_curve_from_kvs_gets_all_the_sites(self):
         expected_curve = shapes.Curve([(39.52702042, 0.99326205),
@@ -743,6 +756,15 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestMixin):
                 (0.2 * ASSET_VALUE, 2.0), (0.3 * ASSET_VALUE, 3.0)]),
                 loss_curve)
 
+    def test_loss_curves_computation(self):
+        loss_ratio_curve = shapes.Curve([(0.1, 1.0), (0.2, 2.0), (0.3, 3.0)])
+        loss_curves = common.compute_loss_curves(
+            loss_ratio_curve, [ASSET_VALUE, 2.0, 0.0])
+
+        self.assertEqual([common.compute_loss_curve(loss_ratio_curve, value)
+                          for value in (ASSET_VALUE, 2.0)], loss_curves[:2])
+        self.assertEqual(shapes.EMPTY_CURVE, loss_curves[2])
+
     def test_lrem_po_computation(self):
         hazard_curve = shapes.Curve([
               (0.01, 0.99), (0.08, 0.96),
@@ -771,6 +793,57 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestMixin):
         self.assertTrue(numpy.allclose(0.23, lrem_po[8][3], atol=0.005))
         self.assertTrue(numpy.allclose(0.00, lrem_po[10][0], atol=0.005))
 
+    def test_lrem_is_computed_once_per_vuln_function(self):
+        imls = [0.1, 0.2, 0.4, 0.6]
+        loss_ratios = [0.05, 0.08, 0.2, 0.4]
+        covs = [0.5, 0.3, 0.2, 0.1]
+
+        lrem = psha._compute_lrem(
+            shapes.VulnerabilityFunction(imls, loss_ratios, covs))
+
+        # a function with the same values shares the LREM
+        self.assertTrue(lrem is psha._compute_lrem(
+            shapes.VulnerabilityFunction(list(imls), loss_ratios, covs)))
+
+        # each cell is the lognormal survival function of its loss ratio
+        mean_val, cov = loss_ratios[1], covs[1]
+        variance = (cov * mean_val) ** 2.0
+        sigma = numpy.sqrt(numpy.log((variance / mean_val ** 2.0) + 1.0))
+        mu = numpy.log(
+            mean_val ** 2.0 / numpy.sqrt(variance + mean_val ** 2.0))
+        loss_ratio = psha._generate_loss_ratios(
+            shapes.VulnerabilityFunction(imls, loss_ratios, covs))[3]
+
+        self.assertTrue(numpy.allclose(
+            psha.stats.lognorm.sf(loss_ratio, sigma, scale=numpy.exp(mu)),
+            lrem[3][1]))
+
+    def test_the_shared_lrems_are_read_only(self):
+        lrem = psha._compute_lrem(shapes.VulnerabilityFunction(
+            [0.1, 0.2], [0.05, 0.08], [0.5, 0.3]))
+
+        def overwrite():
+            lrem[0][0] = 1.0
+
+        self.assertRaises(ValueError, overwrite)
+
+    def test_the_least_recently_used_lrems_are_evicted(self):
+        functions = [shapes.VulnerabilityFunction(
+            [0.1, 0.2], [0.05, 0.08], [0.5, cov]) for cov in (0.1, 0.2, 0.3)]
+
+        with mock.patch.object(psha, "LREM_CACHE_SIZE", 2):
+            psha._LREM_CACHE.clear()
+            first = psha._compute_lrem(functions[0])
+            psha._compute_lrem(functions[1])
+            self.assertTrue(first is psha._compute_lrem(functions[0]))
+            psha._compute_lrem(functions[2])
+
+            self.assertEqual(2, len(psha._LREM_CACHE))
+            self.assertTrue(first is psha._compute_lrem(functions[0]))
+            # functions[1] was the least recently used
+            self.assertFalse(any(key[0] == functions[1].content_hash
+                                 for key in psha._LREM_CACHE))
+
     def test_pes_from_imls(self):
         hazard_curve = shapes.Curve([
               (0.01, 0.99), (0.08, 0.96),
@@ -966,6 +1039,44 @@ class ClassicalPSHABasedTestCase(unittest.TestCase, helpers.DbTestMixin):
 
                 self.assertTrue(kvs.get(loss_key))
 
+    def test_loss_curves_of_assets_sharing_a_vuln_function(self):
+        """
+            the assets at the same point with the same vulnerability
+            function share the loss ratio curve
+        """
+
+        mixin = ClassicalPSHABasedMixin()
+        mixin.job_id = 1234
+        mixin.vuln_curves = {"ID": shapes.VulnerabilityFunction(
+            [0.1, 0.2, 0.4, 0.6], [0.05, 0.08, 0.2, 0.4],
+            [0.5, 0.3, 0.2, 0.1])}
+
+        hazard_curve = shapes.Curve([
+              (0.01, 0.99), (0.08, 0.96),
+              (0.17, 0.89), (0.26, 0.82),
+              (0.36, 0.70), (0.55, 0.40),
+              (0.70, 0.01)])
+        point = shapes.GridPoint(None, 10, 20)
+        assets = [{"vulnerabilityFunctionReference": "ID", "assetID": 1,
+                   "assetValue": 10.0},
+                  {"vulnerabilityFunctionReference": "ID", "assetID": 2,
+                   "assetValue": 20.0}]
+
+        mixin.compute_loss_curves(point, assets, hazard_curve)
+
+        loss_ratio_curve = mixin.compute_loss_ratio_curve(
+            point, assets[0], hazard_curve)
+
+        for asset in assets:
+            self.assertEqual(loss_ratio_curve.to_json(),
+                kvs.get(kvs.tokens.loss_ratio_key(
+                    1234, point.row, point.column, asset["assetID"])))
+            self.assertEqual(
+                common.compute_loss_curve(
+                    loss_ratio_curve, asset["assetValue"]).to_json(),
+                kvs.get(kvs.tokens.loss_curve_key(
+                    1234, point.row, point.column, asset["assetID"])))
+
     def test_loss_ratio_curve_in_the_classical_psha_mixin(self):
 
         # mixin "instance"
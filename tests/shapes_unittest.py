@@ -364,6 +364,19 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
         self.assertRaises(AssertionError, shapes.VulnerabilityFunction,
             self.IMLS_GOOD, self.LOSS_RATIOS_TOO_LONG, self.COVS_GOOD)
 
+    def test_content_hash(self):
+        """
+        Functions with the same values have the same content hash.
+        """
+        same_func = shapes.VulnerabilityFunction(list(self.IMLS_GOOD),
+            list(self.LOSS_RATIOS_GOOD), list(self.COVS_GOOD))
+        other_func = shapes.VulnerabilityFunction(self.IMLS_GOOD,
+            self.LOSS_RATIOS_GOOD, self.COVS_TOO_LONG[1:])
+
+        self.assertEqual(self.test_func.content_hash, same_func.content_hash)
+        self.assertNotEqual(
+            self.test_func.content_hash, other_func.content_hash)
+
     def test_from_dict(self):
         """
         Test that a VulnerabilityFunction can be created from dictionary of
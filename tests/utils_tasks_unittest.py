@@ -22,8 +22,10 @@
 Unit tests for the utils.tasks module.
 """
 
+import itertools
 import unittest
 
+from openquake import kvs
 from openquake.utils import tasks
 
 from tests.utils.helpers import patch
@@ -193,6 +195,241 @@ class DistributeTestCase(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+class DistributeAdaptivelyTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.distribute_adaptively()."""
+
+    def test_the_data_is_split_in_small_chunks(self):
+        """More chunks than running subtasks are used, in the data order."""
+        result = tasks.distribute_adaptively(
+            2, reflect_data_to_be_processed, ("data", range(20)),
+            target_chunk_duration=0.0)
+
+        self.assertTrue(len(result) > 2)
+        self.assertEqual(range(20), sum(result, []))
+
+    def test_flattened_results(self):
+        """Flattened results are returned in the right order."""
+        result = tasks.distribute_adaptively(
+            3, reflect_data_to_be_processed, ("data", range(7)),
+            flatten_results=True)
+        self.assertEqual(range(7), result)
+
+    def test_a_single_subtask_is_spawned_with_empty_data(self):
+        """A *single* subtask will be spawned even with an empty data set."""
+        result = tasks.distribute_adaptively(
+            3, reflect_data_to_be_processed, ("data", []))
+        self.assertEqual([[]], result)
+
+    def test_distribute_uses_the_configured_scheduling(self):
+        """distribute() schedules adaptively when configured to do so."""
+        with patch('openquake.utils.tasks.scheduling') as scheduling_mock:
+            scheduling_mock.return_value = tasks.ADAPTIVE_SCHEDULING
+            result = tasks.distribute(
+                3, reflect_data_to_be_processed, ("data", range(7)),
+                flatten_results=True)
+        self.assertEqual(range(7), result)
+
+    def test_a_slow_chunk_does_not_stop_the_others(self):
+        """New chunks are submitted while an older one is still running."""
+        submitted = []
+        collected = []
+
+        class SlowResult(FakeResult):
+            """The result of the first chunk, which finishes once four more
+            chunks were submitted."""
+
+            def ready(self):
+                return len(submitted) > 4
+
+            def get(self, timeout=None):
+                collected.append(len(submitted))
+                return FakeResult.get(self, timeout)
+
+        class SlowFirstChunkTask(object):
+            """A task whose first chunk is slow."""
+
+            def apply_async(self, kwargs):
+                submitted.append(kwargs["data"])
+                if len(submitted) == 1:
+                    return SlowResult(kwargs["data"])
+                return FakeResult(kwargs["data"])
+
+        result = tasks.distribute_adaptively(
+            2, SlowFirstChunkTask(), ("data", range(20)),
+            flatten_results=True, target_chunk_duration=0.0)
+
+        self.assertEqual(range(20), result)
+        self.assertTrue(collected[0] > 4)
+
+    def test_distribute_adaptively_with_failing_subtask(self):
+        """At least one subtask failed, a `TaskFailed` exception is raised."""
+        self.assertRaises(tasks.TaskFailed, tasks.distribute_adaptively,
+                          1, failing_task, ("data", range(5)))
+
+
+class IterDistributeTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.iter_distribute()."""
+
+    def test_iter_distribute_yields_the_results_with_their_index(self):
+        """All the results are yielded, with the index of their subtask."""
+        result = tasks.iter_distribute(
+            3, reflect_data_to_be_processed, ("data", range(7)))
+        self.assertEqual([(0, [0, 1]), (1, [2, 3]), (2, [4, 5, 6])],
+                         sorted(result))
+
+    def test_iter_distribute_with_failing_subtask(self):
+        """At least one subtask failed, a `TaskFailed` exception is raised."""
+        result = tasks.iter_distribute(1, failing_task, ("data", range(5)))
+        self.assertRaises(tasks.TaskFailed, list, result)
+
+
+class WaitForAnyTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.wait_for_any()."""
+
+    def test_the_finished_tasks_are_removed(self):
+        """The values of the finished tasks are returned with their tags."""
+        pending = [
+            ("a", reflect_data_to_be_processed.apply_async(
+                kwargs=dict(data=[1]))),
+            ("b", reflect_data_to_be_processed.apply_async(
+                kwargs=dict(data=[2])))]
+        finished = []
+        while pending:
+            finished.extend(tasks.wait_for_any(pending))
+        self.assertEqual([("a", [1]), ("b", [2])], sorted(finished))
+
+    def test_a_slow_task_does_not_delay_the_finished_ones(self):
+        """The tasks which finished are returned while an older one is still
+        running."""
+        slow = FakeResult(None, finished=False)
+        pending = [("slow", slow), ("fast", FakeResult(42))]
+        self.assertEqual([("fast", 42)], tasks.wait_for_any(pending))
+        self.assertEqual([("slow", slow)], pending)
+
+    def test_only_the_tasks_signalling_their_completion_are_checked(self):
+        """The running tasks are not checked while the others signal their
+        completion."""
+        slow = FakeResult(None, finished=False)
+        slow.ready = lambda: self.fail("a running task was checked")
+        pending = [("slow", slow), ("fast", FakeResult(42))]
+        self.assertEqual([("fast", 42)],
+                         tasks.wait_for_any(pending, check_interval=60))
+
+    def test_the_tasks_are_all_checked_without_a_signal(self):
+        """A finished task which did not signal its completion (e.g. it did
+        not run in a worker) is found when all the tasks are checked."""
+        result = FakeResult(42)
+        kvs.get_client().delete(kvs.tokens.task_done_key(result.task_id))
+        self.assertEqual([("a", 42)], tasks.wait_for_any(
+            [("a", result)], check_interval=1))
+
+    def test_wait_for_any_with_failing_task(self):
+        """A task failed, a `TaskFailed` exception is raised."""
+        pending = [("a", failing_task.apply_async(kwargs=dict(data=[1])))]
+        self.assertRaises(tasks.TaskFailed, tasks.wait_for_any, pending)
+
+
+_FAKE_TASK_IDS = itertools.count()
+
+
+class FakeResult(object):
+    """A finished `celery` result, with the given outcome (a value or an
+    exception). Its completion is signalled like a worker does."""
+
+    def __init__(self, outcome, finished=True):
+        self.outcome = outcome
+        self.finished = finished
+        self.task_id = "fake-%s" % _FAKE_TASK_IDS.next()
+
+        if finished:
+            tasks.signal_task_done(task_id=self.task_id)
+
+    def ready(self):
+        return self.finished
+
+    def successful(self):
+        return not isinstance(self.outcome, Exception)
+
+    @property
+    def result(self):
+        return self.outcome
+
+    def get(self, timeout=None):
+        if not self.finished:
+            raise tasks.TimeoutError()
+
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+
+        return self.outcome
+
+
+class RetriedTaskTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.RetriedTask."""
+
+    def retried_task(self, *results, **kwargs):
+        """A task with the given successive results."""
+        results = list(results)
+        kwargs.setdefault("retry_delay", 0)
+        kwargs.setdefault("timeout", 0)
+        return tasks.RetriedTask(lambda: results.pop(0), **kwargs)
+
+    def test_failed_tasks_are_resubmitted(self):
+        task = self.retried_task(
+            FakeResult(IOError("1")), FakeResult(IOError("2")),
+            FakeResult(42), max_retries=2)
+        self.assertEqual(42, task.get())
+        self.assertEqual(2, task.retries)
+
+    def test_the_retry_budget_is_limited(self):
+        task = self.retried_task(
+            FakeResult(IOError("1")), FakeResult(IOError("2")),
+            FakeResult(42), max_retries=1)
+        self.assertRaises(IOError, task.get)
+
+    def test_wrong_parameters_are_not_retried(self):
+        task = self.retried_task(
+            FakeResult(TypeError("wrong")), FakeResult(42), max_retries=1)
+        self.assertTrue(task.ready())
+        self.assertRaises(TypeError, task.get)
+
+    def test_ready_resubmits_failed_tasks(self):
+        task = self.retried_task(
+            FakeResult(IOError("1")), FakeResult(42), max_retries=1)
+        self.assertFalse(task.ready())
+        self.assertTrue(task.ready())
+        self.assertEqual(42, task.get())
+
+    def test_lost_tasks_are_resubmitted(self):
+        with patch('openquake.utils.tasks.revoke') as revoke_mock:
+            lost = FakeResult(None, finished=False)
+            task = self.retried_task(
+                lost, FakeResult(42), max_retries=1, timeout=0.01)
+            self.assertEqual(42, task.get())
+            revoke_mock.assert_called_once_with(
+                lost.task_id, terminate=True)
+
+    def test_wait_for_any_reports_the_final_failure(self):
+        pending = [("a", self.retried_task(
+            FakeResult(IOError("1")), FakeResult(IOError("2")),
+            max_retries=1))]
+        self.assertRaises(tasks.TaskFailed, tasks.wait_for_any, pending)
+
+
+class PortionsTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.portions()."""
+
+    def test_the_last_portion_takes_the_rest(self):
+        self.assertEqual([[0, 1], [2, 3], [4, 5, 6]],
+                         tasks.portions(range(7), 3))
+
+    def test_at_most_one_portion_per_item(self):
+        self.assertEqual([[0], [1]], tasks.portions(range(2), 5))
+
+    def test_one_empty_portion_with_empty_data(self):
+        self.assertEqual([[]], tasks.portions([], 3))
+
+
 class ParallelizeTestCase(unittest.TestCase):
     """Tests the behaviour of utils.tasks.parallelize()."""
 
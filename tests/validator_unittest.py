@@ -22,6 +22,7 @@ This module tests the logic related to the engine configuration
 and its validation.
 """
 
+from openquake import kvs
 from openquake.job import config
 from tests.utils import helpers
 
@@ -105,3 +106,25 @@ class ConfigurationConstraintsTestCase(unittest.TestCase):
 
         engine = helpers.create_job(params, sections=sections)
         self.assertTrue(engine.is_valid()[0])
+
+    def test_java_hazard_processing_needs_the_redis_kvs_backend(self):
+        sections = ["HAZARD", "general"]
+        engine = helpers.create_job(
+            {config.CALCULATION_MODE: "Classical"}, sections=sections)
+
+        with helpers.patch('openquake.kvs.backend') as backend_mock:
+            backend_mock.return_value = kvs.LOCAL_BACKEND
+            self.assertFalse(engine.is_valid()[0])
+
+            # the deterministic hazard only uses Java to compute
+            engine.params[config.CALCULATION_MODE] = "Deterministic"
+            self.assertTrue(engine.is_valid()[0])
+
+            engine.params[config.CALCULATION_MODE] = "Event Based"
+            engine.sections = [config.RISK_SECTION, "general"]
+            engine.params[config.EXPOSURE] = "/a/path/to/exposure"
+            self.assertTrue(engine.is_valid()[0])
+
+            backend_mock.return_value = kvs.REDIS_BACKEND
+            engine.sections = sections
+            self.assertTrue(engine.is_valid()[0])